@@ -68,9 +68,9 @@ def transform(module):
     if not isinstance(node, ast.Node):
       continue
     if isinstance(node, ast.Enum):
-      print transform_enum(node)
+      print(transform_enum(node))
     elif isinstance(node, ast.Struct):
-      print transform_struct(node)
+      print(transform_struct(node))
     # TODO(constants)
     # TODO(typedefs)
 
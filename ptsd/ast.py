@@ -11,23 +11,208 @@ def untab(s):
   return s.replace('\t', ' '*TAB_SPACES)
 
 
+_FIELDS = {}
+
+
+def _fields(cls):
+  """Return the names of the public attributes of the node class cls, in a fixed order."""
+  fields = _FIELDS.get(cls)
+  if fields is None:
+    fields = []
+    for base in reversed(cls.__mro__):
+      for name in getattr(base, '__slots__', ()):
+        if not name.startswith('_') and name not in fields:
+          fields.append(name)
+    fields = _FIELDS[cls] = tuple(fields)
+  return fields
+
+
+_HASH = None
+
+
+def _hash(data):
+  """Return the 16 byte digest of data; hashlib is imported by the first call."""
+  global _HASH
+  if _HASH is None:
+    from hashlib import blake2b
+    _HASH = blake2b
+  return _HASH(data, digest_size=16).digest()
+
+
+# Values hashed as they are, by their repr.
+_PLAIN = frozenset([str, int, bool, float, type(None)])
+
+# What _stand_in() returns for values with parts to go through first.
+_COMPOSITE = object()
+
+
+def _stand_in(value):
+  """Return what stands for value, a node or any value within one, in the repr a fingerprint
+  hashes, or _COMPOSITE if that is made of what stands for its parts.
+  """
+  if type(value) in _PLAIN:
+    return value
+  elif isinstance(value, Identifier):
+    # Names are hashed into the node holding them rather than one by one.
+    return ('I', value.value)
+  elif isinstance(value, Node):
+    fingerprint = getattr(value, '_fingerprint', None)
+    return _COMPOSITE if fingerprint is None else fingerprint
+  elif isinstance(value, (list, tuple, dict)):
+    return _COMPOSITE
+  elif isinstance(value, Literal):
+    return ('L', value.value)
+  elif isinstance(value, LexerIdentifier):
+    return ('D', value.value)
+  raise TypeError('Can not fingerprint %s' % type(value).__name__)
+
+
+# The kinds of values _combine() goes through.
+_NODE, _DICT, _SEQUENCE = range(3)
+
+
+def _frame(value):
+  if isinstance(value, Node):
+    cls = type(value)
+    return value, [cls.__name__], iter([getattr(value, name, None) for name in _fields(cls)]), _NODE
+  elif isinstance(value, dict):
+    return value, [], iter(value.items()), _DICT
+  return value, [], iter(value), _SEQUENCE
+
+
+def _combine(value):
+  """Return what stands for value, a node, list, tuple or dict, in the repr a fingerprint hashes.
+
+  Goes through value with an explicit stack, however deep it nests, and gives every node below it
+  without a fingerprint one on the way, children first.  A node stands for its fingerprint, the
+  hash of its class name and what stands for its attributes.  A list or tuple stands for a list of
+  what stands for its items, or for the hash of that within another list, so the repr hashed never
+  nests deeply.  A dict stands for the sorted hashes of its entries.
+  """
+  stack = [_frame(value)]
+  while True:
+    value, parts, items, kind = stack[-1]
+    for item in items:
+      cls = type(item)
+      if cls in _PLAIN:
+        parts.append(item)
+      elif cls is Identifier:
+        parts.append(('I', item.value))
+      elif cls is list and not item and kind != _SEQUENCE:
+        parts.append([])
+      else:
+        part = _stand_in(item)
+        if part is _COMPOSITE:
+          stack.append(_frame(item))
+          break
+        parts.append(part)
+    else:
+      stack.pop()
+      if kind == _NODE:
+        part = value._fingerprint = _hash(repr(parts).encode('utf-8'))
+      elif kind == _DICT:
+        # Const maps are equal whatever order their entries were written in.
+        part = ('M', tuple(sorted(_hash(repr(entry).encode('utf-8')) for entry in parts)))
+      elif stack and stack[-1][3] == _SEQUENCE:
+        part = ('H', _hash(repr(parts).encode('utf-8')))
+      else:
+        part = parts
+      if not stack:
+        return part
+      stack[-1][1].append(part)
+
+
+def fingerprint(value):
+  """Return the structural fingerprint of value, a node or any value within one, as 16 bytes."""
+  if isinstance(value, Node):
+    return value.fingerprint()
+  part = _stand_in(value)
+  if part is _COMPOSITE:
+    part = _combine(value)
+  return _hash(repr(part).encode('utf-8'))
+
+
 class Node(object):
+  # Nodes use __slots__ to keep large trees compact.  Both spans are packed into the single int
+  # _span (lexspan in the low 64 bits, linespan in the high 64, 32 bits per position), or None for
+  # nodes built without positions, either directly or by a parser with track_positions disabled.
+  # _fingerprint is unset until fingerprint() is first called.
+  __slots__ = ('_span', '_fingerprint')
+
   def __init__(self, parser, offset=0):
-    self._linespan = parser.linespan(offset)
-    self._lexspan = parser.lexspan(offset)
+    if parser is None or not parser.parser.track_positions:
+      self._span = None
+    else:
+      (line_start, line_end), (lex_start, lex_end) = parser.linespan(offset), parser.lexspan(offset)
+      self._span = lex_start | lex_end << 32 | line_start << 64 | line_end << 96
     super(Node, self).__init__()
 
+  @property
+  def _linespan(self):
+    span = self._span
+    return None if span is None else ((span >> 64) & 0xFFFFFFFF, span >> 96)
+
+  @property
+  def _lexspan(self):
+    span = self._span
+    return None if span is None else (span & 0xFFFFFFFF, (span >> 32) & 0xFFFFFFFF)
+
+  def fingerprint(self):
+    """Return the structural fingerprint of this node, 16 bytes.
+
+    It hashes what the node means, its class and public attributes, with the fingerprints of the
+    nodes below it standing in for them, and leaves out spans: two trees have equal fingerprints
+    when they are equal however they were formatted.  Fingerprints are computed bottom-up once and
+    kept; call Thrift.invalidate() after modifying a tree.
+    """
+    fingerprint = getattr(self, '_fingerprint', None)
+    if fingerprint is None:
+      fingerprint = _combine(self)
+    return fingerprint
+
+  def _forget(self):
+    """Drop the cached fingerprints of this node and of every node below it."""
+    stack = [self]
+    while stack:
+      value = stack.pop()
+      if isinstance(value, Node):
+        try:
+          del value._fingerprint
+        except AttributeError:
+          pass
+        stack.extend(getattr(value, name, None) for name in _fields(type(value)))
+      elif isinstance(value, (list, tuple)):
+        stack.extend(value)
+      elif isinstance(value, dict):
+        stack.extend(value)
+        stack.extend(value.values())
+
   def _walk(self):
     return []
 
-  def walk(self):
-    for child in self._walk():
-      yield (self, child)
-      for pair in child.walk():
-        yield pair
+  def walk(self, types=None, prune=None):
+    """Yield (parent, child) for every node below this one, depth-first in source order.
+
+    types restricts the pairs yielded to children that are instances of types (a class or a tuple
+    of classes); the walk still visits everything below them.  The subtree of any child for which
+    prune(child) is true is skipped.  The walk is iterative, so arbitrarily deep trees are fine.
+    """
+    stack = [(self, iter(self._walk()))]
+    while stack:
+      parent, children = stack[-1]
+      for child in children:
+        if types is None or isinstance(child, types):
+          yield (parent, child)
+        if prune is None or not prune(child):
+          stack.append((child, iter(child._walk())))
+        break
+      else:
+        stack.pop()
 
 
 class Identifier(Node):
+  __slots__ = ('value',)
+
   def __init__(self, parser, offset):
     assert isinstance(parser[offset], LexerIdentifier)
     self.value = parser[offset].value
@@ -38,10 +223,31 @@ class Identifier(Node):
 
 
 class Thrift(Node):
+  __slots__ = ('includes', 'namespaces', 'body', '_index')
+
   def __init__(self, parser):
     self.includes = [k for k in parser[1] if isinstance(k, Include)]
     self.namespaces = [k for k in parser[1] if isinstance(k, Namespace)]
     self.body = parser[2]
+    self._index = None
+    super(Thrift, self).__init__(None)
+
+  def __getstate__(self):
+    # The index is rebuilt on demand rather than pickled.
+    return None, dict((name, getattr(self, name)) for name in (
+        '_span', 'includes', 'namespaces', 'body'))
+
+  def index(self):
+    """Return the NodeIndex of this tree, building it on first use."""
+    index = getattr(self, '_index', None)
+    if index is None:
+      index = self._index = NodeIndex(self)
+    return index
+
+  def invalidate(self):
+    """Drop the cached index and fingerprints; call this after modifying the tree."""
+    self._index = None
+    self._forget()
 
   def _walk(self):
     return itertools.chain(self.includes, self.namespaces, self.body)
@@ -56,7 +262,49 @@ class Thrift(Node):
 
 
 
+class NodeIndex(object):
+  """The nodes of a tree grouped by type and by annotation, with their parents.
+
+  Built with a single walk; every query afterwards is a dict lookup.  Use Thrift.index() to get the
+  index of a tree, which is cached until Thrift.invalidate() is called.
+  """
+
+  def __init__(self, thrift):
+    self._by_type = {}
+    self._by_annotation = {}
+    self._parents = {}
+    self._subclass_cache = {}
+    for parent, node in thrift.walk():
+      self._parents[node] = parent
+      self._by_type.setdefault(type(node), []).append(node)
+      for annotation in getattr(node, 'annotations', ()):
+        self._by_annotation.setdefault(annotation.name.value, []).append(node)
+
+  def of_type(self, cls):
+    """Return the nodes that are instances of cls, in walk order."""
+    nodes = self._by_type.get(cls)
+    if nodes is not None and not cls.__subclasses__():
+      return nodes
+    nodes = self._subclass_cache.get(cls)
+    if nodes is None:
+      # Merge the matching types back into walk order.
+      matching = set(kind for kind in self._by_type if issubclass(kind, cls))
+      nodes = self._subclass_cache[cls] = [
+          node for node in self._parents if type(node) in matching]
+    return nodes
+
+  def annotated(self, name):
+    """Return the nodes carrying an annotation called name, in walk order."""
+    return self._by_annotation.get(name, [])
+
+  def parent(self, node):
+    """Return the parent of node, the Thrift itself for top-level nodes."""
+    return self._parents[node]
+
+
 class Namespace(Node):
+  __slots__ = ('old_style', 'language_id', 'name')
+
   def __init__(self, parser):
     '''header : include
               | NAMESPACE IDENTIFIER IDENTIFIER
@@ -89,6 +337,8 @@ class Namespace(Node):
 
 
 class Include(Node):
+  __slots__ = ('path',)
+
   def __init__(self, parser):
     '''include : INCLUDE LITERAL'''
     self.path = parser[2]
@@ -99,18 +349,28 @@ class Include(Node):
 
 
 class Annotated(object):
+  __slots__ = ()
+
   def __init__(self):
     self.annotations = []
     super(Annotated, self).__init__()
 
   def add_annotations(self, annotations=None):
-    self.annotations.extend(annotations or [])
+    if not annotations:
+      return
+    if isinstance(self.annotations, tuple):
+      # Nodes shared between trees (shared base types, interned types) are frozen.
+      raise TypeError('This %s is shared and immutable; annotate a node of its own' % (
+          type(self).__name__))
+    self.annotations.extend(annotations)
 
   def annotations_str(self):
     return ' %s' % ' '.join(map(str, self.annotations)) if self.annotations else ''
 
 
 class Typedef(Node, Annotated):
+  __slots__ = ('type', 'name', 'annotations')
+
   def __init__(self, parser):
     '''typedef : TYPEDEF field_type IDENTIFIER type_annotations'''
     super(Typedef, self).__init__(parser)
@@ -127,6 +387,8 @@ class Typedef(Node, Annotated):
 
 
 class Enum(Node, Annotated):
+  __slots__ = ('name', 'values', 'annotations')
+
   def __init__(self, parser):
     '''enum : ENUM IDENTIFIER start_enum_counter '{' enum_def_list '}' type_annotations'''
     super(Enum, self).__init__(parser)
@@ -145,6 +407,8 @@ class Enum(Node, Annotated):
 
 
 class EnumDef(Node, Annotated):
+  __slots__ = ('name', 'tag', 'annotations')
+
   def __init__(self, parser, tag_number):
     '''enum_def : IDENTIFIER '=' INTCONSTANT type_annotations comma_or_semicolon_optional
                 | IDENTIFIER type_annotations comma_or_semicolon_optional'''
@@ -158,6 +422,8 @@ class EnumDef(Node, Annotated):
 
 
 class Senum(Node, Annotated):
+  __slots__ = ('name', 'values', 'annotations')
+
   def __init__(self, parser):
     '''senum : SENUM IDENTIFIER '{' senum_def_list '}' type_annotations'''
     super(Senum, self).__init__(parser)
@@ -167,6 +433,8 @@ class Senum(Node, Annotated):
 
 
 class Const(Node):
+  __slots__ = ('type', 'name', 'value')
+
   @classmethod
   def render_value(cls, value, indent=0):
     if isinstance(value, list):
@@ -191,6 +459,8 @@ class Const(Node):
 
 
 class Struct(Node, Annotated):
+  __slots__ = ('union', 'name', 'xsd_all', 'fields', 'annotations')
+
   def __init__(self, parser):
     '''struct : struct_head IDENTIFIER xsd_all '{' field_list '}' type_annotations'''
     super(Struct, self).__init__(parser)
@@ -212,6 +482,8 @@ class Struct(Node, Annotated):
 
 
 class Exception_(Node, Annotated):
+  __slots__ = ('name', 'fields', 'annotations')
+
   def __init__(self, parser):
     '''exception : EXCEPTION IDENTIFIER '{' field_list '}' type_annotations'''
     super(Exception_, self).__init__(parser)
@@ -230,6 +502,8 @@ class Exception_(Node, Annotated):
 
 
 class Service(Node, Annotated):
+  __slots__ = ('name', 'extends', 'functions', 'annotations')
+
   def __init__(self, parser):
     '''service : SERVICE IDENTIFIER extends '{' flag_args function_list unflag_args '}' type_annotations'''
     super(Service, self).__init__(parser)
@@ -244,12 +518,14 @@ class Service(Node, Annotated):
   def __str__(self):
     return untab('service %s%s {\n\t%s\n}%s' % (
         self.name,
-        ' extends %s' % self.extends if self.extends else '',
+        ' extends %s' % getattr(self.extends, 'value', self.extends) if self.extends else '',
         '\n\t'.join(map(str, self.functions)),
         self.annotations_str()))
 
 
 class Function(Node, Annotated):
+  __slots__ = ('oneway', 'type', 'name', 'arguments', 'throws', 'annotations')
+
   def __init__(self, parser):
     '''function : oneway
                   function_type
@@ -282,6 +558,9 @@ class Function(Node, Annotated):
 
 
 class Field(Node, Annotated):
+  __slots__ = ('tag', 'required', 'type', 'name', 'const_value', 'xsd_optional', 'xsd_nillable',
+               'xsd_attributes', 'annotations')
+
   def __init__(self, parser):
     '''field : field_identifier field_requiredness field_type IDENTIFIER field_value xsd_optional
                xsd_nillable xsd_attributes type_annotations comma_or_semicolon_optional'''
@@ -310,6 +589,8 @@ class Field(Node, Annotated):
 
 
 class TypeAnnotation(Node):
+  __slots__ = ('name', 'value')
+
   def __init__(self, parser):
     """type_annotation : IDENTIFIER '=' LITERAL comma_or_semicolon_optional"""
     super(TypeAnnotation, self).__init__(parser)
@@ -322,57 +603,85 @@ class TypeAnnotation(Node):
 
 # Base types
 class BaseType(object):
+  """A base type: string, binary, slist, bool, byte, i16, i32, i64 or double.
+
+  The base type classes no longer define a constructor taking only the production: they are built
+  as any Node is, cls(parser, offset=0), where offset picks the symbol whose span the node takes
+  and parser may be None for a node without one.  An unannotated occurrence is the instance
+  cls.shared() instead, which is immutable: its annotations are an empty tuple and
+  add_annotations() raises TypeError rather than extend them.
+  """
+
+  __slots__ = ()
+
+  # The instances shared by every unannotated occurrence of each base type, keyed by class.
+  _SHARED = {}
+
+  @classmethod
+  def shared(cls):
+    """Return the instance of this base type shared by all of its unannotated occurrences.
+
+    Shared instances carry no spans and their annotations cannot be extended.
+    """
+    instance = BaseType._SHARED.get(cls)
+    if instance is None:
+      instance = BaseType._SHARED[cls] = cls(None)
+      instance.annotations = ()
+    return instance
+
+  def __reduce_ex__(self, protocol):
+    if BaseType._SHARED.get(type(self)) is self:
+      return (_shared_base_type, (type(self),))
+    return super(BaseType, self).__reduce_ex__(protocol)
+
   def __str__(self):
     return self.__class__.__name__.lower()
 
 
+def _shared_base_type(cls):
+  return cls.shared()
+
+
 class String(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(String, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class Binary(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(Binary, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class Slist(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(Slist, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class Bool(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(Bool, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class Byte(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(Byte, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class I16(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(I16, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class I32(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(I32, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class I64(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(I64, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 class Double(Node, Annotated, BaseType):
-  def __init__(self, parser):
-    super(Double, self).__init__(parser)
+  __slots__ = ('annotations',)
 
 
 # Container types
 class Map(Node, Annotated):
+  __slots__ = ('cpp_type', 'key_type', 'value_type', 'annotations')
+
   def __init__(self, parser):
     """MAP cpp_type '<' field_type ',' field_type '>'"""
     self.cpp_type = parser[2]
@@ -385,6 +694,8 @@ class Map(Node, Annotated):
 
 
 class Set(Node, Annotated):
+  __slots__ = ('cpp_type', 'value_type', 'annotations')
+
   def __init__(self, parser):
     """SET cpp_type '<' field_type '>'"""
     self.cpp_type = parser[2]
@@ -396,6 +707,8 @@ class Set(Node, Annotated):
 
 
 class List(Node, Annotated):
+  __slots__ = ('value_type', 'annotations')
+
   def __init__(self, parser):
     """LIST '<' field_type '>'"""
     self.value_type = parser[3]
@@ -0,0 +1,210 @@
+"""Loading many roots at once, as a schema check over a whole tree of Thrift files.
+
+  batch = BatchLoader(cache=ASTCache(directory))
+  for result in batch.run(expand(['idl/'])):
+    print(result)
+
+Every root is loaded with its includes, as Loader does, but the loads share one parser and every
+file already loaded: a file included by a thousand roots is parsed once.  A root that fails to load
+does not stop the batch; its result holds the error instead.  With workers, the roots are split
+into runs of neighbouring roots, each loaded by one of a pool of worker processes sharing what it
+loaded across its runs, and the results still come back in the order of the roots.
+"""
+
+import glob
+import os
+import sys
+import time
+
+from .lexer import Lexer
+from .loader import Loader, Shared
+from .parser import Parser
+
+
+# What loading a root may fail with: its result records the error, and the batch goes on.
+ERRORS = (Lexer.Error, Parser.Error, Loader.Error, EnvironmentError, UnicodeDecodeError)
+
+
+def expand(arguments, extension='.thrift'):
+  """Return the roots named by arguments: files, directories searched recursively for files with
+  extension, and glob patterns ('**' matching any number of directories).
+
+  Roots are returned sorted within each argument, so neighbouring roots tend to share includes.  A
+  root named more than once, by any path, is only returned where it is first named.
+  """
+  roots = []
+  for argument in arguments:
+    if os.path.isdir(argument):
+      found = []
+      for directory, directories, filenames in os.walk(argument):
+        directories.sort()
+        found.extend(os.path.join(directory, filename) for filename in filenames
+                     if filename.endswith(extension))
+      roots.extend(sorted(found))
+    elif glob.has_magic(argument):
+      roots.extend(sorted(path for path in glob.glob(argument, recursive=True)
+                          if os.path.isfile(path)))
+    else:
+      roots.append(argument)
+  seen = set()
+  unique = []
+  for root in roots:
+    real = os.path.realpath(root)
+    if real not in seen:
+      seen.add(real)
+      unique.append(root)
+  return unique
+
+
+class Result(object):
+  """The outcome of loading one root.
+
+  modules is the number of modules the root loaded, files the number of them parsed (or read from
+  the cache) for this root rather than shared with an earlier one, and error the message of what
+  the load failed with, or None.
+  """
+
+  __slots__ = ('root', 'seconds', 'modules', 'files', 'error')
+
+  def __init__(self, root, seconds, modules=0, files=0, error=None):
+    self.root = root
+    self.seconds = seconds
+    self.modules = modules
+    self.files = files
+    self.error = error
+
+  @property
+  def ok(self):
+    return self.error is None
+
+  def as_dict(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+  def __str__(self):
+    if self.error is not None:
+      return 'FAIL %8.1fms  %s: %s' % (1000 * self.seconds, self.root, self.error)
+    return 'ok   %8.1fms  %s  (%d modules, %d parsed)' % (
+        1000 * self.seconds, self.root, self.modules, self.files)
+
+
+class Summary(object):
+  """Totals over the Results of a batch."""
+
+  def __init__(self, results, seconds, setup_seconds=0.0):
+    self.results = results
+    self.seconds = seconds
+    self.setup_seconds = setup_seconds
+
+  @property
+  def failures(self):
+    return [result for result in self.results if not result.ok]
+
+  @property
+  def files(self):
+    return sum(result.files for result in self.results)
+
+  def as_dict(self):
+    return {
+      'roots': len(self.results),
+      'failures': len(self.failures),
+      'files': self.files,
+      'seconds': self.seconds,
+      'setup_seconds': self.setup_seconds,
+      'slowest': [result.as_dict() for result in self.slowest()],
+    }
+
+  def slowest(self, count=5):
+    return sorted(self.results, key=lambda result: -result.seconds)[:count]
+
+  def report(self, fp=sys.stdout, top=5):
+    print('%d roots, %d failed, %d files parsed in %.1fms (parser setup %.1fms)' % (
+        len(self.results), len(self.failures), self.files, 1000 * self.seconds,
+        1000 * self.setup_seconds), file=fp)
+    for result in self.slowest(top):
+      print('  %8.1fms  %s' % (1000 * result.seconds, result.root), file=fp)
+    for result in self.failures:
+      print('FAIL %s: %s' % (result.root, result.error), file=fp)
+
+
+_WORKER_BATCH = None
+
+
+def _init_worker(options):
+  global _WORKER_BATCH
+  _WORKER_BATCH = BatchLoader(**options)
+
+
+def _check_run(roots):
+  """Check roots in a pool worker, returning their Results and the parser setup time it took."""
+  before = _WORKER_BATCH.shared.setup_seconds
+  results = [_WORKER_BATCH.check(root) for root in roots]
+  return results, _WORKER_BATCH.shared.setup_seconds - before
+
+
+class BatchLoader(object):
+  """Loads many roots, sharing one parser and every loaded file between them.
+
+  The keyword arguments are passed on to each Loader, whose logger is silenced; see Loader for
+  them.  workers, if more than one, is the number of worker processes run() spreads the roots over.
+  The time spent building parsers is not part of any Result, but kept apart in setup_seconds.
+  """
+
+  # How many runs of roots run() aims to give each worker: more balances the load better, fewer
+  # share more files within each run.
+  RUNS = 4
+
+  def __init__(self, workers=None, **options):
+    self.workers = workers
+    self.options = dict(options, logger=lambda message: None)
+    self.options.pop('workers', None)
+    self.shared = Shared()
+    self._worker_setup_seconds = 0.0
+
+  @property
+  def setup_seconds(self):
+    """The time spent building parsers, here and in the workers."""
+    return self.shared.setup_seconds + self._worker_setup_seconds
+
+  def check(self, root):
+    """Load root, returning its Result."""
+    shared = self.shared
+    files, setup_seconds = len(shared.files), shared.setup_seconds
+    start = time.perf_counter()
+    modules, error = 0, None
+    try:
+      modules = len(Loader(root, shared=shared, **self.options).modules)
+    except ERRORS as e:
+      error = '%s: %s' % (type(e).__qualname__, e)
+    # The load that builds the shared parser does not pay for it.
+    seconds = time.perf_counter() - start - (shared.setup_seconds - setup_seconds)
+    return Result(root, seconds, modules=modules, files=len(shared.files) - files, error=error)
+
+  def run(self, roots):
+    """Load each of roots, yielding their Results in order."""
+    roots = list(roots)
+    if not self.workers or self.workers <= 1 or len(roots) <= 1:
+      for root in roots:
+        yield self.check(root)
+      return
+    import multiprocessing
+
+    size = max(1, -(-len(roots) // (self.workers * self.RUNS)))
+    runs = [roots[i:i + size] for i in range(0, len(roots), size)]
+    options = dict(self.options)
+    del options['logger']  # not picklable; workers set their own
+    pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(options,))
+    try:
+      for results, setup_seconds in pool.imap(_check_run, runs):
+        self._worker_setup_seconds += setup_seconds
+        for result in results:
+          yield result
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def summary(self, roots):
+    """Load each of roots, returning the Summary of the batch."""
+    start = time.perf_counter()
+    results = list(self.run(roots))
+    return Summary(results, time.perf_counter() - start, self.setup_seconds)
@@ -0,0 +1,470 @@
+"""Benchmarks for ptsd.
+
+  python -m ptsd.benchmark [options] [FILE ...]
+
+times starting up, building the PLY parser (from scratch, from its pickled tables and from tables
+already loaded), lexing, parsing, loading, rendering, the protocol codecs and validation, and
+measures memory, over the given Thrift files or, without files, over a synthetic include graph
+generated from the options.  With --json the results are printed as one JSON document, to be saved
+and compared between commits.  With --import-budget it fails when importing ptsd.loader takes
+longer than the budget, so a heavy import creeping back in shows up.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import __version__
+from . import ast
+from . import validator as validator_module
+from .codec import Codec, Interpreter, Resolver
+from .lexer import Lexer, Scanner
+from .loader import Loader
+from .parser import parser_class
+
+
+BASE_TYPES = ('bool', 'byte', 'i16', 'i32', 'i64', 'double', 'string', 'binary')
+
+
+class Generator(object):
+  """Generates a synthetic, valid Thrift include graph.
+
+  Module i includes the next fanout modules, so the graph is a DAG rooted at module 0.  Field types
+  mix base types, containers nested up to depth levels (as in CrazyNesting) and references to the
+  structs and enums of the module itself and of the modules it includes.
+  """
+
+  def __init__(self, modules=10, fanout=2, structs=50, fields=10, enums=5, values=10, services=2,
+               functions=10, depth=3, seed=0):
+    self.modules = modules
+    self.fanout = fanout
+    self.structs = structs
+    self.fields = fields
+    self.enums = enums
+    self.values = values
+    self.services = services
+    self.functions = functions
+    self.depth = depth
+    self.seed = seed
+
+  def module_name(self, index):
+    return 'module%d' % index
+
+  def includes(self, index):
+    return [i for i in range(index + 1, index + 1 + self.fanout) if i < self.modules]
+
+  def _type(self, rng, names, depth):
+    roll = rng.random()
+    if depth > 0 and roll < 0.3:
+      container = rng.choice(('list', 'set', 'map'))
+      if container == 'map':
+        return 'map<%s, %s>' % (rng.choice(BASE_TYPES), self._type(rng, names, depth - 1))
+      return '%s<%s>' % (container, self._type(rng, names, depth - 1))
+    if names and roll < 0.6:
+      return rng.choice(names)
+    return rng.choice(BASE_TYPES)
+
+  def module(self, index):
+    """Return the source of module index."""
+    rng = random.Random('%s:%d' % (self.seed, index))
+    lines = ['include "%s.thrift"' % self.module_name(i) for i in self.includes(index)]
+    lines.append('namespace py bench.%s' % self.module_name(index))
+    names = []
+    for i in self.includes(index):
+      names.extend('%s.Struct%d' % (self.module_name(i), s) for s in range(min(self.structs, 3)))
+    for e in range(self.enums):
+      lines.append('\n/** Enum %d of module %d. */\nenum Enum%d {' % (e, index, e))
+      lines.extend('  VALUE%d = %d,' % (v, v) for v in range(self.values))
+      lines.append('}')
+      names.append('Enum%d' % e)
+    for s in range(self.structs):
+      lines.append('\nstruct Struct%d {' % s)
+      for f in range(self.fields):
+        lines.append('  %d: %s%s field%d%s' % (
+            f + 1,
+            'required ' if rng.random() < 0.2 else '',
+            self._type(rng, names, self.depth),
+            f,
+            ' (note = "field %d")' % f if rng.random() < 0.1 else ''))
+      lines.append('}')
+      names.append('Struct%d' % s)
+    lines.append('\nconst map<string, i32> LIMITS = {%s}' % ', '.join(
+        '"limit%d": %d' % (i, i) for i in range(5)))
+    for v in range(self.services):
+      lines.append('\nservice Service%d {' % v)
+      for f in range(self.functions):
+        lines.append('  %s method%d(1: %s request, 2: i64 timeout) throws (1: Error failure)' % (
+            rng.choice(names) if names else 'void', f, rng.choice(names) if names else 'i32'))
+      lines.append('}')
+    lines.append('\nexception Error {\n  1: string message\n}\n')
+    return '\n'.join(lines)
+
+  def write(self, directory):
+    """Write every module into directory and return the path of the root module."""
+    for index in range(self.modules):
+      with open(os.path.join(directory, '%s.thrift' % self.module_name(index)), 'w') as fp:
+        fp.write(self.module(index))
+    return os.path.join(directory, '%s.thrift' % self.module_name(0))
+
+
+def ply_tokens(data):
+  lexer = Lexer.shared()
+  lexer.lineno = 1
+  lexer.input(data)
+  count = 0
+  while lexer.token() is not None:
+    count += 1
+  return count
+
+
+def scanner_tokens(data):
+  return len(Scanner(data).tokenize())
+
+
+LEXERS = (
+  ('ply', ply_tokens),
+  ('scanner', scanner_tokens),
+)
+
+
+def best_of(repeat, function, *args):
+  """Return (result, seconds) of the fastest of repeat calls of function(*args)."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return result, best
+
+
+def traced(function, *args):
+  """Return (result, peak bytes, retained bytes) of function(*args) under tracemalloc.
+
+  Retained is what is still allocated after the call, result included.
+  """
+  gc.collect()
+  tracemalloc.start()
+  try:
+    result = function(*args)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return result, peak, retained
+
+
+def bench_lexers(sources, repeat=5):
+  """Return [(name, tokens, tokens per second)] for each of LEXERS over sources, a list of strings."""
+  def run(lexer):
+    return sum(lexer(data) for data in sources)
+  results = []
+  for name, lexer in LEXERS:
+    tokens, seconds = best_of(repeat, run, lexer)
+    results.append((name, tokens, tokens / seconds))
+  return results
+
+
+def sample(resolver, spec, rng, depth=0):
+  """Return a random value of the codec type spec; containers get smaller as they nest."""
+  kind = spec if isinstance(spec, str) else spec[0]
+  if kind == 'enum':
+    return rng.choice(spec[3].values).tag if spec[3].values else 0
+  elif kind == 'struct':
+    _, module, _, node = spec
+    return dict(
+        (field.name.value, sample(resolver, resolver.spec(field.type, module), rng, depth + 1))
+        for field in node.fields if field.required or depth < 3)
+  elif kind == 'bool':
+    return rng.random() < 0.5
+  elif kind == 'byte':
+    return rng.randint(-100, 100)
+  elif kind in ('i16', 'i32', 'i64'):
+    return rng.randint(-100, 10000)
+  elif kind == 'double':
+    return rng.random()
+  elif kind == 'string':
+    return 'value%d' % rng.randint(0, 1000)
+  elif kind == 'binary':
+    return b'\x00\x01' * rng.randint(0, 8)
+  size = max(0, 4 - depth)
+  if kind == 'map':
+    return dict((sample(resolver, spec[1], rng, depth + 1), sample(resolver, spec[2], rng, depth + 1))
+                for _ in range(size)) if isinstance(spec[1], str) else [
+        (sample(resolver, spec[1], rng, depth + 1), sample(resolver, spec[2], rng, depth + 1))
+        for _ in range(size)]
+  items = [sample(resolver, spec[1], rng, depth + 1) for _ in range(size)]
+  return set(items) if kind == 'set' and isinstance(spec[1], str) else items
+
+
+def bench_codecs(loader, repeat=3, limit=100):
+  """Time encoding and decoding a message of each of up to limit structs of loader.
+
+  Returns a dict of stage name to measurements for the compiled codecs and the interpreter, in
+  both protocols.
+  """
+  resolver = Resolver(loader)
+  rng = random.Random(0)
+  messages = []
+  for module, table in loader.modules.items():
+    for name, node in table.items():
+      if isinstance(node, (ast.Struct, ast.Exception_)) and len(messages) < limit:
+        messages.append((module, name, sample(resolver, resolver.struct(name, module), rng)))
+  results = {}
+  for protocol in ('binary', 'compact'):
+    for implementation, codec in (('compiled', Codec(loader, protocol)),
+                                  ('interpreted', Interpreter(loader, protocol))):
+      if implementation == 'compiled':
+        functions = [(codec.encoder(name, module), codec.decoder(name, module), value)
+                     for module, name, value in messages]
+      else:
+        functions = [(lambda value, name=name, module=module: codec.encode(name, value, module),
+                      lambda data, name=name, module=module: codec.decode(name, data, module),
+                      value) for module, name, value in messages]
+      encoded, encode_seconds = best_of(
+          repeat, lambda: [encode(value) for encode, _, value in functions])
+      _, decode_seconds = best_of(
+          repeat, lambda: [decode(data) for (_, decode, _), data in zip(functions, encoded)])
+      size = sum(len(data) for data in encoded)
+      results['codec.%s.%s' % (protocol, implementation)] = {
+          'messages': len(messages), 'bytes': size,
+          'encode_bytes_per_second': size / encode_seconds,
+          'decode_bytes_per_second': size / decode_seconds}
+  return results
+
+
+def bench_validators(loader, repeat=3, limit=100):
+  """Time validating a payload of each of up to limit structs of loader.
+
+  Returns a dict of stage name to measurements for the compiled validators and the interpreter.
+  """
+  resolver = Resolver(loader, enums=True)
+  rng = random.Random(0)
+  payloads = []
+  for module, table in loader.modules.items():
+    for name, node in table.items():
+      if isinstance(node, (ast.Struct, ast.Exception_)) and len(payloads) < limit:
+        payloads.append((module, name, sample(resolver, resolver.struct(name, module), rng)))
+  results = {}
+  for implementation, validator in (('compiled', validator_module.Validator(loader)),
+                                    ('interpreted', validator_module.Interpreter(loader))):
+    _, seconds = best_of(repeat, lambda: [
+        validator.validate(name, value, module) for module, name, value in payloads])
+    results['validate.%s' % implementation] = {
+        'payloads': len(payloads), 'seconds': seconds,
+        'payloads_per_second': len(payloads) / seconds}
+  return results
+
+
+# Run in a fresh interpreter: how long importing ptsd.loader, then building each parser, takes.
+STARTUP = """
+import sys, time
+start = time.perf_counter()
+import ptsd.loader
+imported = time.perf_counter()
+print(imported - start)
+for backend in sys.argv[1:]:
+  start = time.perf_counter()
+  ptsd.loader.parser_class(backend)()
+  print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(backends=('ply', 'descent'), repeat=3):
+  """Time a cold start: importing ptsd.loader, and building each backend's parser, in a fresh
+  interpreter each run.
+
+  Returns a dict of stage name to measurements, the best of repeat runs.
+  """
+  package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [package, env.get('PYTHONPATH')]))
+  best = None
+  for _ in range(repeat):
+    output = subprocess.check_output(
+        [sys.executable, '-c', STARTUP] + list(backends), env=env, universal_newlines=True)
+    seconds = [float(line) for line in output.split()]
+    best = seconds if best is None else [min(pair) for pair in zip(best, seconds)]
+  results = {'startup.import': {'seconds': best[0]}}
+  for backend, seconds in zip(backends, best[1:]):
+    results['startup.%s' % backend] = {'seconds': seconds}
+  return results
+
+
+def bench_tables(repeat=3):
+  """Time building a PLY Parser from scratch, from tables pickled on disk, and from the tables
+  already loaded by the process.
+
+  Returns a dict of stage name to measurements.
+  """
+  from .parser import Parser
+
+  saved_tables, saved_dir = Parser._TABLES, os.environ.get('PTSD_CACHE_DIR')
+  directory = tempfile.mkdtemp(prefix='ptsd-benchmark-tables-')
+  try:
+    def cold():
+      # A cache directory without tables, so they are generated (and written) again.
+      os.environ['PTSD_CACHE_DIR'] = tempfile.mkdtemp(dir=directory)
+      Parser._TABLES = None
+      return Parser()
+    def pickled():
+      Parser._TABLES = None
+      return Parser()
+    _, cold_seconds = best_of(repeat, cold)
+    _, pickled_seconds = best_of(repeat, pickled)
+    _, warm_seconds = best_of(repeat, Parser)
+  finally:
+    Parser._TABLES = saved_tables
+    if saved_dir is None:
+      os.environ.pop('PTSD_CACHE_DIR', None)
+    else:
+      os.environ['PTSD_CACHE_DIR'] = saved_dir
+    shutil.rmtree(directory, ignore_errors=True)
+  return {
+    'tables.cold': {'seconds': cold_seconds},
+    'tables.pickled': {'seconds': pickled_seconds},
+    'tables.warm': {'seconds': warm_seconds},
+  }
+
+
+def run(root, sources, backends=('ply', 'descent'), repeat=3):
+  """Run every stage over sources (a list of strings) and the include graph at root.
+
+  Returns a dict of stage name to measurements, times in seconds and memory in bytes.
+  """
+  size = sum(len(data) for data in sources)
+  results = bench_startup(backends, repeat)
+  if 'ply' in backends:
+    results.update(bench_tables(repeat))
+  for name, tokens, rate in bench_lexers(sources, repeat):
+    results['lex.%s' % name] = {'tokens': tokens, 'tokens_per_second': rate}
+  for backend in backends:
+    parser = parser_class(backend)()
+    trees, seconds = best_of(repeat, lambda: [parser.parse(data) for data in sources])
+    _, peak, retained = traced(lambda: [parser.parse(data) for data in sources])
+    results['parse.%s' % backend] = {
+        'seconds': seconds, 'bytes_per_second': size / seconds, 'peak_bytes': peak,
+        'retained_bytes': retained}
+    def load():
+      return Loader(root, logger=lambda message: None, backend=backend)
+    loader, seconds = best_of(repeat, load)
+    _, peak, retained = traced(load)
+    results['load.%s' % backend] = {
+        'seconds': seconds, 'modules': len(loader.modules), 'peak_bytes': peak,
+        'retained_bytes': retained}
+  text, seconds = best_of(repeat, lambda: [str(tree) for tree in trees])
+  results['render'] = {'seconds': seconds, 'characters': sum(len(t) for t in text)}
+  results.update(bench_codecs(loader, repeat))
+  results.update(bench_validators(loader, repeat))
+  return results
+
+
+def environment():
+  return {
+    'ptsd': __version__,
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+  }
+
+
+def report(results, fp=sys.stdout):
+  for stage, measurements in sorted(results.items()):
+    fp.write('%-16s %s\n' % (stage, '  '.join(
+        '%s=%s' % (key, ('%.4g' % value) if isinstance(value, float) else value)
+        for key, value in sorted(measurements.items()))))
+
+
+def compare(results, baseline, fp=sys.stdout):
+  """Print how each stage's time changed against baseline, the results of an earlier --json run."""
+  for stage, measurements in sorted(results.items()):
+    before = baseline.get(stage, {})
+    for key in ('seconds', 'tokens_per_second', 'encode_bytes_per_second',
+                'decode_bytes_per_second'):
+      if key in measurements and before.get(key):
+        ratio = measurements[key] / before[key]
+        fp.write('%-16s %-18s %10.4g -> %10.4g  (%+.1f%%)\n' % (
+            stage, key, before[key], measurements[key], 100 * (ratio - 1)))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+      prog='python -m ptsd.benchmark', description=__doc__.strip().split('\n\n')[-1])
+  parser.add_argument('files', nargs='*', help='Thrift files, the first being the root to load')
+  parser.add_argument('--modules', type=int, default=10)
+  parser.add_argument('--fanout', type=int, default=2, help='includes per module')
+  parser.add_argument('--structs', type=int, default=50, help='structs per module')
+  parser.add_argument('--fields', type=int, default=10, help='fields per struct')
+  parser.add_argument('--enums', type=int, default=5, help='enums per module')
+  parser.add_argument('--values', type=int, default=10, help='values per enum')
+  parser.add_argument('--services', type=int, default=2, help='services per module')
+  parser.add_argument('--functions', type=int, default=10, help='functions per service')
+  parser.add_argument('--depth', type=int, default=3, help='maximum container nesting')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--backend', action='append', dest='backends',
+                      help='parser backends to run (default: all)')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per timing, best is kept')
+  parser.add_argument('--json', action='store_true', help='print the results as JSON')
+  parser.add_argument('--compare', metavar='JSON',
+                      help='compare against the output of an earlier --json run')
+  parser.add_argument('--import-budget', type=float, metavar='MS',
+                      help='fail if importing ptsd.loader takes longer than MS milliseconds')
+  options = parser.parse_args(argv)
+
+  directory = None
+  try:
+    if options.files:
+      root, filenames, config = options.files[0], options.files, {'files': options.files}
+    else:
+      generator = Generator(
+          modules=options.modules, fanout=options.fanout, structs=options.structs,
+          fields=options.fields, enums=options.enums, values=options.values,
+          services=options.services, functions=options.functions, depth=options.depth,
+          seed=options.seed)
+      directory = tempfile.mkdtemp(prefix='ptsd-benchmark-')
+      root = generator.write(directory)
+      filenames = [os.path.join(directory, '%s.thrift' % generator.module_name(i))
+                   for i in range(generator.modules)]
+      config = dict(vars(generator))
+    sources = []
+    for filename in filenames:
+      with open(filename) as fp:
+        sources.append(fp.read())
+    config['bytes'] = sum(len(data) for data in sources)
+    results = run(root, sources, backends=options.backends or ('ply', 'descent'),
+                  repeat=options.repeat)
+  finally:
+    if directory is not None:
+      shutil.rmtree(directory, ignore_errors=True)
+
+  if options.json:
+    json.dump({'environment': environment(), 'config': config, 'results': results},
+              sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+  else:
+    report(results)
+  if options.compare:
+    with open(options.compare) as fp:
+      compare(results, json.load(fp)['results'])
+  if options.import_budget is not None:
+    took = 1000 * results['startup.import']['seconds']
+    if took > options.import_budget:
+      sys.stderr.write('importing ptsd.loader took %.1fms, over the budget of %.1fms\n' % (
+          took, options.import_budget))
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,146 @@
+import os
+
+
+def default_cache_dir():
+  """Directory for ptsd's persistent caches, overridable via $PTSD_CACHE_DIR."""
+  return os.environ.get('PTSD_CACHE_DIR') or os.path.join(
+      os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'ptsd')
+
+
+def read_pickle(path):
+  """Load a pickle written by write_pickle, or return None if it is missing or unreadable."""
+  import pickle
+  try:
+    with open(path, 'rb') as fp:
+      return pickle.load(fp)
+  except Exception:
+    return None
+
+
+def write_pickle(path, value):
+  """Atomically pickle value to path, returning its size in bytes (0 if it could not be written).
+
+  The pickle goes to a temporary file that is renamed into place, so concurrent readers and
+  writers never observe a partial file.
+  """
+  import pickle
+  import tempfile
+  dirname = os.path.dirname(path)
+  try:
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as fp:
+      pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+      size = fp.tell()
+    os.rename(tmp, path)
+    return size
+  except (IOError, OSError):
+    return 0
+
+
+class ASTCache(object):
+  """A content-addressed on-disk cache of parsed trees.
+
+  Entries are keyed by a hash of the source text, the ptsd version, the node format and the grammar
+  signature, so any change to the input or to the parser invalidates them.  The cache directory is capped at
+  max_bytes; when it grows past the cap the least recently used entries are evicted.
+  """
+
+  SUFFIX = '.ast'
+
+  # Bump whenever the pickled layout of ptsd.ast nodes changes.
+  FORMAT = 2
+
+  def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+    import pickle
+    from . import __version__
+    from .parser import Parser
+    self.directory = directory or os.path.join(default_cache_dir(), 'ast')
+    self.max_bytes = max_bytes
+    self.hits = self.misses = self.evictions = 0
+    self._salt = ('%s:%d:%s:%d:' % (
+        __version__, self.FORMAT, Parser.grammar_signature(), pickle.HIGHEST_PROTOCOL)).encode('utf-8')
+    self._size = None
+
+  def key(self, data, variant=''):
+    """The cache key of data, text or a buffer such as an mmap of UTF-8 source.
+
+    variant distinguishes trees parsed from the same source in different modes.
+    """
+    import hashlib
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    digest = hashlib.sha1(self._salt + variant.encode('utf-8') + b':')
+    digest.update(data)
+    return digest.hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.directory, key + self.SUFFIX)
+
+  def get(self, data, variant=''):
+    path = self.path(self.key(data, variant))
+    value = read_pickle(path)
+    if value is None:
+      if os.path.exists(path):
+        self._remove(path)  # corrupt or from an incompatible interpreter
+      self.misses += 1
+      return None
+    try:
+      os.utime(path, None)  # mtime doubles as the LRU timestamp
+    except OSError:
+      pass
+    self.hits += 1
+    return value
+
+  def put(self, data, value, variant=''):
+    size = write_pickle(self.path(self.key(data, variant)), value)
+    if size and self._size is not None:
+      self._size += size
+    if self.size() > self.max_bytes:
+      self.evict()
+
+  def _entries(self):
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return
+    for name in names:
+      if name.endswith(self.SUFFIX):
+        path = os.path.join(self.directory, name)
+        try:
+          yield path, os.stat(path)
+        except OSError:
+          continue
+
+  def _remove(self, path):
+    try:
+      size = os.path.getsize(path)
+      os.unlink(path)
+    except OSError:
+      return
+    if self._size is not None:
+      self._size -= size
+
+  def size(self):
+    """Total size in bytes of the cached entries."""
+    if self._size is None:
+      self._size = sum(st.st_size for _, st in self._entries())
+    return self._size
+
+  def evict(self, max_bytes=None):
+    """Evict least recently used entries until the cache fits in max_bytes."""
+    max_bytes = self.max_bytes if max_bytes is None else max_bytes
+    entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+    self._size = sum(st.st_size for _, st in entries)
+    for path, _ in entries:
+      if self._size <= max_bytes:
+        break
+      self._remove(path)
+      self.evictions += 1
+
+  def clear(self):
+    self.evict(max_bytes=0)
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,959 @@
+"""Thrift binary and compact protocol codecs for the structs of a Loader."""
+
+from array import array
+import struct
+import sys
+
+from . import ast
+
+
+class Error(Exception): pass
+class EncodeError(Error): pass
+class DecodeError(Error): pass
+
+
+# Wire types of the binary protocol.
+BINARY_TYPES = {
+  'bool': 2, 'byte': 3, 'double': 4, 'i16': 6, 'i32': 8, 'i64': 10, 'string': 11, 'binary': 11,
+  'struct': 12, 'map': 13, 'set': 14, 'list': 15,
+}
+
+# Wire types of the compact protocol.  Bool fields carry their value in the type: 1 true, 2 false.
+COMPACT_TYPES = {
+  'bool': 1, 'byte': 3, 'i16': 4, 'i32': 5, 'i64': 6, 'double': 7, 'string': 8, 'binary': 8,
+  'list': 9, 'set': 10, 'map': 11, 'struct': 12,
+}
+
+BASE_KINDS = {
+  ast.Bool: 'bool', ast.Byte: 'byte', ast.I16: 'i16', ast.I32: 'i32', ast.I64: 'i64',
+  ast.Double: 'double', ast.String: 'string', ast.Slist: 'string', ast.Binary: 'binary',
+}
+
+_FIXED = {'byte': 'b', 'i16': 'h', 'i32': 'i', 'i64': 'q', 'double': 'd'}
+_INTEGERS = ('byte', 'i16', 'i32', 'i64')
+
+# The values each integer kind holds.  The binary protocol's struct formats enforce them; the
+# compact protocol, writing varints, checks them itself.
+_RANGES = dict((kind, (-1 << bits - 1, (1 << bits - 1) - 1))
+               for kind, bits in zip(_INTEGERS, (8, 16, 32, 64)))
+
+
+def _out_of_range(kind, value):
+  low, high = _RANGES[kind]
+  return EncodeError('%s value %d out of range [%d, %d]' % (kind, value, low, high))
+
+
+class Resolver(object):
+  """Resolves type nodes of a Loader's modules to type specs."""
+
+  def __init__(self, loader, enums=False):
+    self.modules = loader.modules
+    self.enums = enums
+
+  def _entry(self, name, module):
+    while True:
+      table = self.modules.get(module)
+      if table is None:
+        raise Error('Unknown module %s' % module)
+      entry = table.get(name)
+      if entry is not None:
+        return entry, name, module
+      if '.' not in name:
+        raise Error('Could not resolve %s from %s' % (name, module))
+      module, name = name.split('.', 1)
+
+  def spec(self, node, module):
+    """Return the spec of the type node as written in module."""
+    seen = set()
+    while isinstance(node, ast.Identifier):
+      node, name, module = self._entry(node.value, module)
+      if (module, name) in seen:
+        raise Error('Cyclic typedef %s in %s' % (name, module))
+      seen.add((module, name))
+      if isinstance(node, (ast.Struct, ast.Exception_)):
+        return ('struct', module, name, node)
+      elif isinstance(node, ast.Enum):
+        return ('enum', module, name, node) if self.enums else 'i32'
+      elif not isinstance(node, ast.Node):
+        raise Error('%s in %s is not a type' % (name, module))
+    kind = BASE_KINDS.get(type(node))
+    if kind is not None:
+      return kind
+    elif isinstance(node, ast.List):
+      return ('list', self.spec(node.value_type, module))
+    elif isinstance(node, ast.Set):
+      return ('set', self.spec(node.value_type, module))
+    elif isinstance(node, ast.Map):
+      return ('map', self.spec(node.key_type, module), self.spec(node.value_type, module))
+    raise Error('Unsupported type %s in %s' % (type(node).__name__, module))
+
+  def struct(self, name, module=None):
+    """Return the ('struct', ...) spec of the struct or exception name, from module or any module."""
+    for candidate in ([module] if module else list(self.modules)):
+      try:
+        entry, name_, module_ = self._entry(name, candidate)
+      except Error:
+        if module:
+          raise
+        continue
+      if isinstance(entry, (ast.Struct, ast.Exception_)):
+        return ('struct', module_, name_, entry)
+      if module:
+        raise Error('%s in %s is not a struct' % (name, module))
+    raise Error('Could not resolve struct %s' % name)
+
+
+def _kind(spec):
+  return spec if isinstance(spec, str) else spec[0]
+
+
+def _hashable(spec):
+  return isinstance(spec, str)
+
+
+def _zigzag(n):
+  return (n << 1) ^ (n >> 63)
+
+
+def _varint_bytes(n):
+  out = bytearray()
+  while n > 0x7F:
+    out.append(n & 0x7F | 0x80)
+    n >>= 7
+  out.append(n)
+  return bytes(out)
+
+
+def write_varint(out, n):
+  while n > 0x7F:
+    out.append(n & 0x7F | 0x80)
+    n >>= 7
+  out.append(n)
+
+
+def read_varint(data, pos):
+  byte = data[pos]
+  pos += 1
+  if byte < 0x80:
+    return byte, pos
+  n, shift = byte & 0x7F, 7
+  while True:
+    byte = data[pos]
+    pos += 1
+    n |= (byte & 0x7F) << shift
+    if byte < 0x80:
+      return n, pos
+    shift += 7
+
+
+def _items(value):
+  return value.items() if isinstance(value, dict) else value
+
+
+# The array.array typecodes of the fixed width kinds, picked for their sizes on this platform.
+ARRAY_TYPECODES = {
+  'byte': 'b', 'i16': 'h', 'i32': 'i' if array('i').itemsize == 4 else 'l', 'i64': 'q', 'double': 'd',
+}
+NUMPY_DTYPES = {'byte': 'i1', 'i16': 'i2', 'i32': 'i4', 'i64': 'i8', 'double': 'f8'}
+SWAP = sys.byteorder == 'little'
+
+_BE = dict((kind, struct.Struct('>' + code)) for kind, code in _FIXED.items())
+_LE_DOUBLE = struct.Struct('<d')
+_BE_LENGTH = struct.Struct('>i')
+_BE_LIST = struct.Struct('>bi')
+_BE_MAP = struct.Struct('>bbi')
+_BE_FIELD = struct.Struct('>bh')
+
+
+class _Protocol(object):
+  """The wire format of a protocol, value by value, as used by Interpreter and for skipping."""
+
+  def __init__(self, resolver=None):
+    self.resolver = resolver
+
+
+class BinaryProtocol(_Protocol):
+  name = 'binary'
+  TYPES = BINARY_TYPES
+
+  def write_struct(self, spec, value, out):
+    _, module, name, node = spec
+    for field in node.fields:
+      item = value.get(field.name.value)
+      if item is None:
+        if field.required:
+          raise EncodeError('Missing required field %s.%s' % (name, field.name.value))
+        continue
+      field_spec = self.resolver.spec(field.type, module)
+      out += _BE_FIELD.pack(self.TYPES[_kind(field_spec)], field.tag)
+      self.write(field_spec, item, out)
+    out.append(0)
+
+  def write(self, spec, value, out):
+    kind = _kind(spec)
+    if kind == 'struct':
+      self.write_struct(spec, value, out)
+    elif kind == 'bool':
+      out.append(1 if value else 0)
+    elif kind in _FIXED:
+      out += _BE[kind].pack(value)
+    elif kind in ('string', 'binary'):
+      data = value.encode('utf-8') if kind == 'string' else value
+      out += _BE_LENGTH.pack(len(data))
+      out += data
+    elif kind == 'map':
+      out += _BE_MAP.pack(self.TYPES[_kind(spec[1])], self.TYPES[_kind(spec[2])], len(value))
+      for key, item in _items(value):
+        self.write(spec[1], key, out)
+        self.write(spec[2], item, out)
+    else:
+      out += _BE_LIST.pack(self.TYPES[_kind(spec[1])], len(value))
+      for item in value:
+        self.write(spec[1], item, out)
+
+  def read_struct(self, spec, data, pos):
+    _, module, name, node = spec
+    value = {}
+    while True:
+      ttype = data[pos]
+      if ttype == 0:
+        pos += 1
+        break
+      _, tag = _BE_FIELD.unpack_from(data, pos)
+      pos += 3
+      for field in node.fields:
+        if field.tag == tag:
+          field_spec = self.resolver.spec(field.type, module)
+          if self.TYPES[_kind(field_spec)] == ttype:
+            value[field.name.value], pos = self.read(field_spec, data, pos)
+            break
+      else:
+        pos = self.skip(data, pos, ttype)
+    for field in node.fields:
+      if field.required and field.name.value not in value:
+        raise DecodeError('Missing required field %s.%s' % (name, field.name.value))
+    return value, pos
+
+  def read(self, spec, data, pos):
+    kind = _kind(spec)
+    if kind == 'struct':
+      return self.read_struct(spec, data, pos)
+    elif kind == 'bool':
+      return data[pos] != 0, pos + 1
+    elif kind in _FIXED:
+      return _BE[kind].unpack_from(data, pos)[0], pos + _BE[kind].size
+    elif kind in ('string', 'binary'):
+      length, = _BE_LENGTH.unpack_from(data, pos)
+      pos += 4
+      value = bytes(data[pos:pos + length])
+      return value.decode('utf-8') if kind == 'string' else value, pos + length
+    elif kind == 'map':
+      _, _, size = _BE_MAP.unpack_from(data, pos)
+      pos += 6
+      items = []
+      for _ in range(size):
+        key, pos = self.read(spec[1], data, pos)
+        item, pos = self.read(spec[2], data, pos)
+        items.append((key, item))
+      return dict(items) if _hashable(spec[1]) else items, pos
+    _, size = _BE_LIST.unpack_from(data, pos)
+    pos += 5
+    items = []
+    for _ in range(size):
+      item, pos = self.read(spec[1], data, pos)
+      items.append(item)
+    return set(items) if kind == 'set' and _hashable(spec[1]) else items, pos
+
+  @classmethod
+  def skip(cls, data, pos, ttype):
+    """Return the position after a value of wire type ttype at pos."""
+    if ttype == 2 or ttype == 3:
+      return pos + 1
+    elif ttype == 4 or ttype == 10:
+      return pos + 8
+    elif ttype == 6:
+      return pos + 2
+    elif ttype == 8:
+      return pos + 4
+    elif ttype == 11:
+      return pos + 4 + _BE_LENGTH.unpack_from(data, pos)[0]
+    elif ttype == 12:
+      while True:
+        field_type = data[pos]
+        if field_type == 0:
+          return pos + 1
+        pos = cls.skip(data, pos + 3, field_type)
+    elif ttype == 13:
+      key_type, value_type, size = _BE_MAP.unpack_from(data, pos)
+      pos += 6
+      for _ in range(size):
+        pos = cls.skip(data, cls.skip(data, pos, key_type), value_type)
+      return pos
+    elif ttype == 14 or ttype == 15:
+      element_type, size = _BE_LIST.unpack_from(data, pos)
+      pos += 5
+      for _ in range(size):
+        pos = cls.skip(data, pos, element_type)
+      return pos
+    raise DecodeError('Unknown wire type %d' % ttype)
+
+
+class CompactProtocol(_Protocol):
+  name = 'compact'
+  TYPES = COMPACT_TYPES
+
+  def _field_header(self, out, ctype, tag, last):
+    delta = tag - last
+    if 0 < delta < 16:
+      out.append(delta << 4 | ctype)
+    else:
+      out.append(ctype)
+      write_varint(out, _zigzag(tag))
+
+  def write_struct(self, spec, value, out):
+    _, module, name, node = spec
+    last = 0
+    for field in node.fields:
+      item = value.get(field.name.value)
+      if item is None:
+        if field.required:
+          raise EncodeError('Missing required field %s.%s' % (name, field.name.value))
+        continue
+      field_spec = self.resolver.spec(field.type, module)
+      if field_spec == 'bool':
+        self._field_header(out, 1 if item else 2, field.tag, last)
+      else:
+        self._field_header(out, self.TYPES[_kind(field_spec)], field.tag, last)
+        self.write(field_spec, item, out)
+      last = field.tag
+    out.append(0)
+
+  def write(self, spec, value, out):
+    kind = _kind(spec)
+    if kind == 'struct':
+      self.write_struct(spec, value, out)
+    elif kind == 'bool':
+      out.append(1 if value else 2)
+    elif kind in _INTEGERS:
+      low, high = _RANGES[kind]
+      if not low <= value <= high:
+        raise _out_of_range(kind, value)
+      if kind == 'byte':
+        out.append(value & 0xFF)
+      else:
+        write_varint(out, _zigzag(value))
+    elif kind == 'double':
+      out += _LE_DOUBLE.pack(value)
+    elif kind in ('string', 'binary'):
+      data = value.encode('utf-8') if kind == 'string' else value
+      write_varint(out, len(data))
+      out += data
+    elif kind == 'map':
+      if not value:
+        out.append(0)
+        return
+      write_varint(out, len(value))
+      out.append(self.TYPES[_kind(spec[1])] << 4 | self.TYPES[_kind(spec[2])])
+      for key, item in _items(value):
+        self.write(spec[1], key, out)
+        self.write(spec[2], item, out)
+    else:
+      size, ctype = len(value), self.TYPES[_kind(spec[1])]
+      if size < 15:
+        out.append(size << 4 | ctype)
+      else:
+        out.append(0xF0 | ctype)
+        write_varint(out, size)
+      for item in value:
+        self.write(spec[1], item, out)
+
+  def read_struct(self, spec, data, pos):
+    _, module, name, node = spec
+    value, last = {}, 0
+    while True:
+      byte = data[pos]
+      pos += 1
+      if byte == 0:
+        break
+      ctype, delta = byte & 0x0F, byte >> 4
+      if delta:
+        tag = last + delta
+      else:
+        n, pos = read_varint(data, pos)
+        tag = (n >> 1) ^ -(n & 1)
+      last = tag
+      for field in node.fields:
+        if field.tag == tag:
+          field_spec = self.resolver.spec(field.type, module)
+          if field_spec == 'bool' and ctype in (1, 2):
+            value[field.name.value] = ctype == 1
+            break
+          elif self.TYPES[_kind(field_spec)] == ctype:
+            value[field.name.value], pos = self.read(field_spec, data, pos)
+            break
+      else:
+        pos = self.skip(data, pos, ctype, field=True)
+    for field in node.fields:
+      if field.required and field.name.value not in value:
+        raise DecodeError('Missing required field %s.%s' % (name, field.name.value))
+    return value, pos
+
+  def read(self, spec, data, pos):
+    kind = _kind(spec)
+    if kind == 'struct':
+      return self.read_struct(spec, data, pos)
+    elif kind == 'bool':
+      return data[pos] == 1, pos + 1
+    elif kind == 'byte':
+      byte = data[pos]
+      return byte - 256 if byte > 127 else byte, pos + 1
+    elif kind in _INTEGERS:
+      n, pos = read_varint(data, pos)
+      return (n >> 1) ^ -(n & 1), pos
+    elif kind == 'double':
+      return _LE_DOUBLE.unpack_from(data, pos)[0], pos + 8
+    elif kind in ('string', 'binary'):
+      length, pos = read_varint(data, pos)
+      value = bytes(data[pos:pos + length])
+      return value.decode('utf-8') if kind == 'string' else value, pos + length
+    elif kind == 'map':
+      size, pos = read_varint(data, pos)
+      if size:
+        pos += 1
+      items = []
+      for _ in range(size):
+        key, pos = self.read(spec[1], data, pos)
+        item, pos = self.read(spec[2], data, pos)
+        items.append((key, item))
+      return dict(items) if _hashable(spec[1]) else items, pos
+    byte = data[pos]
+    pos += 1
+    size = byte >> 4
+    if size == 15:
+      size, pos = read_varint(data, pos)
+    items = []
+    for _ in range(size):
+      item, pos = self.read(spec[1], data, pos)
+      items.append(item)
+    return set(items) if kind == 'set' and _hashable(spec[1]) else items, pos
+
+  @classmethod
+  def skip(cls, data, pos, ctype, field=False):
+    """Return the position after a value of wire type ctype at pos; bool fields have none."""
+    if ctype == 1 or ctype == 2:
+      return pos if field else pos + 1
+    elif ctype == 3:
+      return pos + 1
+    elif ctype in (4, 5, 6):
+      return read_varint(data, pos)[1]
+    elif ctype == 7:
+      return pos + 8
+    elif ctype == 8:
+      length, pos = read_varint(data, pos)
+      return pos + length
+    elif ctype == 12:
+      while True:
+        byte = data[pos]
+        pos += 1
+        if byte == 0:
+          return pos
+        if not byte >> 4:
+          pos = read_varint(data, pos)[1]
+        pos = cls.skip(data, pos, byte & 0x0F, field=True)
+    elif ctype == 11:
+      size, pos = read_varint(data, pos)
+      if not size:
+        return pos
+      types = data[pos]
+      pos += 1
+      for _ in range(size):
+        pos = cls.skip(data, cls.skip(data, pos, types >> 4), types & 0x0F)
+      return pos
+    elif ctype == 9 or ctype == 10:
+      byte = data[pos]
+      pos += 1
+      size = byte >> 4
+      if size == 15:
+        size, pos = read_varint(data, pos)
+      for _ in range(size):
+        pos = cls.skip(data, pos, byte & 0x0F)
+      return pos
+    raise DecodeError('Unknown wire type %d' % ctype)
+
+
+PROTOCOLS = {'binary': BinaryProtocol, 'compact': CompactProtocol}
+
+
+def _protocol_class(protocol):
+  try:
+    return PROTOCOLS[protocol]
+  except KeyError:
+    raise ValueError('Unknown protocol: %s' % protocol)
+
+
+class Interpreter(object):
+  """Encodes and decodes structs by walking their definitions for every message."""
+
+  def __init__(self, loader, protocol='binary', arrays=None):
+    if arrays not in (None, 'array', 'numpy'):
+      raise ValueError("arrays must be None, 'array' or 'numpy', not %r" % (arrays,))
+    self.arrays = arrays
+    self.resolver = Resolver(loader)
+    self.protocol = _protocol_class(protocol)(self.resolver)
+
+  def encode(self, name, value, module=None):
+    out = bytearray()
+    try:
+      self.protocol.write_struct(self.resolver.struct(name, module), value, out)
+    except struct.error as e:
+      raise EncodeError(str(e))
+    return bytes(out)
+
+  def decode(self, name, data, module=None):
+    return self.protocol.read_struct(self.resolver.struct(name, module), data, 0)[0]
+
+
+class _Compiler(object):
+  """Generates the source of the encode and decode functions of structs for one protocol."""
+
+  def __init__(self, codec):
+    self.codec = codec
+    self.TYPES = codec.protocol.TYPES
+    self._names = 0
+
+  def name(self, prefix):
+    self._names += 1
+    return '%s%d' % (prefix, self._names)
+
+  def constant(self, value):
+    """Return the name under which value is available to the generated code."""
+    name = self.name('_c')
+    self.codec.namespace[name] = value
+    return name
+
+  def encode_struct(self, spec):
+    """Return the source of encode_<n>(value, out) for the struct spec."""
+    _, module, name, node = spec
+    lines = ['def %s(value, out):' % self.codec.function(spec, 'encode')]
+    if self.codec.protocol.name == 'compact':
+      lines.append('  last = 0')
+    for field in node.fields:
+      field_name, field_spec = field.name.value, self.codec.resolver.spec(field.type, module)
+      lines.append('  v = value.get(%r)' % field_name)
+      lines.append('  if v is not None:')
+      self.field_header(field, field_spec, lines, '    ')
+      if not (field_spec == 'bool' and self.codec.protocol.name == 'compact'):
+        self.encode(field_spec, 'v', lines, '    ')
+      if field.required:
+        lines.append('  else:')
+        lines.append('    raise EncodeError(%r)' % (
+            'Missing required field %s.%s' % (name, field_name)))
+    lines.append('  out.append(0)')
+    return lines
+
+  def fields(self, spec, lines, indent, store, stored):
+    """Append the loop reading the fields of a struct at pos, up to its stop byte."""
+    _, module, name, node = spec
+    compact = self.codec.protocol.name == 'compact'
+    if compact:
+      header = [
+        'last = 0',
+        'while True:',
+        '  byte = data[pos]',
+        '  pos += 1',
+        '  if byte == 0:',
+        '    break',
+        '  if byte >> 4:',
+        '    last += byte >> 4',
+        '  else:',
+        '    n, pos = read_varint(data, pos)',
+        '    last = (n >> 1) ^ -(n & 1)',
+        '  key = last << 8 | byte & 0x0F',
+      ]
+    else:
+      header = [
+        'while True:',
+        '  ttype = data[pos]',
+        '  if ttype == 0:',
+        '    pos += 1',
+        '    break',
+        '  tag, = unpack_tag(data, pos + 1)',
+        '  pos += 3',
+        '  key = tag << 8 | ttype',
+      ]
+    lines.extend(indent + line for line in header)
+    test = 'if'
+    for field in node.fields:
+      field_spec = self.codec.resolver.spec(field.type, module)
+      if compact and field_spec == 'bool':
+        # The value is the wire type: 1 true, 2 false.
+        for ctype, value in ((1, True), (2, False)):
+          lines.append('%s  %s key == %d:' % (indent, test, field.tag << 8 | ctype))
+          lines.append('%s    %s' % (indent, store(field, repr(value))))
+          test = 'elif'
+        continue
+      lines.append('%s  %s key == %d:' % (
+          indent, test, field.tag << 8 | self.TYPES[_kind(field_spec)]))
+      self.decode(field_spec, 'x', lines, indent + '    ')
+      lines.append('%s    %s' % (indent, store(field, 'x')))
+      test = 'elif'
+    skip = 'pos = skip(data, pos, %s)' % ('byte & 0x0F, True' if compact else 'ttype')
+    if test == 'if':
+      lines.append('%s  %s' % (indent, skip))
+    else:
+      lines.append('%s  else:' % indent)
+      lines.append('%s    %s' % (indent, skip))
+    for field in node.fields:
+      if field.required:
+        lines.append('%sif not %s:' % (indent, stored(field)))
+        lines.append('%s  raise DecodeError(%r)' % (
+            indent, 'Missing required field %s.%s' % (name, field.name.value)))
+
+  def decode_struct(self, spec):
+    """Return the source of decode_<n>(data, pos) -> (value, pos) for the struct spec."""
+    lines = ['def %s(data, pos):' % self.codec.function(spec, 'decode'), '  value = {}']
+    self.fields(spec, lines, '  ',
+                lambda field, code: 'value[%r] = %s' % (field.name.value, code),
+                lambda field: '%r in value' % field.name.value)
+    lines.append('  return value, pos')
+    return lines
+
+  def batch_struct(self, spec):
+    """Return the source of batch_<n>(messages) -> Batch for the struct spec."""
+    _, module, name, node = spec
+    columns, lines = [], ['def %s(messages):' % self.codec.function(spec, 'batch')]
+    for index, field in enumerate(node.fields):
+      field_spec = self.codec.resolver.spec(field.type, module)
+      typecode = ARRAY_TYPECODES.get('byte' if field_spec == 'bool' else field_spec)
+      columns.append((field, typecode))
+      lines.append('  c%d = %s' % (index, 'array(%r)' % typecode if typecode else '[]'))
+      lines.append('  m%d = bytearray()' % index)
+    lines.append('  index = -1')
+    lines.append('  for index, data in enumerate(messages):')
+    for index, (field, typecode) in enumerate(columns):
+      lines.append('    c%d.append(%s)' % (index, '0' if typecode else 'None'))
+      lines.append('    m%d.append(0)' % index)
+    lines.append('    pos = 0')
+    slots = dict((id(field), index) for index, (field, _) in enumerate(columns))
+    self.fields(spec, lines, '    ',
+                lambda field, code: 'c%d[index] = %s; m%d[index] = 1' % (
+                    slots[id(field)], code, slots[id(field)]),
+                lambda field: 'm%d[index]' % slots[id(field)])
+    names = [field.name.value for field, _ in columns]
+    lines.append('  return Batch(index + 1, {%s}, {%s})' % (
+        ', '.join('%r: c%d' % (name, index) for index, name in enumerate(names)),
+        ', '.join('%r: m%d' % (name, index) for index, name in enumerate(names))))
+    return lines
+
+  def field_header(self, field, spec, lines, indent):
+    ctype = self.TYPES[_kind(spec)]
+    if self.codec.protocol.name == 'binary':
+      lines.append('%sout += %s' % (indent, self.constant(_BE_FIELD.pack(ctype, field.tag))))
+      return
+    # The short form holds the delta from the previous field written, known only at run time.
+    long_tag = self.constant(_varint_bytes(_zigzag(field.tag)))
+    if spec == 'bool':
+      lines.append('%sctype = 1 if v else 2' % indent)
+      ctype = 'ctype'
+    lines.extend([
+      '%sdelta = %d - last' % (indent, field.tag),
+      '%sif 0 < delta < 16:' % indent,
+      '%s  out.append(delta << 4 | %s)' % (indent, ctype),
+      '%selse:' % indent,
+      '%s  out.append(%s)' % (indent, ctype),
+      '%s  out += %s' % (indent, long_tag),
+      '%slast = %d' % (indent, field.tag),
+    ])
+
+  def encode(self, spec, var, lines, indent):
+    """Append the statements writing the value of var, of type spec, to out."""
+    kind, compact = _kind(spec), self.codec.protocol.name == 'compact'
+    if kind == 'struct':
+      lines.append('%s%s(%s, out)' % (indent, self.codec.function(spec, 'encode'), var))
+    elif kind == 'bool':
+      lines.append('%sout.append(%s if %s else %d)' % (indent, 1, var, 2 if compact else 0))
+    elif compact and kind in _INTEGERS:
+      lines.extend([
+        '%sif not %d <= %s <= %d:' % (indent, _RANGES[kind][0], var, _RANGES[kind][1]),
+        '%s  raise out_of_range(%r, %s)' % (indent, kind, var),
+      ])
+      if kind == 'byte':
+        lines.append('%sout.append(%s & 0xFF)' % (indent, var))
+      else:
+        lines.append('%swrite_varint(out, (%s << 1) ^ (%s >> 63))' % (indent, var, var))
+    elif kind in _FIXED:
+      packer = self.constant((_LE_DOUBLE if compact else _BE[kind]).pack)
+      lines.append('%sout += %s(%s)' % (indent, packer, var))
+    elif kind in ('string', 'binary'):
+      data = self.name('b')
+      if kind == 'string':
+        lines.append('%s%s = %s.encode("utf-8")' % (indent, data, var))
+      else:
+        data = var
+      if compact:
+        lines.append('%swrite_varint(out, len(%s))' % (indent, data))
+      else:
+        lines.append('%sout += pack_length(len(%s))' % (indent, data))
+      lines.append('%sout += %s' % (indent, data))
+    elif kind == 'map':
+      key, item = self.name('k'), self.name('e')
+      key_type, value_type = self.TYPES[_kind(spec[1])], self.TYPES[_kind(spec[2])]
+      if compact:
+        lines.extend([
+          '%sif %s:' % (indent, var),
+          '%s  write_varint(out, len(%s))' % (indent, var),
+          '%s  out.append(%d)' % (indent, key_type << 4 | value_type),
+          '%selse:' % indent,
+          '%s  out.append(0)' % indent,
+        ])
+      else:
+        lines.append('%sout += pack_map(%d, %d, len(%s))' % (indent, key_type, value_type, var))
+      lines.append('%sfor %s, %s in items(%s):' % (indent, key, item, var))
+      self.encode(spec[1], key, lines, indent + '  ')
+      self.encode(spec[2], item, lines, indent + '  ')
+    else:
+      item, element = self.name('e'), spec[1]
+      element_type = self.TYPES[_kind(element)]
+      if compact:
+        size = self.name('n')
+        lines.extend([
+          '%s%s = len(%s)' % (indent, size, var),
+          '%sif %s < 15:' % (indent, size),
+          '%s  out.append(%s << 4 | %d)' % (indent, size, element_type),
+          '%selse:' % indent,
+          '%s  out.append(%d)' % (indent, 0xF0 | element_type),
+          '%s  write_varint(out, %s)' % (indent, size),
+        ])
+      else:
+        lines.append('%sout += pack_list(%d, len(%s))' % (indent, element_type, var))
+      if not compact and element in _FIXED:
+        # Fixed width elements are packed in one call.
+        lines.append('%sout += pack(">%%d%s" %% len(%s), *%s)' % (
+            indent, _FIXED[element], var, var))
+      else:
+        lines.append('%sfor %s in %s:' % (indent, item, var))
+        self.encode(element, item, lines, indent + '  ')
+
+  def decode(self, spec, var, lines, indent):
+    """Append the statements reading a value of type spec at pos into var, advancing pos."""
+    kind, compact = _kind(spec), self.codec.protocol.name == 'compact'
+    if kind == 'struct':
+      lines.append('%s%s, pos = %s(data, pos)' % (indent, var, self.codec.function(spec, 'decode')))
+    elif kind == 'bool':
+      lines.append('%s%s = data[pos] %s' % (indent, var, '== 1' if compact else '!= 0'))
+      lines.append('%spos += 1' % indent)
+    elif compact and kind == 'byte':
+      lines.append('%s%s = data[pos]' % (indent, var))
+      lines.append('%sif %s > 127: %s -= 256' % (indent, var, var))
+      lines.append('%spos += 1' % indent)
+    elif compact and kind in _INTEGERS:
+      lines.append('%s%s, pos = read_varint(data, pos)' % (indent, var))
+      lines.append('%s%s = (%s >> 1) ^ -(%s & 1)' % (indent, var, var, var))
+    elif kind in _FIXED:
+      unpacker = _LE_DOUBLE if compact else _BE[kind]
+      lines.append('%s%s, = %s(data, pos)' % (indent, var, self.constant(unpacker.unpack_from)))
+      lines.append('%spos += %d' % (indent, unpacker.size))
+    elif kind in ('string', 'binary'):
+      size = self.name('n')
+      if compact:
+        lines.append('%s%s, pos = read_varint(data, pos)' % (indent, size))
+      else:
+        lines.append('%s%s, = unpack_length(data, pos)' % (indent, size))
+        lines.append('%spos += 4' % indent)
+      lines.append('%s%s = %s(data[pos:pos + %s]%s)' % (
+          indent, var, 'str' if kind == 'string' else 'bytes', size,
+          ', "utf-8"' if kind == 'string' else ''))
+      lines.append('%spos += %s' % (indent, size))
+    elif kind == 'map':
+      size, key, item = self.name('n'), self.name('k'), self.name('e')
+      if compact:
+        lines.append('%s%s, pos = read_varint(data, pos)' % (indent, size))
+        lines.append('%sif %s: pos += 1' % (indent, size))
+      else:
+        lines.append('%s%s = unpack_map(data, pos)[2]' % (indent, size))
+        lines.append('%spos += 6' % indent)
+      hashable = _hashable(spec[1])
+      lines.append('%s%s = %s' % (indent, var, '{}' if hashable else '[]'))
+      lines.append('%sfor _ in range(%s):' % (indent, size))
+      self.decode(spec[1], key, lines, indent + '  ')
+      self.decode(spec[2], item, lines, indent + '  ')
+      if hashable:
+        lines.append('%s  %s[%s] = %s' % (indent, var, key, item))
+      else:
+        lines.append('%s  %s.append((%s, %s))' % (indent, var, key, item))
+    else:
+      size, item, element = self.name('n'), self.name('e'), spec[1]
+      if compact:
+        lines.extend([
+          '%s%s = data[pos] >> 4' % (indent, size),
+          '%spos += 1' % indent,
+          '%sif %s == 15:' % (indent, size),
+          '%s  %s, pos = read_varint(data, pos)' % (indent, size),
+        ])
+      else:
+        lines.append('%s%s = unpack_list(data, pos)[1]' % (indent, size))
+        lines.append('%spos += 5' % indent)
+      arrays = self.codec.arrays and element in ARRAY_TYPECODES
+      if arrays and (not compact or element in ('byte', 'double')):
+        # The elements are copied straight into the array, swapping their bytes if need be: the
+        # binary protocol is big endian, compact doubles little endian and compact bytes raw.
+        width = _BE[element].size
+        lines.append('%sif pos + %d * %s > len(data):' % (indent, width, size))
+        lines.append("%s  raise DecodeError('Truncated input')" % indent)
+        lines.append('%s%s = array(%r, data[pos:pos + %d * %s])' % (
+            indent, var, ARRAY_TYPECODES[element], width, size))
+        if width > 1 and SWAP != compact:
+          lines.append('%s%s.byteswap()' % (indent, var))
+        lines.append('%spos += %d * %s' % (indent, width, size))
+      elif arrays:
+        # Varints are read into a list, which the array copies in one call.
+        lines.append('%s%s = []' % (indent, var))
+        lines.append('%sfor _ in range(%s):' % (indent, size))
+        self.decode(element, item, lines, indent + '  ')
+        lines.append('%s  %s.append(%s)' % (indent, var, item))
+        lines.append('%s%s = array(%r, %s)' % (indent, var, ARRAY_TYPECODES[element], var))
+      elif not compact and element in _FIXED:
+        # Fixed width elements are unpacked in one call.
+        lines.append('%s%s = list(unpack(">%%d%s" %% %s, data, pos))' % (
+            indent, var, _FIXED[element], size))
+        lines.append('%spos += %d * %s' % (indent, _BE[element].size, size))
+      else:
+        lines.append('%s%s = []' % (indent, var))
+        lines.append('%sfor _ in range(%s):' % (indent, size))
+        self.decode(element, item, lines, indent + '  ')
+        lines.append('%s  %s.append(%s)' % (indent, var, item))
+      if arrays and self.codec.arrays == 'numpy':
+        lines.append('%s%s = numpy.frombuffer(%s, %r)' % (
+            indent, var, var, NUMPY_DTYPES[element]))
+      elif kind == 'set' and _hashable(element) and not arrays:
+        lines.append('%s%s = set(%s)' % (indent, var, var))
+
+
+class Batch(object):
+  """Messages of one struct decoded column by column."""
+
+  def __init__(self, size, columns, present):
+    self.size = size
+    self.columns = columns
+    self.present = present
+
+  def __len__(self):
+    return self.size
+
+  def row(self, index):
+    """Return message index as decode() would have: a dict of the fields it had."""
+    return dict(
+        (name, column[index]) for name, column in self.columns.items()
+        if self.present[name][index])
+
+  def rows(self):
+    return [self.row(index) for index in range(self.size)]
+
+
+class Codec(object):
+  """Compiled encoders and decoders for the structs of a Loader, in one protocol."""
+
+  def __init__(self, loader, protocol='binary', arrays=None):
+    if arrays not in (None, 'array', 'numpy'):
+      raise ValueError("arrays must be None, 'array' or 'numpy', not %r" % (arrays,))
+    self.arrays = arrays
+    self.resolver = Resolver(loader)
+    self.protocol = _protocol_class(protocol)(self.resolver)
+    self.namespace = {
+      'EncodeError': EncodeError, 'DecodeError': DecodeError, 'out_of_range': _out_of_range,
+      'items': _items,
+      'write_varint': write_varint, 'read_varint': read_varint, 'skip': self.protocol.skip,
+      'pack': struct.pack, 'unpack': struct.unpack_from,
+      'pack_length': _BE_LENGTH.pack, 'unpack_length': _BE_LENGTH.unpack_from,
+      'pack_list': _BE_LIST.pack, 'unpack_list': _BE_LIST.unpack_from,
+      'pack_map': _BE_MAP.pack, 'unpack_map': _BE_MAP.unpack_from,
+      'unpack_tag': struct.Struct('>h').unpack_from,
+      'array': array, 'Batch': Batch,
+    }
+    if arrays == 'numpy':
+      try:
+        import numpy
+      except ImportError:
+        raise Error("arrays='numpy' needs NumPy, which is not installed")
+      self.namespace['numpy'] = numpy
+    self._functions = {}  # (module, name, 'encode', 'decode' or 'batch') -> function name
+    self._pending = []
+    self._compiler = _Compiler(self)
+
+  def function(self, spec, direction):
+    """Return the name of the compiled function of spec for direction, scheduling its source."""
+    key = (spec[1], spec[2], direction)
+    name = self._functions.get(key)
+    if name is None:
+      name = self._functions[key] = '%s_%s_%d' % (
+          direction, spec[2].replace('.', '_'), len(self._functions))
+      self._pending.append((spec, direction))
+    return name
+
+  def _compile(self, spec, direction):
+    name = self.function(spec, direction)
+    try:
+      while self._pending:
+        pending, pending_direction = self._pending.pop()
+        if pending_direction == 'encode':
+          lines = self._compiler.encode_struct(pending)
+        elif pending_direction == 'batch':
+          lines = self._compiler.batch_struct(pending)
+        else:
+          lines = self._compiler.decode_struct(pending)
+        exec(compile('\n'.join(lines), '<ptsd.codec %s>' % pending[2], 'exec'), self.namespace)
+    except Error:
+      # Forget the functions left uncompiled, so the error is raised again on the next attempt.
+      del self._pending[:]
+      for key, function in list(self._functions.items()):
+        if function not in self.namespace:
+          del self._functions[key]
+      raise
+    return self.namespace[name]
+
+  def encoder(self, name, module=None):
+    """Return the compiled function(value) -> bytes of the struct or exception name."""
+    function = self._compile(self.resolver.struct(name, module), 'encode')
+    def encode(value):
+      out = bytearray()
+      try:
+        function(value, out)
+      except struct.error as e:
+        raise EncodeError(str(e))
+      return bytes(out)
+    return encode
+
+  def decoder(self, name, module=None):
+    """Return the compiled function(data) -> value of the struct or exception name."""
+    function = self._compile(self.resolver.struct(name, module), 'decode')
+    def decode(data):
+      try:
+        return function(data, 0)[0]
+      except (IndexError, struct.error):
+        raise DecodeError('Truncated input')
+    return decode
+
+  def encode(self, name, value, module=None):
+    return self.encoder(name, module)(value)
+
+  def decode(self, name, data, module=None):
+    return self.decoder(name, module)(data)
+
+  def batch_decoder(self, name, module=None):
+    """Return the compiled function(messages) -> Batch of the struct or exception name."""
+    function = self._compile(self.resolver.struct(name, module), 'batch')
+    numpy = self.namespace.get('numpy')
+    def decode_batch(messages):
+      try:
+        batch = function(messages)
+      except (IndexError, struct.error):
+        raise DecodeError('Truncated input')
+      if numpy is not None:
+        for field, column in batch.columns.items():
+          if isinstance(column, array):
+            batch.columns[field] = numpy.frombuffer(column, column.typecode)
+      return batch
+    return decode_batch
+
+  def decode_batch(self, name, messages, module=None):
+    return self.batch_decoder(name, module)(messages)
@@ -0,0 +1,541 @@
+from .ast import (
+    TypeAnnotation,
+
+    # Container types
+    Set,
+    Map,
+    List,
+
+    # Everything else
+    Field,
+    Function,
+    Identifier,
+    Service,
+    Exception_,
+    Struct,
+    Const,
+    Senum,
+    Enum,
+    EnumDef,
+    Typedef,
+    Include,
+    Namespace,
+    Thrift
+)
+from .lexer import Scanner
+from .parser import Parser
+
+
+# Stands for no value yet, where None could be one.
+_NOTHING = object()
+
+
+def _span(token):
+  lineno, lexpos = token[2], token[3]
+  return (lineno, lineno, lexpos, lexpos)
+
+
+class Production(object):
+  """Stands in for PLY's YaccProduction when the descent parser builds ptsd.ast nodes.
+
+  values are the semantic values of the right-hand side symbols, indexed from 1.  spans holds a
+  (lineno, endlineno, lexpos, endlexpos) tuple per symbol; only the symbols a node reads need one,
+  and the span of the production itself is derived from its first and last symbols as PLY does.
+  """
+
+  __slots__ = ('parser', 'values', 'spans')
+
+  def __init__(self, parser, values, spans=None):
+    self.parser = parser
+    self.values = values
+    self.spans = spans
+
+  def __getitem__(self, n):
+    return self.values[n]
+
+  def __len__(self):
+    return len(self.values)
+
+  def _span(self, n):
+    if n == 0:
+      first, last = self.spans[1], self.spans[-1]
+      return (first[0], last[1], first[2], last[3])
+    return self.spans[n]
+
+  def linespan(self, n):
+    span = self._span(n)
+    return span[0], span[1]
+
+  def lexspan(self, n):
+    span = self._span(n)
+    return span[2], span[3]
+
+
+class DescentParser(object):
+  """A hand-written recursive-descent parser for the grammar of ptsd.parser.Parser.
+
+  It builds the same ptsd.ast trees, spans included, without PLY: PLY's LALR engine dispatches a
+  Python callback for every reduction, including the many empty ones, while this parser only does
+  work where the grammar produces a value.
+
+  Spans of empty productions reproduce PLY's, which are taken from the lexer state at the time of
+  the reduction.  PLY reduces every empty production that ends up in a span with the next token
+  already read, so those spans sit at the end of that lookahead token.
+  """
+
+  Error = Parser.Error
+
+  BASIC_TYPES = dict((name.upper(), cls) for name, cls in Parser.BASIC_TYPES.items())
+
+  NAMESPACES = {
+    'CPP_NAMESPACE': 'IDENTIFIER',
+    'CPP_INCLUDE': 'LITERAL',
+    'PHP_NAMESPACE': 'IDENTIFIER',
+    'PY_MODULE': 'IDENTIFIER',
+    'PERL_PACKAGE': 'IDENTIFIER',
+    'RUBY_NAMESPACE': 'IDENTIFIER',
+    'SMALLTALK_CATEGORY': 'ST_IDENTIFIER',
+    'SMALLTALK_PREFIX': 'IDENTIFIER',
+    'JAVA_PACKAGE': 'IDENTIFIER',
+    'COCOA_PREFIX': 'IDENTIFIER',
+    'XSD_NAMESPACE': 'LITERAL',
+    'CSHARP_NAMESPACE': 'IDENTIFIER',
+    'DELPHI_NAMESPACE': 'IDENTIFIER',
+  }
+
+  FIELD_TYPE_START = frozenset(['IDENTIFIER', 'MAP', 'SET', 'LIST']) | frozenset(BASIC_TYPES)
+  FIELD_START = FIELD_TYPE_START | frozenset(['INTCONSTANT', 'REQUIRED', 'OPTIONAL'])
+  FUNCTION_START = FIELD_TYPE_START | frozenset(['ONEWAY', 'VOID'])
+  CONST_VALUE_START = frozenset(['INTCONSTANT', 'DUBCONSTANT', 'LITERAL', 'IDENTIFIER', '[', '{'])
+
+  def __init__(self, track_positions=True):
+    self.track_positions = track_positions
+    self._scanner = None
+    self._lookahead = None
+
+  def parse(self, data):
+    self._scanner = Scanner(data)
+    self._lookahead = None
+    try:
+      return self._thrift()
+    except RecursionError:
+      # Types and const values nest without recursion; only fields nested in xsd_attributes get here.
+      raise self.Error('Parse error: nested too deeply')
+    finally:
+      self._scanner = self._lookahead = None
+
+  def iterparse(self, data):
+    """Parse data, yielding each header and top-level definition as soon as it is complete.
+
+    Nothing is kept once yielded, so memory does not grow with the number of definitions.  As with
+    Parser.iterparse(), data is tokenized up front, so memory still grows with its size.
+    """
+    self._scanner = Scanner(data)
+    self._lookahead = None
+    try:
+      for header in self._headers():
+        yield header
+      for definition in self._definitions():
+        yield definition
+    except RecursionError:
+      raise self.Error('Parse error: nested too deeply')
+    finally:
+      self._scanner = self._lookahead = None
+
+  # Token handling
+  def _peek(self):
+    if self._lookahead is None:
+      token = self._scanner.token()
+      if token is None:
+        # PLY leaves lexpos one past the end of the input once it runs out of tokens.
+        end = self._scanner.lexpos + 1
+        token = ('$end', None, self._scanner.lineno, end, end)
+      self._lookahead = token
+    return self._lookahead
+
+  def _next(self):
+    token = self._peek()
+    self._lookahead = None
+    return token
+
+  def _expect(self, kind):
+    token = self._peek()
+    if token[0] != kind:
+      self._error(token)
+    self._lookahead = None
+    return token
+
+  def _empty(self):
+    """The span PLY gives an empty production: the lexer state after the lookahead token."""
+    token = self._peek()
+    return (token[2], token[2], token[4], token[4])
+
+  def _error(self, token):
+    if token[0] == '$end':
+      raise self.Error('Parse error: None')
+    raise self.Error('Parse error: LexToken(%s,%r,%d,%d)' % token[:4])
+
+  # Productions
+  def _thrift(self):
+    return Thrift(Production(self, [None, list(self._headers()), list(self._definitions())]))
+
+  def _headers(self):
+    while True:
+      kind = self._peek()[0]
+      if kind == 'INCLUDE':
+        include, path = self._next(), self._expect('LITERAL')
+        yield Include(Production(
+            self, [None, include[1], path[1]], [None, _span(include), _span(path)]))
+      elif kind == 'NAMESPACE' or kind in self.NAMESPACES:
+        yield self._namespace()
+      else:
+        return
+
+  def _definitions(self):
+    while self._peek()[0] != '$end':
+      yield self._definition()
+
+  def _namespace(self):
+    keyword = self._next()
+    if keyword[0] == 'NAMESPACE':
+      scope = self._peek()
+      if scope[0] not in ('IDENTIFIER', '*'):
+        self._error(scope)
+      self._next()
+      tokens = (keyword, scope, self._expect('IDENTIFIER'))
+    else:
+      tokens = (keyword, self._expect(self.NAMESPACES[keyword[0]]))
+    return Namespace(Production(
+        self, [None] + [token[1] for token in tokens], [None] + [_span(token) for token in tokens]))
+
+  def _definition(self):
+    kind = self._peek()[0]
+    if kind == 'CONST':
+      return self._const()
+    elif kind == 'TYPEDEF':
+      return self._typedef()
+    elif kind == 'ENUM':
+      return self._enum()
+    elif kind == 'SENUM':
+      return self._senum()
+    elif kind in ('STRUCT', 'UNION'):
+      return self._struct()
+    elif kind == 'EXCEPTION':
+      return self._exception()
+    elif kind == 'SERVICE':
+      return self._service()
+    self._error(self._peek())
+
+  def _typedef(self):
+    typedef = self._next()
+    field_type = self._field_type()
+    name = self._expect('IDENTIFIER')
+    annotations, annotations_span = self._type_annotations()
+    return Typedef(Production(
+        self,
+        [None, typedef[1], field_type, name[1], annotations],
+        [None, _span(typedef), None, _span(name), annotations_span]))
+
+  def _separator(self):
+    """comma_or_semicolon_optional"""
+    if self._peek()[0] in (',', ';'):
+      token = self._next()
+      return token[1], _span(token)
+    return '', self._empty()
+
+  def _enum(self):
+    enum, name = self._next(), self._expect('IDENTIFIER')
+    self._expect('{')
+    values, counter = [], -1
+    while self._peek()[0] == 'IDENTIFIER':
+      value = self._next()
+      if self._peek()[0] == '=':
+        self._next()
+        counter = self._expect('INTCONSTANT')[1]
+        annotations, _ = self._type_annotations()
+        separator, separator_span = self._separator()
+        production = Production(
+            self,
+            [None, value[1], '=', counter, annotations, separator],
+            [None, _span(value), None, None, None, separator_span])
+      else:
+        counter += 1
+        annotations, _ = self._type_annotations()
+        separator, separator_span = self._separator()
+        production = Production(
+            self,
+            [None, value[1], annotations, separator],
+            [None, _span(value), None, separator_span])
+      values.append(EnumDef(production, counter))
+    self._expect('}')
+    annotations, annotations_span = self._type_annotations()
+    return Enum(Production(
+        self,
+        [None, enum[1], name[1], None, '{', values, '}', annotations],
+        [None, _span(enum), _span(name), None, None, None, None, annotations_span]))
+
+  def _senum(self):
+    senum, name = self._next(), self._expect('IDENTIFIER')
+    self._expect('{')
+    # Like Parser.p_senum_def_list, which accepts a single value and always reduces to [].
+    if self._peek()[0] == 'LITERAL':
+      self._next()
+      self._separator()
+    self._expect('}')
+    annotations, annotations_span = self._type_annotations()
+    return Senum(Production(
+        self,
+        [None, senum[1], name[1], '{', [], '}', annotations],
+        [None, _span(senum), _span(name), None, None, None, annotations_span]))
+
+  def _const(self):
+    const = self._next()
+    field_type = self._field_type()
+    name = self._expect('IDENTIFIER')
+    self._expect('=')
+    value = self._const_value()
+    separator, separator_span = self._separator()
+    return Const(Production(
+        self,
+        [None, const[1], field_type, name[1], '=', value, separator],
+        [None, _span(const), None, _span(name), None, None, separator_span]))
+
+  def _const_value(self):
+    # Lists and maps nest without recursion: each open one waits on the stack, as [values, key]
+    # with key the map key whose value comes next, for its values.
+    stack = []
+    while True:
+      token = self._next()
+      kind = token[0]
+      if kind in ('INTCONSTANT', 'DUBCONSTANT', 'LITERAL'):
+        value = token[1]
+      elif kind == 'IDENTIFIER':
+        value = Identifier(Production(self, [None, token[1]], [None, _span(token)]), 1)
+      elif kind == '[' or kind == '{':
+        stack.append([[] if kind == '[' else {}, _NOTHING])
+        value = _NOTHING
+      else:
+        self._error(token)
+      # Hand the value to the innermost open container, closing each one that ends here.
+      while stack:
+        frame = stack[-1]
+        values, key = frame
+        if value is not _NOTHING:
+          if type(values) is list:
+            values.append(value)
+          elif key is _NOTHING:
+            frame[1] = value
+            self._expect(':')
+            break
+          else:
+            values[key] = value
+            frame[1] = _NOTHING
+          self._separator()
+        if self._peek()[0] in self.CONST_VALUE_START:
+          break
+        self._expect(']' if type(values) is list else '}')
+        stack.pop()
+        value = values
+      else:
+        return value
+
+  def _struct(self):
+    head, name = self._next(), self._expect('IDENTIFIER')
+    xsd_all = self._flag('XSD_ALL')
+    self._expect('{')
+    fields = self._field_list()
+    self._expect('}')
+    annotations, annotations_span = self._type_annotations()
+    return Struct(Production(
+        self,
+        [None, head[1], name[1], xsd_all, '{', fields, '}', annotations],
+        [None, _span(head), _span(name), None, None, None, None, annotations_span]))
+
+  def _exception(self):
+    exception, name = self._next(), self._expect('IDENTIFIER')
+    self._expect('{')
+    fields = self._field_list()
+    self._expect('}')
+    annotations, annotations_span = self._type_annotations()
+    return Exception_(Production(
+        self,
+        [None, exception[1], name[1], '{', fields, '}', annotations],
+        [None, _span(exception), _span(name), None, None, None, annotations_span]))
+
+  def _service(self):
+    service, name = self._next(), self._expect('IDENTIFIER')
+    extends = None
+    if self._peek()[0] == 'EXTENDS':
+      self._next()
+      extends = self._expect('IDENTIFIER')[1]
+    self._expect('{')
+    functions = []
+    while self._peek()[0] in self.FUNCTION_START:
+      functions.append(self._function())
+    self._expect('}')
+    annotations, annotations_span = self._type_annotations()
+    return Service(Production(
+        self,
+        [None, service[1], name[1], extends, '{', None, functions, None, '}', annotations],
+        [None, _span(service), _span(name), None, None, None, None, None, None, annotations_span]))
+
+  def _function(self):
+    token = self._peek()
+    if token[0] == 'ONEWAY':
+      self._next()
+      oneway, oneway_span = True, _span(token)
+    else:
+      oneway, oneway_span = False, self._empty()
+    if self._peek()[0] == 'VOID':
+      function_type = self._next()[1]
+    else:
+      function_type = self._field_type()
+    name = self._expect('IDENTIFIER')
+    self._expect('(')
+    arguments = self._field_list()
+    self._expect(')')
+    throws = []
+    if self._peek()[0] == 'THROWS':
+      self._next()
+      self._expect('(')
+      throws = self._field_list()
+      self._expect(')')
+    annotations, _ = self._type_annotations()
+    separator, separator_span = self._separator()
+    return Function(Production(
+        self,
+        [None, oneway, function_type, name[1], '(', arguments, ')', throws, annotations, separator],
+        [None, oneway_span, None, _span(name), None, None, None, None, None, separator_span]))
+
+  def _flag(self, kind):
+    if self._peek()[0] == kind:
+      self._next()
+      return True
+    return False
+
+  def _field_list(self):
+    fields = []
+    while self._peek()[0] in self.FIELD_START:
+      fields.append(self._field())
+    return fields
+
+  def _field(self):
+    token = self._peek()
+    if token[0] == 'INTCONSTANT':
+      self._next()
+      colon = self._expect(':')
+      tag, tag_span = token[1], (token[2], colon[2], token[3], colon[3])
+    else:
+      tag, tag_span = None, self._empty()
+    required = self._peek()[0] == 'REQUIRED'
+    if required or self._peek()[0] == 'OPTIONAL':
+      self._next()
+    field_type = self._field_type()
+    name = self._expect('IDENTIFIER')
+    value = None
+    if self._peek()[0] == '=':
+      self._next()
+      value = self._const_value()
+    xsd_optional = self._flag('XSD_OPTIONAL')
+    xsd_nillable = self._flag('XSD_NILLABLE')
+    xsd_attributes = []
+    if self._peek()[0] == 'XSD_ATTRS':
+      self._next()
+      self._expect('{')
+      xsd_attributes = self._field_list()
+      self._expect('}')
+    annotations, _ = self._type_annotations()
+    separator, separator_span = self._separator()
+    return Field(Production(
+        self,
+        [None, tag, required, field_type, name[1], value, xsd_optional, xsd_nillable,
+         xsd_attributes, annotations, separator],
+        [None, tag_span, None, None, _span(name), None, None, None, None, None, separator_span]))
+
+  def _field_type(self):
+    # Containers nest without recursion, so a type nests as deep as PLY's parser allows: each open
+    # container waits on the stack, as [kind, token, cpp_type, element types], for its elements.
+    stack = []
+    while True:
+      token = self._peek()
+      kind = token[0]
+      if kind in ('MAP', 'SET', 'LIST'):
+        self._next()
+        cpp_type = None if kind == 'LIST' else self._cpp_type()[0]
+        self._expect('<')
+        stack.append([kind, token, cpp_type, []])
+        continue
+      node = self._simple_field_type(token)
+      while stack:
+        kind, token, cpp_type, types = stack[-1]
+        types.append(node)
+        if kind == 'MAP' and len(types) == 1:
+          self._expect(',')
+          break
+        stack.pop()
+        node = self._container_type(kind, token, cpp_type, types)
+      else:
+        return node
+
+  def _simple_field_type(self, token):
+    kind = token[0]
+    if kind == 'IDENTIFIER':
+      self._next()
+      return Identifier(Production(self, [None, token[1]], [None, _span(token)]), 1)
+    base_type = self.BASIC_TYPES.get(kind)
+    if base_type is None:
+      self._error(token)
+    self._next()
+    annotations, annotations_span = self._type_annotations()
+    if not annotations:
+      return base_type.shared()
+    node = base_type(Production(
+        self, [None, base_type, annotations], [None, _span(token), annotations_span]), 1)
+    node.add_annotations(annotations)
+    return node
+
+  def _cpp_type(self):
+    if self._peek()[0] == 'CPP_TYPE':
+      cpp_type, literal = self._next(), self._expect('LITERAL')
+      return literal[1], (cpp_type[2], literal[2], cpp_type[3], literal[3])
+    return None, self._empty()
+
+  def _container_type(self, kind, token, cpp_type, types):
+    """Build the container opened by token, from its element types, once they are parsed."""
+    close = self._expect('>')
+    if kind == 'MAP':
+      node = Map(Production(
+          self,
+          [None, token[1], cpp_type, '<', types[0], ',', types[1], '>'],
+          [None, _span(token), None, None, None, None, None, _span(close)]))
+    elif kind == 'SET':
+      node = Set(Production(
+          self,
+          [None, token[1], cpp_type, '<', types[0], '>'],
+          [None, _span(token), None, None, None, _span(close)]))
+    else:
+      cpp_type, cpp_type_span = self._cpp_type()
+      node = List(Production(
+          self,
+          [None, token[1], '<', types[0], '>', cpp_type],
+          [None, _span(token), None, None, None, cpp_type_span]))
+    annotations, _ = self._type_annotations()
+    node.add_annotations(annotations)
+    return node
+
+  def _type_annotations(self):
+    if self._peek()[0] != '(':
+      return [], self._empty()
+    start = self._next()
+    annotations = []
+    while self._peek()[0] == 'IDENTIFIER':
+      name = self._next()
+      self._expect('=')
+      value = self._expect('LITERAL')
+      separator, separator_span = self._separator()
+      annotations.append(TypeAnnotation(Production(
+          self,
+          [None, name[1], '=', value[1], separator],
+          [None, _span(name), None, None, separator_span])))
+    end = self._expect(')')
+    return annotations, (start[2], end[2], start[3], end[3])
@@ -0,0 +1,346 @@
+"""Structural diffs between versions of a schema, each change classified as wire-compatible or not.
+
+  python -m ptsd.diff OLD NEW
+
+prints the changes from the Thrift file OLD, with its includes, to NEW, and exits with status 1 if
+any of them is incompatible.  From Python:
+
+  for change in diff_loaders(Loader(old_root), Loader(new_root)):
+    print(change)
+
+or Differ().diff(old, new) for two Thrifts, or two definitions such as VersioningTestV1 and
+VersioningTestV2.  Subtrees whose fingerprints (Node.fingerprint()) are equal are skipped without
+being looked into, so once fingerprints are computed a diff takes time in proportion to what
+changed rather than to the size of the schemas.
+
+Compatible means that peers built from either version still read what the other writes, with the
+binary and compact protocols.  Fields are matched by tag and enum values by name:
+
+  - adding or removing a field is compatible unless the field is required;
+  - moving a field to another tag, or changing whether it is required, is not;
+  - changing the type of a field, argument, return type or typedef is compatible only when the
+    types are written the same way: string and binary, an enum and i32, a typedef and its type;
+  - renaming a field is compatible, as names are not written;
+  - adding an enum value or renaming one is compatible; changing or removing one is not;
+  - removing a definition or a function, or changing what kind of definition a name is, is not;
+  - defaults, consts, annotations, namespaces and includes do not change what is written.
+
+Named types are compared by name unless the loaders are given to resolve them.
+"""
+
+import argparse
+import os
+import sys
+
+from . import ast
+from .codec import BASE_KINDS, Error, Resolver
+from .lexer import Identifier as LexerIdentifier
+
+
+# Base kinds written as another: binary is written as a string.
+WIRE_KINDS = {'binary': 'string'}
+
+
+class Change(object):
+  """One difference between two versions of a schema.
+
+  path names what changed ('Module.Struct.field', ...), kind what about it did ('added', 'removed',
+  'tag', 'type', 'requiredness', 'value', 'name', 'default', 'definition', 'oneway', 'extends',
+  'annotations' or 'other'), and old and new are the values before and after, rendered as text or
+  None.  compatible says whether peers of both versions still understand each other.
+  """
+
+  __slots__ = ('path', 'kind', 'compatible', 'old', 'new')
+
+  def __init__(self, path, kind, compatible, old=None, new=None):
+    self.path = path
+    self.kind = kind
+    self.compatible = compatible
+    self.old = old
+    self.new = new
+
+  def as_dict(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+  def __repr__(self):
+    return 'Change(%r, %r, %r, %r, %r)' % (self.path, self.kind, self.compatible, self.old, self.new)
+
+  def __str__(self):
+    if self.kind == 'added':
+      change = 'added %s' % self.new
+    elif self.kind == 'removed':
+      change = 'removed %s' % self.old
+    else:
+      change = '%s %s -> %s' % (self.kind, self.old, self.new)
+    return '%s  %s: %s' % ('ok  ' if self.compatible else 'FAIL', self.path, change)
+
+
+def _text(value):
+  if value is None:
+    return None
+  elif isinstance(value, ast.Node):
+    return str(value)
+  elif isinstance(value, LexerIdentifier):
+    return value.value
+  return ast.Const.render_value(value)
+
+
+def _same(old, new):
+  return ast.fingerprint(old) == ast.fingerprint(new)
+
+
+def _join(path, name):
+  return '%s.%s' % (path, name) if path else name
+
+
+class Differ(object):
+  """Diffs trees, resolving named types through old and new, the Loaders they belong to, if given."""
+
+  def __init__(self, old=None, new=None):
+    self.resolvers = (old and Resolver(old), new and Resolver(new))
+    self._modules = (None, None)
+
+  def diff(self, old, new, path='', modules=(None, None)):
+    """Return the Changes from old to new, two Thrifts or two definitions.
+
+    modules are the names of the modules old and new are from, to resolve named types with.
+    """
+    changes = []
+    if not _same(old, new):
+      self._modules = modules
+      if isinstance(old, ast.Thrift) and isinstance(new, ast.Thrift):
+        self.thrift(changes, path, old, new)
+      else:
+        self.definition(changes, path, old, new)
+    return changes
+
+  def change(self, changes, path, kind, compatible, old=None, new=None):
+    changes.append(Change(path, kind, compatible, _text(old), _text(new)))
+
+  def thrift(self, changes, path, old, new):
+    for kind, olds, news, key in (
+        ('include', old.includes, new.includes, lambda node: node.path.value),
+        ('namespace', old.namespaces, new.namespaces, lambda node: node.language_id)):
+      olds = dict((key(node), node) for node in olds)
+      news = dict((key(node), node) for node in news)
+      for name in sorted(set(olds) | set(news)):
+        if name not in olds or name not in news or not _same(olds[name], news[name]):
+          self.change(changes, _join(path, '%s %s' % (kind, name)), 'other', True,
+                      olds.get(name), news.get(name))
+    self.members(changes, path, old.body, new.body, self.definition, removable=False)
+
+  def members(self, changes, path, olds, news, differ, removable):
+    """Diff two lists of named nodes, matching them by name.
+
+    Members only in news were added, which is compatible; members only in olds were removed,
+    which is compatible if removable is.
+    """
+    old_names = dict((node.name.value, node) for node in olds)
+    new_names = set()
+    for node in news:
+      name = node.name.value
+      new_names.add(name)
+      previous = old_names.get(name)
+      if previous is None:
+        self.change(changes, _join(path, name), 'added', True, None, node)
+      elif not _same(previous, node):
+        differ(changes, _join(path, name), previous, node)
+    for node in olds:
+      if node.name.value not in new_names:
+        self.change(changes, _join(path, node.name.value), 'removed', removable, node)
+
+  def definition(self, changes, path, old, new):
+    if type(old) is not type(new) or getattr(old, 'union', False) != getattr(new, 'union', False):
+      self.change(changes, path, 'definition', False, _kind(old), _kind(new))
+      return
+    count = len(changes)
+    if isinstance(old, (ast.Struct, ast.Exception_)):
+      self.fields(changes, path, old.fields, new.fields)
+    elif isinstance(old, ast.Enum):
+      self.enum(changes, path, old, new)
+    elif isinstance(old, ast.Typedef):
+      self.type(changes, path, old.type, new.type)
+    elif isinstance(old, ast.Const):
+      if not _same(old.type, new.type):
+        self.change(changes, path, 'type', True, old.type, new.type)
+      if not _same(old.value, new.value):
+        self.change(changes, path, 'value', True, old.value, new.value)
+    elif isinstance(old, ast.Service):
+      if not _same(old.extends, new.extends):
+        self.change(changes, path, 'extends', False, old.extends, new.extends)
+      self.members(changes, path, old.functions, new.functions, self.function, removable=False)
+    self.annotations(changes, path, old, new)
+    if len(changes) == count:
+      # Only what the cases above do not look at changed: a senum, xsd_all, ...
+      self.change(changes, path, 'other', True, old, new)
+
+  def annotations(self, changes, path, old, new):
+    if not _same(getattr(old, 'annotations', ()), getattr(new, 'annotations', ())):
+      self.change(changes, path, 'annotations', True, old.annotations_str().strip() or None,
+                  new.annotations_str().strip() or None)
+
+  def function(self, changes, path, old, new):
+    count = len(changes)
+    if old.oneway != new.oneway:
+      self.change(changes, path, 'oneway', False, old.oneway, new.oneway)
+    if isinstance(old.type, ast.Node) and isinstance(new.type, ast.Node):
+      self.type(changes, path, old.type, new.type)
+    elif old.type != new.type:
+      self.change(changes, path, 'type', False, old.type, new.type)
+    self.fields(changes, path, old.arguments, new.arguments)
+    self.fields(changes, _join(path, 'throws'), old.throws or [], new.throws or [])
+    self.annotations(changes, path, old, new)
+    if len(changes) == count:
+      self.change(changes, path, 'other', True, old, new)
+
+  def fields(self, changes, path, olds, news):
+    """Diff two field lists, matching fields by tag."""
+    if _same(olds, news):
+      return
+    old_tags = dict((_key(field), field) for field in olds)
+    added = []
+    for field in news:
+      previous = old_tags.pop(_key(field), None)
+      if previous is None:
+        added.append(field)
+      elif not _same(previous, field):
+        self.field(changes, _join(path, field.name.value), previous, field)
+    # A field moved to another tag is removed from one and added at the other, under one name.
+    added_names = dict((field.name.value, field) for field in added)
+    for field in old_tags.values():
+      name = field.name.value
+      if name in added_names:
+        self.change(changes, _join(path, name), 'tag', False, field.tag, added_names.pop(name).tag)
+      else:
+        self.change(changes, _join(path, name), 'removed', not field.required, field)
+    for field in added:
+      if field.name.value in added_names:
+        self.change(changes, _join(path, field.name.value), 'added', not field.required, None,
+                    field)
+
+  def field(self, changes, path, old, new):
+    count = len(changes)
+    if old.name.value != new.name.value:
+      self.change(changes, path, 'name', True, old.name, new.name)
+    if old.required != new.required:
+      self.change(changes, path, 'requiredness', False,
+                  'required' if old.required else 'optional',
+                  'required' if new.required else 'optional')
+    self.type(changes, path, old.type, new.type)
+    if not _same(old.const_value, new.const_value):
+      self.change(changes, path, 'default', True, old.const_value, new.const_value)
+    self.annotations(changes, path, old, new)
+    if len(changes) == count:
+      self.change(changes, path, 'other', True, old, new)
+
+  def type(self, changes, path, old, new):
+    if not _same(old, new):
+      compatible = self.wire(old, 0) == self.wire(new, 1)
+      self.change(changes, path, 'type', compatible, old, new)
+
+  def enum(self, changes, path, old, new):
+    """Diff the values of two enums, matching them by name."""
+    old_names = dict((value.name.value, value) for value in old.values)
+    new_names = dict((value.name.value, value) for value in new.values)
+    for name, value in new_names.items():
+      previous = old_names.get(name)
+      if previous is None:
+        continue
+      if previous.tag != value.tag:
+        self.change(changes, _join(path, name), 'value', False, previous.tag, value.tag)
+      elif not _same(previous, value):
+        self.annotations(changes, _join(path, name), previous, value)
+    # A value kept under another name is written the same way.
+    added = dict((value.tag, value) for name, value in new_names.items() if name not in old_names)
+    for name, value in old_names.items():
+      if name in new_names:
+        continue
+      renamed = added.pop(value.tag, None)
+      if renamed is not None:
+        self.change(changes, _join(path, name), 'name', True, name, renamed.name.value)
+      else:
+        self.change(changes, _join(path, name), 'removed', False, value)
+    for value in added.values():
+      self.change(changes, _join(path, value.name.value), 'added', True, None, value)
+
+  def wire(self, node, side):
+    """Return how values of the type node, of the old (side 0) or new (side 1) tree, are written."""
+    resolver, module = self.resolvers[side], self._modules[side]
+    if resolver and module is not None:
+      try:
+        return _wire(resolver.spec(node, module))
+      except Error:
+        pass
+    if isinstance(node, ast.Identifier):
+      return ('named', node.value)
+    kind = BASE_KINDS.get(type(node))
+    if kind is not None:
+      return WIRE_KINDS.get(kind, kind)
+    elif isinstance(node, (ast.List, ast.Set)):
+      return (type(node).__name__.lower(), self.wire(node.value_type, side))
+    elif isinstance(node, ast.Map):
+      return ('map', self.wire(node.key_type, side), self.wire(node.value_type, side))
+    return ('other', ast.fingerprint(node))
+
+
+def _key(field):
+  # Fields without an explicit tag are matched by name.
+  return field.tag if field.tag is not None else field.name.value
+
+
+def _kind(node):
+  if isinstance(node, ast.Struct) and node.union:
+    return 'union'
+  return type(node).__name__.rstrip('_').lower()
+
+
+def _wire(spec):
+  if isinstance(spec, str):
+    return WIRE_KINDS.get(spec, spec)
+  elif spec[0] == 'struct':
+    return ('named', spec[2])
+  return (spec[0],) + tuple(_wire(item) for item in spec[1:])
+
+
+def module_name(path):
+  return os.path.splitext(os.path.basename(path))[0]
+
+
+def diff_loaders(old, new):
+  """Return the Changes from the modules of the Loader old to those of the Loader new."""
+  differ = Differ(old, new)
+  olds = dict((module_name(path), thrift) for path, thrift in old.thrifts.items())
+  news = dict((module_name(path), thrift) for path, thrift in new.thrifts.items())
+  changes = []
+  for module, thrift in news.items():
+    if module not in olds:
+      changes.append(Change(module, 'added', True, None, 'module %s' % module))
+    else:
+      changes.extend(differ.diff(olds[module], thrift, module, (module, module)))
+  for module in olds:
+    if module not in news:
+      changes.append(Change(module, 'removed', False, 'module %s' % module))
+  return changes
+
+
+def main(argv):
+  from .loader import Loader
+
+  parser = argparse.ArgumentParser(
+      prog='python -m ptsd.diff',
+      description='Print the changes between two versions of a Thrift file and its includes.')
+  parser.add_argument('old')
+  parser.add_argument('new')
+  parser.add_argument('--incompatible', action='store_true',
+                      help='only print the changes that are not wire-compatible')
+  options = parser.parse_args(argv)
+  quiet = lambda message: None
+  changes = diff_loaders(Loader(options.old, logger=quiet), Loader(options.new, logger=quiet))
+  for change in changes:
+    if not (options.incompatible and change.compatible):
+      print(change)
+  return 0 if all(change.compatible for change in changes) else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
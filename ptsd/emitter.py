@@ -0,0 +1,177 @@
+from . import ast
+from .lexer import Identifier as LexerIdentifier
+
+
+class Emitter(object):
+  """Writes nodes as Thrift IDL to a file object, a line at a time.
+
+  The output is what str() of the nodes gives, except that names the tree keeps as raw tokens
+  (service extends clauses, old-style namespaces) and senums are rendered as IDL.  No string larger
+  than a line is built: definitions are written member by member, with their indentation written as
+  such instead of substituted for tabs afterwards.  Types and const values are rendered from an
+  explicit stack, so arbitrarily deep nesting does not recurse.
+  """
+
+  INDENT = ' ' * ast.TAB_SPACES
+
+  def __init__(self, fp):
+    self.write = fp.write
+
+  def emit(self, node):
+    """Write node, a Thrift or any node within one."""
+    if isinstance(node, ast.Thrift):
+      self.thrift(node)
+    elif isinstance(node, (ast.Struct, ast.Exception_, ast.Enum, ast.Senum, ast.Service)):
+      self.definition(node)
+    else:
+      self.write(self.text(node))
+
+  def thrift(self, thrift):
+    write = self.write
+    for index, include in enumerate(thrift.includes):
+      write('%s%s' % ('\n' if index else '', self.text(include)))
+    if thrift.includes:
+      write('\n\n')
+    for index, namespace in enumerate(thrift.namespaces):
+      write('%s%s' % ('\n' if index else '', self.text(namespace)))
+    if thrift.namespaces:
+      write('\n\n')
+    for index, definition in enumerate(thrift.body):
+      if index:
+        write('\n\n')
+      self.emit(definition)
+
+  def definition(self, node):
+    """Write a definition with members: a struct, union, exception, enum, senum or service."""
+    if isinstance(node, ast.Struct):
+      head, members = '%s %s' % ('union' if node.union else 'struct', node.name.value), node.fields
+    elif isinstance(node, ast.Exception_):
+      head, members = 'exception %s' % node.name.value, node.fields
+    elif isinstance(node, ast.Service):
+      head, members = 'service %s' % node.name.value, node.functions
+      if node.extends:
+        head += ' extends %s' % self._name(node.extends)
+    else:
+      head, members = '%s %s' % (
+          'enum' if isinstance(node, ast.Enum) else 'senum', node.name.value), node.values
+    write, text, indent = self.write, self.text, self.INDENT
+    write('%s {\n' % head)
+    for index, member in enumerate(members):
+      write('%s%s%s' % ('\n' if index else '', indent, text(member)))
+    if not members:
+      write(indent)
+    write('\n}%s' % self.annotations(node))
+
+  @classmethod
+  def _name(cls, name):
+    return name.value if isinstance(name, (ast.Identifier, LexerIdentifier)) else str(name)
+
+  def annotations(self, node):
+    if not node.annotations:
+      return ''
+    return ' %s' % ' '.join(
+        '%s=%s' % (annotation.name.value, annotation.value) for annotation in node.annotations)
+
+  def text(self, node):
+    """Return the IDL of node, any node but a Thrift or a definition with members."""
+    if isinstance(node, ast.Field):
+      return '%d: %s%s %s%s%s' % (
+          node.tag,
+          'required ' if node.required else '',
+          self.type(node.type),
+          node.name.value,
+          ' = %s ' % self.value(node.const_value) if node.const_value else '',
+          self.annotations(node))
+    elif isinstance(node, ast.Function):
+      return '%s%s %s(%s)%s%s' % (
+          'oneway ' if node.oneway else '',
+          self.type(node.type),
+          node.name.value,
+          ', '.join(map(self.text, node.arguments)),
+          (' throws (%s)' % ' '.join(map(self.text, node.throws))) if node.throws else '',
+          self.annotations(node))
+    elif isinstance(node, ast.EnumDef):
+      return '%s = %s%s' % (node.name.value, node.tag, self.annotations(node))
+    elif isinstance(node, ast.Typedef):
+      return 'typedef %s %s%s' % (self.type(node.type), node.name.value, self.annotations(node))
+    elif isinstance(node, ast.Const):
+      return 'const %s %s = %s' % (self.type(node.type), node.name.value, self.value(node.value))
+    elif isinstance(node, ast.Namespace):
+      return '%s%s %s' % (
+          '' if node.old_style else 'namespace ', node.language_id, self._name(node.name))
+    elif isinstance(node, ast.Include):
+      return 'include %s' % node.path
+    elif isinstance(node, ast.TypeAnnotation):
+      return '%s=%s' % (node.name.value, node.value)
+    elif isinstance(node, (ast.Identifier, ast.BaseType, ast.Map, ast.Set, ast.List)):
+      return self.type(node)
+    return self._name(node)
+
+  # The IDL of each base type, keyed by class.
+  BASE_TYPES = dict((cls, cls.__name__.lower()) for cls in (
+      ast.String, ast.Binary, ast.Slist, ast.Bool, ast.Byte, ast.I16, ast.I32, ast.I64, ast.Double))
+
+  @classmethod
+  def type(cls, node):
+    """Return the IDL of a type node."""
+    kind = type(node)
+    if kind is ast.Identifier:
+      return node.value
+    base_types = cls.BASE_TYPES
+    name = base_types.get(kind)
+    if name is not None:
+      return name
+    parts, stack = [], [node]
+    while stack:
+      item = stack.pop()
+      kind = type(item)
+      if kind is str:
+        parts.append(item)
+      elif kind is ast.Identifier:
+        parts.append(item.value)
+      elif kind in base_types:
+        parts.append(base_types[kind])
+      elif kind is ast.Map:
+        stack.extend(('>', item.value_type, ', ', item.key_type, 'map<'))
+      elif kind is ast.Set:
+        stack.extend(('>', item.value_type, 'set<'))
+      elif kind is ast.List:
+        stack.extend(('>', item.value_type, 'list<'))
+      else:
+        # 'void', and subclasses of the node types.
+        parts.append(str(item))
+    return ''.join(parts)
+
+  @classmethod
+  def value(cls, value):
+    """Return the IDL of a const value: a number, literal, identifier, list or dict of those."""
+    if not isinstance(value, (list, dict)):
+      return cls._name(value)
+    # Values are never plain strings (literals are Literals), so strings on the stack are punctuation.
+    parts, stack = [], [value]
+    while stack:
+      item = stack.pop()
+      if isinstance(item, str):
+        parts.append(item)
+      elif isinstance(item, list):
+        stack.append(']')
+        for index in range(len(item) - 1, -1, -1):
+          stack.append(item[index])
+          if index:
+            stack.append(', ')
+        stack.append('[')
+      elif isinstance(item, dict):
+        stack.append('}')
+        for index, (key, element) in reversed(list(enumerate(item.items()))):
+          stack.extend((element, ': ', key))
+          if index:
+            stack.append(', ')
+        stack.append('{')
+      else:
+        parts.append(cls._name(item))
+    return ''.join(parts)
+
+
+def emit(node, fp):
+  """Write node as Thrift IDL to fp, a file object or anything else with a write() method."""
+  Emitter(fp).emit(node)
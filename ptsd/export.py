@@ -0,0 +1,372 @@
+"""Structured export of parsed trees, as JSON or a compact binary encoding."""
+
+import json
+import os
+import struct
+
+from . import ast
+from .ast import _fields
+from .lexer import Identifier as LexerIdentifier, Literal
+
+
+FORMAT = 'ptsd'
+VERSION = 1
+MAGIC = b'PTSD\x01'
+
+
+class Error(Exception): pass
+
+
+_MISSING = object()
+
+
+NODE_CLASSES = dict(
+    (name, cls) for name, cls in vars(ast).items()
+    if isinstance(cls, type) and issubclass(cls, ast.Node))
+
+
+def _node_class(name):
+  try:
+    return NODE_CLASSES[name]
+  except KeyError:
+    raise Error('Unknown node class %s' % name)
+
+
+def _is_shared(node):
+  return isinstance(node, ast.BaseType) and ast.BaseType._SHARED.get(type(node)) is node
+
+
+def _new_node(cls, span):
+  node = cls.__new__(cls)
+  node._span = span
+  if cls is ast.Thrift:
+    node._index = None
+  return node
+
+
+def _document(loader):
+  modules = []
+  for path, thrift in loader.thrifts.items():
+    modules.append({
+      'path': path,
+      'module': os.path.splitext(os.path.basename(path))[0],
+      'includes': list(loader.include_paths(path, thrift)),
+      'thrift': thrift,
+    })
+  return {'format': FORMAT, 'version': VERSION, 'root': os.path.realpath(loader.root),
+          'modules': modules}
+
+
+def _exported(source):
+  if isinstance(source, ast.Thrift):
+    return source
+  elif hasattr(source, 'thrifts'):
+    return _document(source)
+  raise TypeError('Can only export a Thrift or a Loader, not %s' % type(source).__name__)
+
+
+# JSON
+def plain(value):
+  """Return value, a node or any value within one, as JSON-serializable data."""
+  if isinstance(value, ast.Node):
+    cls = type(value)
+    if _is_shared(value):
+      return {'node': cls.__name__, 'shared': True}
+    data = {'node': cls.__name__}
+    if value._span is not None:
+      data['span'] = list(value._linespan + value._lexspan)
+    for name in _fields(cls):
+      field = getattr(value, name, _MISSING)
+      if field is not _MISSING:
+        data[name] = plain(field)
+    return data
+  elif isinstance(value, list):
+    return [plain(item) for item in value]
+  elif isinstance(value, Literal):
+    return {'literal': value.value}
+  elif isinstance(value, LexerIdentifier):
+    return {'identifier': value.value}
+  elif isinstance(value, dict):
+    return {'map': [[plain(key), plain(item)] for key, item in value.items()]}
+  elif isinstance(value, tuple):
+    return {'tuple': [plain(item) for item in value]}
+  return value
+
+
+def _from_plain(data):
+  """The object_hook of read_json(): turn the tagged objects back into nodes and values."""
+  name = data.get('node')
+  if name is not None:
+    cls = _node_class(name)
+    if data.get('shared'):
+      return cls.shared()
+    span = data.get('span')
+    if span is not None:
+      line_start, line_end, lex_start, lex_end = span
+      span = lex_start | lex_end << 32 | line_start << 64 | line_end << 96
+    node = _new_node(cls, span)
+    for field in _fields(cls):
+      if field in data:
+        setattr(node, field, data[field])
+    return node
+  elif len(data) == 1:
+    if 'literal' in data:
+      return Literal(data['literal'])
+    elif 'identifier' in data:
+      return LexerIdentifier(data['identifier'])
+    elif 'map' in data:
+      return dict((key, value) for key, value in data['map'])
+    elif 'tuple' in data:
+      return tuple(data['tuple'])
+  return data
+
+
+def _write_json_list(items, fp):
+  fp.write('[')
+  for index, item in enumerate(items):
+    if index:
+      fp.write(', ')
+    fp.write(json.dumps(plain(item)))
+  fp.write(']')
+
+
+def _write_json_thrift(thrift, fp):
+  fp.write('{"node": "Thrift"')
+  for name in _fields(ast.Thrift):
+    fp.write(', "%s": ' % name)
+    _write_json_list(getattr(thrift, name), fp)
+  fp.write('}')
+
+
+def write_json(source, fp):
+  """Write source, a Thrift or a Loader, to fp as JSON."""
+  exported = _exported(source)
+  if isinstance(exported, ast.Thrift):
+    _write_json_thrift(exported, fp)
+  else:
+    modules = exported.pop('modules')
+    fp.write(json.dumps(exported)[:-1])
+    fp.write(', "modules": [')
+    for index, module in enumerate(modules):
+      thrift = module.pop('thrift')
+      fp.write('%s%s, "thrift": ' % (', ' if index else '', json.dumps(module)[:-1]))
+      _write_json_thrift(thrift, fp)
+      fp.write('}')
+    fp.write(']}')
+  fp.write('\n')
+
+
+def read_json(fp):
+  """Read what write_json() wrote: a Thrift, or the document of a Loader."""
+  return json.load(fp, object_hook=_from_plain)
+
+
+# Binary
+(_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STRING, _STRING_REF, _LIST, _TUPLE, _DICT, _LITERAL,
+ _IDENTIFIER, _NODE, _SHARED, _SPAN) = range(15)
+
+_DOUBLE = struct.Struct('<d')
+
+
+class BinaryWriter(object):
+  """Streams values in the binary encoding to a file object opened for bytes."""
+
+  # How many bytes are buffered between writes to the file.
+  BUFFER = 1 << 16
+
+  def __init__(self, fp):
+    self.fp = fp
+    self._buffer = bytearray()
+    self._strings = {}
+
+  def _varint(self, n):
+    buffer = self._buffer
+    while n > 0x7F:
+      buffer.append(n & 0x7F | 0x80)
+      n >>= 7
+    buffer.append(n)
+
+  def _string(self, s):
+    index = self._strings.get(s)
+    if index is not None:
+      self._buffer.append(_STRING_REF)
+      self._varint(index)
+    else:
+      self._strings[s] = len(self._strings)
+      data = s.encode('utf-8')
+      self._buffer.append(_STRING)
+      self._varint(len(data))
+      self._buffer += data
+
+  def value(self, value):
+    buffer = self._buffer
+    if isinstance(value, str):
+      self._string(value)
+    elif isinstance(value, ast.Node):
+      cls = type(value)
+      if _is_shared(value):
+        buffer.append(_SHARED)
+        self._string(cls.__name__)
+        return
+      buffer.append(_NODE)
+      self._string(cls.__name__)
+      if value._span is None:
+        buffer.append(_NONE)
+      else:
+        # Spans pack four 32 bit positions; fixed width beats a 15 byte varint.
+        buffer.append(_SPAN)
+        buffer += value._span.to_bytes(16, 'little')
+      for name in _fields(cls):
+        self.value(getattr(value, name, None))
+      if len(buffer) >= self.BUFFER:
+        self.flush()
+    elif value is None:
+      buffer.append(_NONE)
+    elif value is True:
+      buffer.append(_TRUE)
+    elif value is False:
+      buffer.append(_FALSE)
+    elif isinstance(value, int):
+      buffer.append(_INT)
+      self._varint(value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+      buffer.append(_FLOAT)
+      buffer += _DOUBLE.pack(value)
+    elif isinstance(value, (list, tuple)):
+      buffer.append(_LIST if isinstance(value, list) else _TUPLE)
+      self._varint(len(value))
+      for item in value:
+        self.value(item)
+    elif isinstance(value, dict):
+      buffer.append(_DICT)
+      self._varint(len(value))
+      for key, item in value.items():
+        self.value(key)
+        self.value(item)
+    elif isinstance(value, Literal):
+      buffer.append(_LITERAL)
+      self._string(value.value)
+    elif isinstance(value, LexerIdentifier):
+      buffer.append(_IDENTIFIER)
+      self._string(value.value)
+    else:
+      raise TypeError('Can not export %s' % type(value).__name__)
+
+  def flush(self):
+    self.fp.write(self._buffer)
+    del self._buffer[:]
+
+
+class BinaryReader(object):
+  """Decodes a value of the binary encoding from bytes."""
+
+  def __init__(self, data, pos=0):
+    self.data = data
+    self.pos = pos
+    self._strings = []
+
+  def _varint(self):
+    data, pos = self.data, self.pos
+    byte = data[pos]
+    pos += 1
+    if byte < 0x80:
+      self.pos = pos
+      return byte
+    n, shift = byte & 0x7F, 7
+    while byte & 0x80:
+      byte = data[pos]
+      n |= (byte & 0x7F) << shift
+      shift += 7
+      pos += 1
+    self.pos = pos
+    return n
+
+  def _take(self, pos, length):
+    if pos + length > len(self.data):
+      raise Error('Truncated input')
+    return self.data[pos:pos + length]
+
+  def value(self):
+    """Decode the value at pos and move past it.  Input cut short raises IndexError or Error."""
+    data = self.data
+    try:
+      tag = data[self.pos]
+    except IndexError:
+      raise Error('Truncated input')
+    self.pos += 1
+    if tag == _STRING_REF:
+      index = self._varint()
+      if index >= len(self._strings):
+        raise Error('Unknown string %d at offset %d' % (index, self.pos))
+      return self._strings[index]
+    elif tag == _NODE:
+      cls = _node_class(self.value())
+      if data[self.pos] == _SPAN:
+        span = int.from_bytes(self._take(self.pos + 1, 16), 'little')
+        self.pos += 17
+      else:
+        span = self.value()
+      node = _new_node(cls, span)
+      for name in _fields(cls):
+        setattr(node, name, self.value())
+      return node
+    elif tag == _STRING:
+      length = self._varint()
+      s = str(self._take(self.pos, length), 'utf-8')
+      self.pos += length
+      self._strings.append(s)
+      return s
+    elif tag == _NONE:
+      return None
+    elif tag == _TRUE:
+      return True
+    elif tag == _FALSE:
+      return False
+    elif tag == _INT:
+      n = self._varint()
+      return -((n + 1) >> 1) if n & 1 else n >> 1
+    elif tag == _LIST:
+      return [self.value() for _ in range(self._varint())]
+    elif tag == _LITERAL:
+      return Literal(self.value())
+    elif tag == _IDENTIFIER:
+      return LexerIdentifier(self.value())
+    elif tag == _SHARED:
+      return _node_class(self.value()).shared()
+    elif tag == _FLOAT:
+      value, = _DOUBLE.unpack(self._take(self.pos, _DOUBLE.size))
+      self.pos += _DOUBLE.size
+      return value
+    elif tag == _TUPLE:
+      return tuple(self.value() for _ in range(self._varint()))
+    elif tag == _DICT:
+      items = []
+      for _ in range(self._varint()):
+        key = self.value()
+        items.append((key, self.value()))
+      return dict(items)
+    raise Error('Unknown tag %d at offset %d' % (tag, self.pos - 1))
+
+
+def write_binary(source, fp):
+  """Write source, a Thrift or a Loader, to fp, opened for bytes, in the binary encoding."""
+  fp.write(MAGIC)
+  writer = BinaryWriter(fp)
+  writer.value(_exported(source))
+  writer.flush()
+
+
+def read_binary(fp):
+  """Read what write_binary() wrote: a Thrift, or the document of a Loader."""
+  data = fp.read()
+  if data[:len(MAGIC)] != MAGIC:
+    raise Error('Not a ptsd binary export')
+  reader = BinaryReader(data, len(MAGIC))
+  try:
+    value = reader.value()
+  except IndexError:
+    # The input ended within a varint.
+    raise Error('Truncated input')
+  if reader.pos != len(data):
+    raise Error('Trailing data at offset %d' % reader.pos)
+  return value
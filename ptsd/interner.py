@@ -0,0 +1,73 @@
+from sys import intern
+
+from . import ast
+
+
+class Interner(object):
+  """Hash-conses the type nodes of trees and interns the strings of their identifiers.
+
+  Every unannotated type expression in the trees passed to intern() is replaced by the canonical
+  node for its structure, so repeated types such as list<i32> or map<string, string> share a single
+  object and comparing two types reduces to an identity check.  Like the shared base type instances,
+  canonical nodes carry no spans and add_annotations() on them raises TypeError.  Annotated types keep
+  their own node, but their element types are interned.
+  """
+
+  def __init__(self):
+    self._types = {}
+
+  def __len__(self):
+    return len(self._types)
+
+  def type(self, node):
+    """Return the canonical node for the type node, interning its element types in place."""
+    if isinstance(node, ast.Identifier):
+      node.value = intern(node.value)
+      key = (ast.Identifier, node.value)
+    elif isinstance(node, ast.Map):
+      node.key_type = self.type(node.key_type)
+      node.value_type = self.type(node.value_type)
+      key = (ast.Map, self._cpp_type(node), node.key_type, node.value_type)
+    elif isinstance(node, ast.Set):
+      node.value_type = self.type(node.value_type)
+      key = (ast.Set, self._cpp_type(node), node.value_type)
+    elif isinstance(node, ast.List):
+      node.value_type = self.type(node.value_type)
+      key = (ast.List, node.value_type)
+    else:
+      # Base types, whose unannotated occurrences are already shared, and 'void'.
+      return node
+    if getattr(node, 'annotations', None):
+      return node
+    canonical = self._types.get(key)
+    if canonical is None:
+      canonical = self._types[key] = node
+      node._span = None
+      if isinstance(node, ast.Annotated):
+        node.annotations = ()
+    return canonical
+
+  @classmethod
+  def _cpp_type(cls, node):
+    return None if node.cpp_type is None else node.cpp_type.value
+
+  def _field(self, field):
+    field.type = self.type(field.type)
+    for attribute in field.xsd_attributes:
+      self._field(attribute)
+
+  def intern(self, thrift):
+    """Intern the types and names of thrift in place and return it."""
+    for _, node in thrift.walk():
+      name = getattr(node, 'name', None)
+      if isinstance(name, ast.Identifier):
+        name.value = intern(name.value)
+      if isinstance(node, ast.Field):
+        self._field(node)
+      elif isinstance(node, ast.Function):
+        node.type = self.type(node.type)
+        for field in node.throws:
+          self._field(field)
+      elif isinstance(node, (ast.Typedef, ast.Const)):
+        node.type = self.type(node.type)
+    return thrift
@@ -1,12 +1,16 @@
-from . import constants
+import re
+from array import array
+from sys import intern
 
-import ply.lex as lex
+from . import constants
 
 
-__all__ = ('Lexer', 'Literal', 'Identifier',)
+__all__ = ('Lexer', 'Literal', 'Identifier', 'Scanner', 'ScannerLexer', 'Token', 'TokenStream')
 
 
 class Literal(object):
+  __slots__ = ('value',)
+
   def __init__(self, value):
     self.value = value
 
@@ -15,6 +19,8 @@ class Literal(object):
 
 
 class Identifier(object):
+  __slots__ = ('value',)
+
   def __init__(self, value):
     self.value = value
 
@@ -84,5 +90,269 @@ class Lexer(object):
   def t_error(self, t):
     raise self.Error('Failed to lex: %s' % t)
 
+  # Master lexer whose compiled regex is shared by every lexer handed out by shared().
+  _MASTER = None
+
   def build(self, **kwargs):
+    import ply.lex as lex
     return lex.lex(module=self, **kwargs)
+
+  @classmethod
+  def shared(cls):
+    """Return a fresh lexer cloned from a master built once per process."""
+    if cls._MASTER is None:
+      cls._MASTER = cls().build()
+    return cls._MASTER.clone()
+
+
+class Token(object):
+  """A token in the shape PLY's parser expects from a lexer, as returned by ScannerLexer."""
+
+  __slots__ = ('type', 'value', 'lineno', 'lexpos', 'lexer')
+
+  def __init__(self, type, value, lineno, lexpos):
+    self.type = type
+    self.value = value
+    self.lineno = lineno
+    self.lexpos = lexpos
+
+  def __str__(self):
+    return 'LexToken(%s,%r,%d,%d)' % (self.type, self.value, self.lineno, self.lexpos)
+
+  __repr__ = __str__
+
+
+class TokenStream(object):
+  """The tokens of one input, stored column-wise.
+
+  kinds holds an index into Scanner.TYPES per token, linenos, starts and ends its line and the
+  offsets of its first and one past its last character; values holds the token values.  If the
+  input failed to lex, error is the Lexer.Error to raise once the consumer reaches the bad token,
+  so that errors surface in the same order as with a lazy lexer.  lineno is the line number at the
+  end of the input and length the length of the input.
+  """
+
+  __slots__ = ('kinds', 'values', 'linenos', 'starts', 'ends', 'error', 'lineno', 'length')
+
+  def __init__(self, length):
+    self.kinds = array('B')
+    self.values = []
+    self.linenos = array('l')
+    self.starts = array('l')
+    self.ends = array('l')
+    self.error = None
+    self.lineno = 1
+    self.length = length
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def token(self, index):
+    """Return token index as a (type, value, lineno, lexpos, endpos) tuple."""
+    return (Scanner.TYPES[self.kinds[index]], self.values[index], self.linenos[index],
+            self.starts[index], self.ends[index])
+
+
+def _keywords(codes):
+  # Later entries win, matching the order of the checks in Lexer.t_IDENTIFIER.
+  keywords = dict((word, None) for word in Lexer.RESERVED_DISALLOW)
+  keywords.update((word, (codes['INTCONSTANT'], int(word == 'true'))) for word in constants.BOOL)
+  keywords.update((word, (codes[word.upper()], word)) for word in Lexer.RESERVED)
+  return keywords
+
+
+class Scanner(object):
+  """A PLY-free, single-pass tokenizer producing exactly the tokens of Lexer.
+
+  One master regex matches whitespace, comments, doc text and every token, keywords are found with a
+  single dict lookup, and identifiers are interned: every occurrence of a name shares one string and
+  one Identifier, kept in the names table, which may be shared between scanners.
+
+  tokenize() scans the whole input into a TokenStream; token() hands the tokens out one at a time as
+  (type, value, lineno, lexpos, endpos) tuples, endpos being where PLY's lexer would leave lexpos
+  after returning the token.  Line numbers follow PLY's: only newlines outside of comments count.
+
+  data may also be UTF-8 encoded bytes or any buffer the re module can scan, such as an mmap.  The
+  buffer is then scanned in place and only the text of names and literals is decoded; positions are
+  byte offsets into the buffer.
+  """
+
+  TYPES = tuple(Lexer.tokens) + tuple(Lexer.literals)
+  CODES = dict((kind, code) for code, kind in enumerate(TYPES))
+
+  # Identifier text -> (type code, value) for reserved words and booleans, or None for disallowed
+  # words.
+  KEYWORDS = _keywords(CODES)
+
+  # The same for identifiers read from bytes.
+  BYTE_KEYWORDS = dict((word.encode('ascii'), value) for word, value in KEYWORDS.items())
+
+  # The master regexes for text and for bytes.  Lexer's rules keep the order PLY tries them in:
+  # function rules by definition order, then string rules by decreasing pattern length.  Ignored
+  # characters and newlines can not start any other rule, so they are matched first, and literals
+  # are only tried when no rule matches, as in PLY.
+  _MASTERS = {}
+
+  @classmethod
+  def master(cls, binary=False):
+    if binary not in cls._MASTERS:
+      functions, strings = [], []
+      blanks = re.escape(Lexer.t_ignore)
+      for name in sorted(dir(Lexer)):
+        rule = getattr(Lexer, name)
+        if not name.startswith('t_') or name in ('t_ignore', 't_error', 't_newline'):
+          continue
+        if isinstance(rule, str):
+          strings.append((name[2:], rule))
+        else:
+          functions.append((rule.__code__.co_firstlineno, name[2:], rule.__doc__))
+      rules = [('newline', r'\n[%s\n]*' % blanks), ('end', r'\Z')]
+      rules.extend((name, regex) for _, name, regex in sorted(functions))
+      rules.extend(sorted(strings, key=lambda rule: len(rule[1]), reverse=True))
+      rules.append(('literal', '[%s]' % re.escape(''.join(Lexer.literals))))
+      pattern = '[%s]*(?:%s)' % (blanks, '|'.join('(?P<%s>%s)' % rule for rule in rules))
+      cls._MASTERS[binary] = re.compile(
+          pattern.encode('ascii') if binary else pattern, re.VERBOSE)
+    return cls._MASTERS[binary]
+
+  def __init__(self, data, names=None):
+    """data is a str, bytes-like object or a TokenStream already scanned from one."""
+    self.data = data
+    self.names = {} if names is None else names
+    self.lexpos = 0
+    self.lineno = 1
+    self._stream = data if isinstance(data, TokenStream) else None
+    self._index = 0
+
+  def tokenize(self):
+    """Scan the whole input and return its TokenStream."""
+    data, names, codes = self.data, self.names, self.CODES
+    text = isinstance(data, str)
+    match = self.master(not text).match
+    keywords = self.KEYWORDS if text else self.BYTE_KEYWORDS
+    newline = '\n' if text else b'\n'
+    stream = TokenStream(len(data))
+    kinds, values, linenos, starts, ends = (
+        stream.kinds.append, stream.values.append, stream.linenos.append, stream.starts.append,
+        stream.ends.append)
+    identifier = codes['IDENTIFIER']
+    pos, lineno, length = 0, 1, len(data)
+    while pos < length:
+      m = match(data, pos)
+      if m is None:
+        rest = data[pos:].lstrip(Lexer.t_ignore if text else Lexer.t_ignore.encode('ascii'))
+        pos = length - len(rest)
+        if not text:
+          rest = rest.decode('utf-8', 'replace')
+        stream.error = Lexer.Error('Failed to lex: LexToken(error,%r,%d,%d)' % (rest, lineno, pos))
+        break
+      rule, end = m.lastgroup, m.end()
+      if rule == 'newline':
+        lineno += m.group(rule).count(newline)
+        pos = end
+        continue
+      start = m.start(rule)
+      if rule == 'IDENTIFIER':
+        word = data[start:end]
+        keyword = keywords.get(word, False)
+        if keyword is False:
+          # Names are keyed by the scanned text, so bytes are only decoded once per name.
+          value = names.get(word)
+          if value is None:
+            value = names[word] = Identifier(intern(word if text else word.decode('ascii')))
+          kind = identifier
+        elif keyword is None:
+          stream.error = Lexer.Error(
+              'Found invalid reserved word: %s' % (word if text else word.decode('ascii')))
+          break
+        else:
+          kind, value = keyword
+      elif rule == 'literal':
+        value = data[start] if text else chr(data[start])
+        kind = codes[value]
+      elif rule.startswith('ignore_') or rule == 'end':
+        pos = end
+        continue
+      else:
+        kind, value = self.convert(
+            rule, data[start:end] if text else data[start:end].decode('utf-8'))
+        kind = codes[kind]
+      kinds(kind)
+      values(value)
+      linenos(lineno)
+      starts(start)
+      ends(end)
+      pos = end
+    stream.lineno = lineno
+    return stream
+
+  def token(self):
+    """Return the next token, or None at the end of the input."""
+    if self._stream is None:
+      self._stream = self.tokenize()
+    stream, index = self._stream, self._index
+    if index == len(stream):
+      if stream.error is not None:
+        raise stream.error
+      self.lexpos, self.lineno = stream.length, stream.lineno
+      return None
+    token = stream.token(index)
+    self._index = index + 1
+    self.lineno, self.lexpos = token[2], token[4]
+    return token
+
+  @classmethod
+  def convert(cls, rule, text):
+    """Convert the text matched by rule to a (type, value) pair as Lexer's t_ functions would."""
+    if rule == 'IDENTIFIER':
+      if text in Lexer.RESERVED:
+        return text.upper(), text
+      elif text in Lexer.RESERVED_DISALLOW:
+        raise Lexer.Error('Found invalid reserved word: %s' % text)
+      elif text in constants.BOOL:
+        return 'INTCONSTANT', 1 if text == 'true' else 0
+      return rule, Identifier(text)
+    elif rule == 'LITERAL':
+      return rule, Literal(text[1:-1])
+    elif rule == 'INTCONSTANT':
+      return rule, int(text)
+    elif rule == 'DUBCONSTANT':
+      return rule, float(text)
+    elif rule == 'HEXCONSTANT':
+      return 'INTCONSTANT', int(text, 16)
+    return rule, text
+
+
+class ScannerLexer(object):
+  """Feeds a Scanner's tokens to PLY's parser through the lexer interface PLY expects.
+
+  PLY reads lineno and lexpos off the lexer to place empty productions; they are kept exactly as
+  PLY's own lexer would leave them.
+  """
+
+  def __init__(self, names=None):
+    self.names = names
+    self.lineno = 1
+    self.lexpos = 0
+    self._stream = None
+    self._index = 0
+
+  def input(self, data):
+    self._stream = data if isinstance(data, TokenStream) else Scanner(data, self.names).tokenize()
+    self._index = 0
+    self.lineno = 1
+    self.lexpos = 0
+
+  def token(self):
+    stream, index = self._stream, self._index
+    if index == len(stream):
+      if stream.error is not None:
+        raise stream.error
+      # PLY's lexer leaves lexpos one past the end of the input once it runs out of tokens.
+      self.lineno, self.lexpos = stream.lineno, stream.length + 1
+      return None
+    self._index = index + 1
+    self.lineno = lineno = stream.linenos[index]
+    self.lexpos = stream.ends[index]
+    return Token(Scanner.TYPES[stream.kinds[index]], stream.values[index], lineno,
+                 stream.starts[index])
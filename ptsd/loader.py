@@ -1,15 +1,20 @@
-from __future__ import print_function
-
 from collections import defaultdict
+import mmap
 import os
+import time
 
 from . import ast
-from .parser import Parser
+from .emitter import emit
+from .interner import Interner
+from .lexer import Scanner
 
 
 class SymbolTable(dict):
+  TYPES = (ast.Typedef, ast.Enum, ast.EnumDef, ast.Const, ast.Struct, ast.Exception_, ast.Service)
+
   def __init__(self, thrift):
-    for parent, node in thrift.walk():
+    # Only enums have symbols below the top level.
+    for parent, node in thrift.walk(self.TYPES, prune=lambda node: not isinstance(node, ast.Enum)):
       if isinstance(node, ast.Typedef):
         self[node.name.value] = node.type
       elif isinstance(node, ast.Enum):
@@ -26,17 +31,353 @@ class SymbolTable(dict):
         self[node.name.value] = node
 
 
+class SymbolIndex(object):
+  """A flat index over the symbol tables of a set of modules, with reference chains resolved.
+
+  Every name of every module is resolved once, following typedef and const references through
+  other modules exactly as Loader.find does, so that find() and lookup() are dict hits.  Cyclic
+  references resolve to an error instead of recursing forever.
+
+  error is the LookupError subclass to raise for names that do not resolve.
+  """
+
+  def __init__(self, modules, error=LookupError):
+    self.modules = modules
+    self.Error = error
+    self._resolved = {}  # (module, name) -> value, or the error resolving it raised
+    self._resolving = set()
+    for module, table in modules.items():
+      for name in table:
+        self._entry(module, name, raising=False)
+    self._names = self._global_names()
+
+  def _entry(self, module, name, raising=True):
+    key = (module, name)
+    try:
+      result = self._resolved[key]
+    except KeyError:
+      result = self.modules[module][name]
+      if isinstance(result, ast.Identifier):
+        if key in self._resolving:
+          result = self.Error('Cyclic reference to %s from %s' % (name, module))
+        else:
+          self._resolving.add(key)
+          try:
+            result = self.find(result.value, module)
+          except self.Error as e:
+            result = e
+          finally:
+            self._resolving.discard(key)
+      self._resolved[key] = result
+    if raising and isinstance(result, self.Error):
+      raise self.Error(*result.args)
+    return result
+
+  def find(self, name, module):
+    """Return the resolved value of name as seen from module, like Loader.find."""
+    while True:
+      table = self.modules.get(module)
+      if table is None:
+        raise self.Error('Unknown module %s' % module)
+      if table.get(name) is not None:
+        return self._entry(module, name)
+      # Not found, is it prefixed by a module name?
+      if '.' not in name:
+        raise self.Error('Could not resolve %s from %s' % (name, module))
+      module, name = name.split('.', 1)
+
+  def _global_names(self):
+    """Map the names lookup() is asked for without a module to their values.
+
+    Loader.lookup tries the modules in order and returns the first that resolves the name: either
+    one of its own symbols or, for a dotted name it does not define, the name read as
+    module.symbol.  The latter answer is the same from every module, so it is computed once.
+    """
+    qualified = {}
+    for module, table in self.modules.items():
+      for name in table:
+        dotted = '%s.%s' % (module, name)
+        prefix, rest = dotted.split('.', 1)
+        try:
+          qualified[dotted] = self.find(rest, prefix)
+        except self.Error:
+          pass
+    names = {}
+    for module, table in self.modules.items():
+      for name in table:
+        if name not in names:
+          value = self._entry(module, name, raising=False)
+          if not isinstance(value, self.Error):
+            names[name] = value
+      # Only the first modules see any of these: a name is settled by the first module lacking it.
+      for dotted in list(qualified):
+        if table.get(dotted) is None:
+          names.setdefault(dotted, qualified.pop(dotted))
+        elif dotted in names:
+          del qualified[dotted]
+    return names
+
+  def lookup(self, name):
+    """Return what Loader.lookup(name) returns: the first resolution of name from any module."""
+    try:
+      return self._names[name]
+    except KeyError:
+      pass
+    # Dotted names may still resolve through a chain of module prefixes.
+    if '.' in name:
+      for module in self.modules:
+        try:
+          return self.find(name, module)
+        except self.Error:
+          continue
+    return None
+
+
+_WORKER_PARSER = None
+
+
+def _init_worker(factory, track_positions):
+  global _WORKER_PARSER
+  _WORKER_PARSER = factory(track_positions=track_positions)
+
+
+def _parse_source(data):
+  """Parse data in a pool worker, returning None on any failure.
+
+  Failures are not reported from here: the loader re-processes the file sequentially, which raises
+  the error exactly as a non-parallel load would.
+  """
+  try:
+    return _WORKER_PARSER.parse(data)
+  except Exception:
+    return None
+
+
+class Shared(object):
+  """What many loads can share: their parsers, and the files they loaded.
+
+  Pass the same instance as Loader(..., shared=shared) to every load of a batch: each parser is
+  built once, and each file parsed once however many roots include it.  Files are assumed not to
+  change while the instance is in use.
+  """
+
+  def __init__(self):
+    self.parsers = {}  # (backend, track_positions) -> parser
+    self.files = {}  # (cache variant, real path) -> (stat, thrift, symbols)
+    self.setup_seconds = 0.0  # time spent building the parsers
+
+
 class Loader(object):
   class Error(Exception): pass
   class LookupError(Error): pass
 
-  def __init__(self, filename, logger=print):
+  def __init__(self, filename, logger=print, parser=None, workers=None, cache=None,
+               track_positions=True, backend='ply', intern=False, use_mmap=False, stats=None,
+               shared=None):
     self.root = filename
     self.logger = logger
     self.thrifts = {}
     self.modules = {}
-    self.parser = Parser()
-    self.process(self.root)
+    self.backend = backend
+    self.stats = stats
+    self.shared = shared
+    # Parsers built here read Scanner tokens, so profiling can time lexing apart from parsing.
+    self._tokenize = parser is None
+    # Built on first use: loads served entirely from the cache never build one.
+    self._parser = parser
+    self.setup_seconds = 0.0  # time spent building the parser
+    self.track_positions = track_positions if parser is None else parser.track_positions
+    self.cache = cache
+    self.interner = Interner() if intern else None
+    self.use_mmap = use_mmap
+    variant = []
+    if not self.track_positions:
+      variant.append('nopos')
+    elif use_mmap:
+      variant.append('bytes')  # spans are byte offsets
+    if intern:
+      variant.append('intern')
+    self._cache_variant = '-'.join(variant)
+    self._prefetched = {}
+    self._reusable = {}
+    self._stats = {}
+    self._symbols = {}
+    self._index = None
+    self._depth = 0
+    try:
+      if workers and workers > 1:
+        self.prefetch(self.root, workers)
+      self.process(self.root)
+    finally:
+      self._release()
+
+  @property
+  def parser(self):
+    if self._parser is None:
+      key = (self.backend, self.track_positions)
+      if self.shared is not None and key in self.shared.parsers:
+        self._parser = self.shared.parsers[key]
+        return self._parser
+      start = time.perf_counter()
+      # Imported here, with the rest of the parser setup, so cached loads never import it.
+      from .parser import parser_class
+      self._parser = parser_class(self.backend)(track_positions=self.track_positions)
+      self.setup_seconds = time.perf_counter() - start
+      if self.stats is not None:
+        self.stats.add('setup', self.setup_seconds)
+      if self.shared is not None:
+        self.shared.parsers[key] = self._parser
+        self.shared.setup_seconds += self.setup_seconds
+    return self._parser
+
+  @classmethod
+  def _timed(cls, record, phase, function, *args, **kwargs):
+    """Call function, adding the time it took to phase of record, a Stats or FileStats, if any."""
+    if record is None:
+      return function(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      record.add(phase, time.perf_counter() - start)
+
+  @classmethod
+  def include_paths(cls, real_root, thrift):
+    for include in thrift.includes:
+      yield os.path.realpath(os.path.join(os.path.dirname(real_root), include.path.value))
+
+  def prefetch(self, root, workers):
+    """Parse root and its include closure across a pool of worker processes.
+
+    The include graph is explored breadth-first, parsing each level in parallel.  The trees are
+    only staged here; process() still assembles them depth-first, so the resulting thrifts and
+    modules are the same as those of a sequential load.
+    """
+    import multiprocessing
+
+    # Workers build parsers like the one given, if any: of its class, or of a pool's factory.
+    if self._parser is not None:
+      factory = getattr(self._parser, 'factory', type(self._parser))
+    else:
+      from .parser import parser_class
+      factory = parser_class(self.backend)
+    seen = set()
+    frontier = [os.path.realpath(root)]
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=(factory, self.track_positions))
+    try:
+      while frontier:
+        seen.update(frontier)
+        pending = []
+        for real_path in frontier:
+          if self.shared is not None and (self._cache_variant, real_path) in self.shared.files:
+            continue  # loaded before, with its includes
+          record = self.stats and self.stats.file(real_path)
+          try:
+            data = self._timed(record, 'read', self.read, real_path)
+          except (IOError, OSError):
+            continue
+          cached = self._cached(record, data)
+          if cached is not None:
+            self._prefetched[real_path] = (data,) + cached
+          else:
+            pending.append((real_path, data))
+        # Mapped sources can not be pickled, so workers are sent a copy.
+        parsed = self._timed(self.stats, 'prefetch', pool.map, _parse_source, [
+            data[:] if isinstance(data, mmap.mmap) else data for _, data in pending])
+        for (real_path, data), thrift in zip(pending, parsed):
+          if thrift is not None:
+            self._prefetched[real_path] = (data, thrift, None)
+        next_frontier = []
+        for real_path in frontier:
+          if real_path not in self._prefetched:
+            continue
+          for include_path in self.include_paths(real_path, self._prefetched[real_path][1]):
+            if include_path not in seen and include_path not in self.thrifts:
+              seen.add(include_path)
+              next_frontier.append(include_path)
+        frontier = next_frontier
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def _release(self):
+    """Close the mapped sources prefetched but never loaded."""
+    for data, _, _ in self._prefetched.values():
+      if isinstance(data, mmap.mmap):
+        data.close()
+    self._prefetched.clear()
+
+  @classmethod
+  def stat(cls, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return (st.st_mtime, st.st_size)
+
+  def read(self, real_root):
+    """Return the source of real_root: its text, or a read-only mmap of it if self.use_mmap is set.
+
+    Mapped sources are scanned in place, so a file is never decoded or copied as a whole.
+    """
+    self._stats[real_root] = self.stat(real_root)
+    if self.use_mmap:
+      with open(real_root, 'rb') as fp:
+        try:
+          return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+          return b''  # empty files can not be mapped
+    with open(real_root) as fp:
+      return fp.read()
+
+  def _cached(self, record, data):
+    """Return the cached (thrift, symbols) of data, or None."""
+    if self.cache is None:
+      return None
+    cached = self._timed(record, 'cache', self.cache.get, data, self._cache_variant)
+    if record is not None:
+      record.cache_hit = cached is not None
+    return cached
+
+  def _parse(self, record, data):
+    if record is None:
+      return self.parser.parse(data)
+    if self._tokenize:
+      tokens = self._timed(record, 'lex', Scanner(data).tokenize)
+      record.tokens = len(tokens)
+      data = tokens
+    thrift = self._timed(record, 'parse', self.parser.parse, data)
+    record.nodes.update(type(node).__name__ for _, node in thrift.walk())
+    return thrift
+
+  def load(self, real_root):
+    """Return the thrift and symbol table of real_root, from the prefetch, the cache or a parse."""
+    record = self.stats and self.stats.file(real_root)
+    data, thrift, symbols = self._prefetched.pop(real_root, (None, None, None))
+    if data is None:
+      data = self._timed(record, 'read', self.read, real_root)
+      thrift, symbols = self._cached(record, data) or (None, None)
+    if record is not None:
+      record.depth, record.bytes = self._depth, len(data)
+      record.source = 'parse' if thrift is None else 'cache' if record.cache_hit else 'prefetch'
+    try:
+      if thrift is None:
+        thrift = self._parse(record, data)
+      if self.interner is not None:
+        self._timed(record, 'intern', self.interner.intern, thrift)
+      if symbols is None:
+        symbols = self._timed(record, 'symbols', SymbolTable, thrift)
+        if self.cache is not None:
+          self._timed(record, 'cache', self.cache.put, data, (thrift, symbols), self._cache_variant)
+      elif self.interner is not None:
+        # The typedef entries of a cached table must point at the interned types.
+        symbols = self._timed(record, 'symbols', SymbolTable, thrift)
+    finally:
+      if isinstance(data, mmap.mmap):
+        data.close()
+    return thrift, symbols
 
   def process(self, root):
     real_root = os.path.realpath(root)
@@ -44,27 +385,107 @@ class Loader(object):
     if real_root in self.thrifts:
       return
 
-    self.logger('Processing %s' % real_root)
-
-    with open(real_root) as fp:
-      parent = self.thrifts[real_root] = self.parser.parse(fp.read())
+    if real_root in self._reusable:
+      self._stats[real_root], parent, symbols = self._reusable.pop(real_root)
+      if self.stats is not None:
+        self.stats.file(real_root, self._depth).source = 'reused'
+    elif self.shared is not None and (self._cache_variant, real_root) in self.shared.files:
+      self._stats[real_root], parent, symbols = self.shared.files[self._cache_variant, real_root]
+      if self.stats is not None:
+        self.stats.file(real_root, self._depth).source = 'shared'
+    else:
+      self.logger('Processing %s' % real_root)
+      parent, symbols = self.load(real_root)
+      if self.shared is not None:
+        self.shared.files[self._cache_variant, real_root] = (
+            self._stats[real_root], parent, symbols)
+    self.thrifts[real_root] = parent
+    self._symbols[real_root] = symbols
+    self.invalidate()
 
     parent_name = os.path.basename(real_root)
     parent_name, _ = os.path.splitext(parent_name)
     if parent_name in self.modules:
       self.logger('Warning: ambiguous include (module %s already exists)' % parent_name)
-    self.modules[parent_name] = SymbolTable(parent)
+    self.modules[parent_name] = symbols
+
+    self._depth += 1
+    try:
+      for include_path in self.include_paths(real_root, parent):
+        self.process(include_path)
+    finally:
+      self._depth -= 1
+
+  def refresh(self):
+    """Reparse the files that changed on disk since they were loaded.
 
-    for include in parent.includes:
-      real_path = os.path.join(os.path.dirname(real_root), include.path.value)
-      self.process(real_path)
+    A file counts as changed when its mtime or size differs.  Unchanged files keep their trees and
+    symbol tables, and the include graph is re-walked from the root to pick up includes that were
+    added or removed.  Returns the sorted names of the modules that were added, removed or rebuilt.
+    """
+    saved = (self.thrifts, self.modules, self._stats, self._symbols)
+    self._reusable = dict(
+        (path, (self._stats[path], thrift, self._symbols[path]))
+        for path, thrift in self.thrifts.items()
+        if self.stat(path) == self._stats.get(path))
+    self.thrifts, self.modules, self._stats, self._symbols = {}, {}, {}, {}
+    self.invalidate()
+    try:
+      self.process(self.root)
+    except Exception:
+      self.thrifts, self.modules, self._stats, self._symbols = saved
+      self.invalidate()
+      raise
+    finally:
+      self._reusable = {}
+    modules = saved[1]
+    return sorted(name for name in set(modules) | set(self.modules)
+                  if modules.get(name) is not self.modules.get(name))
 
-  def dump(self):
+  def dump(self, fp=None, directory=None):
+    """Render every loaded thrift as IDL.
+
+    By default each one is passed to the logger.  With fp they are streamed to fp in the same
+    format instead, and with directory each is written to a file of its own there, at its path
+    relative to the directory containing all loaded files; the paths written are returned.
+    """
+    if directory is not None:
+      base = os.path.commonpath([os.path.dirname(filename) for filename in self.thrifts])
+      written = []
+      for filename, thrift in self.thrifts.items():
+        path = os.path.join(directory, os.path.relpath(filename, base))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as output:
+          emit(thrift, output)
+          output.write('\n')
+        written.append(path)
+      return written
     for filename, thrift in self.thrifts.items():
-      self.logger('Dumping %s\n' % filename)
-      self.logger('%s\n\n' % thrift)
+      if fp is None:
+        self.logger('Dumping %s\n' % filename)
+        self.logger('%s\n\n' % thrift)
+      else:
+        fp.write('Dumping %s\n\n' % filename)
+        emit(thrift, fp)
+        fp.write('\n\n\n')
+
+  def invalidate(self):
+    """Drop the symbol index; called whenever the set of modules changes.
+
+    Callers that modify modules or their symbol tables directly must call this as well.
+    """
+    self._index = None
+
+  def index(self):
+    """Return the SymbolIndex of the loaded modules, building it on first use."""
+    if self._index is None:
+      self._index = SymbolIndex(self.modules, self.LookupError)
+    return self._index
 
   def find(self, name, module, recursive=True):
+    if recursive:
+      return self.index().find(name, module)
+
     if module not in self.modules:
       raise self.LookupError('Unknown module %s' % module)
 
@@ -77,16 +498,9 @@ class Loader(object):
       prefix, name = name.split('.', 1)
       return self.find(name, prefix)
 
-    if isinstance(value, ast.Identifier) and recursive:
-      return self.find(value.value, module, recursive)
-
     return value
 
   def lookup(self, name, module=None):
     if module:
       return self.find(name, module)
-    for module_name in self.modules:
-      try:
-        return self.find(name, module_name)
-      except self.LookupError:
-        continue
+    return self.index().lookup(name)
@@ -33,12 +33,19 @@ from .ast import (
     Namespace,
     Thrift
 )
+from .cache import (
+    default_cache_dir,
+    read_pickle,
+    write_pickle
+)
 from .lexer import (
     Lexer,
+    ScannerLexer,
     Identifier as LexerIdentifier
 )
 
-import ply.yacc as yacc
+from collections import deque
+import os
 
 
 class Parser(object):
@@ -66,9 +73,15 @@ class Parser(object):
       p[0] = '%s(%s)' % (name, p[0])
 
   @classmethod
-  def default_list_action(cls, p):
+  def default_list_action(cls, p, sink=None):
+    # Appends in place: the list in p[1] is only referenced from the parser stack.  With a sink the
+    # items are passed on instead of accumulated.
     if len(p) == 3:
-      p[0] = (p[1] if p[1] else []) + [p[2]]
+      p[0] = p[1]
+      if sink is None:
+        p[0].append(p[2])
+      else:
+        sink(p[2])
     else:
       p[0] = []
 
@@ -83,7 +96,7 @@ class Parser(object):
   def p_header_list(self, p):
     '''header_list : header_list header
                    | empty'''
-    self.default_list_action(p)
+    self.default_list_action(p, self._sink)
 
   def p_header(self, p):
     '''header : include
@@ -114,7 +127,7 @@ class Parser(object):
   def p_definition_list(self, p):
     '''definition_list : definition_list definition
                        | empty'''
-    self.default_list_action(p)
+    self.default_list_action(p, self._sink)
 
   def p_definition(self, p):
     '''definition : const
@@ -323,8 +336,11 @@ class Parser(object):
 
   def p_base_type(self, p):
     '''base_type : simple_base_type type_annotations'''
-    p[0] = p[1]
-    p[0].add_annotations(p[2])
+    if p[2]:
+      p[0] = p[1](p, 1)
+      p[0].add_annotations(p[2])
+    else:
+      p[0] = p[1].shared()
 
   def p_simple_base_type(self, p):
     '''simple_base_type : STRING
@@ -336,7 +352,7 @@ class Parser(object):
                         | I32
                         | I64
                         | DOUBLE'''
-    p[0] = self.BASIC_TYPES[p[1]](p)
+    p[0] = self.BASIC_TYPES[p[1]]
 
   def p_container_type(self, p):
     '''container_type : simple_container_type type_annotations'''
@@ -383,9 +399,179 @@ class Parser(object):
   def p_error(self, p):
     raise self.Error('Parse error: %s' % p)
 
-  def __init__(self):
-    self._lex = Lexer().build()
-    self._yacc = yacc.yacc(module=self, write_tables=False, debug=False)
+  # LALR tables shared by every Parser in this process: (action, goto, productions).
+  _TABLES = None
+
+  @classmethod
+  def grammar_signature(cls):
+    """A hash of the grammar: the start symbol, the tokens and every production."""
+    import hashlib
+    digest = hashlib.sha1()
+    for part in (cls.start, ' '.join(cls.tokens)):
+      digest.update(part.encode('utf-8'))
+    for name in sorted(dir(cls)):
+      if name.startswith('p_') and name != 'p_error':
+        digest.update(('%s:%s' % (name, getattr(cls, name).__doc__)).encode('utf-8'))
+    return digest.hexdigest()
+
+  @classmethod
+  def table_signature(cls):
+    """A hash of everything the LALR tables are derived from: the grammar and the PLY version."""
+    import hashlib
+    import ply
+    import ply.yacc as yacc
+    return hashlib.sha1(('%s:%s:%s' % (
+        ply.__version__, yacc.__tabversion__, cls.grammar_signature())).encode('utf-8')).hexdigest()
+
+  @classmethod
+  def table_path(cls, cache_dir=None):
+    return os.path.join(
+        cache_dir or default_cache_dir(), 'parsetab-%s.pickle' % cls.table_signature()[:16])
+
+  def _tables(self):
+    import ply.yacc as yacc
+    cls = type(self)
+    if cls._TABLES is None:
+      path, signature = cls.table_path(), cls.table_signature()
+      cached = read_pickle(path)
+      if cached and cached[0] == signature:
+        tables = cached[1]
+      else:
+        lr = yacc.yacc(module=self, write_tables=False, debug=False)
+        tables = (lr.action, lr.goto, [
+            (p.str, p.name, p.len, p.func, p.file, p.line) for p in lr.productions])
+        write_pickle(path, (signature, tables))
+      cls._TABLES = tables
+    return cls._TABLES
+
+  def _build_yacc(self):
+    import ply.yacc as yacc
+    action, goto, productions = self._tables()
+    lr = yacc.LRTable()
+    lr.lr_action, lr.lr_goto, lr.lr_method = action, goto, 'LALR'
+    lr.lr_productions = [yacc.MiniProduction(*p) for p in productions]
+    lr.bind_callables(dict((p.func, getattr(self, p.func)) for p in lr.lr_productions if p.func))
+    parser = yacc.LRParser(lr, self.p_error)
+    parser.track_positions = self.track_positions  # consulted by ast.Node
+    return parser
+
+  def __init__(self, track_positions=True, lexer=None):
+    """Create a parser.
+
+    With track_positions=False PLY's position tracking is skipped and nodes are built without
+    spans, which is noticeably faster for consumers that never look at positions.
+
+    Tokens come from a ScannerLexer, ptsd's own tokenizer, unless another lexer is given, for
+    instance Lexer.shared() for PLY's.
+    """
+    self.track_positions = track_positions
+    self._lex = ScannerLexer() if lexer is None else lexer
+    self._sink = None
+    self._yacc = self._build_yacc()
+
+  def parse(self, data):
+    self._lex.lineno = 1
+    return self._yacc.parse(data, lexer=self._lex, tracking=self.track_positions)
+
+  # How many parsed but not yet consumed items iterparse() buffers.
+  ITERPARSE_BUFFER = 64
+
+  class _Closed(Exception): pass
+
+  def iterparse(self, data):
+    """Parse data, yielding each header and top-level definition as soon as it is reduced.
+
+    Nothing is kept once yielded, so memory does not grow with the number of definitions.  The
+    tokens are not streamed, though: data is tokenized up front, into arrays far smaller than the
+    tree, so memory still grows with the size of data.  PLY's parser can not be suspended
+    mid-parse, so the parse runs in a helper thread that waits whenever ITERPARSE_BUFFER items are
+    pending.  Like parse(), this is not reentrant: the Parser must not be used again until the
+    generator is exhausted or closed.
+    """
+    import queue
+    import threading
+
+    items = queue.Queue(self.ITERPARSE_BUFFER)
+    closed = threading.Event()
+    done = object()
+
+    def sink(item):
+      if closed.is_set():
+        raise self._Closed()
+      items.put((None, item))
+
+    def run():
+      try:
+        self.parse(data)
+      except self._Closed:
+        pass
+      except Exception as e:
+        items.put((e, None))
+      finally:
+        self._sink = None
+        # Always the last item, whatever ended the parse.
+        items.put((None, done))
+
+    self._sink = sink
+    thread = threading.Thread(target=run, name='ptsd-iterparse')
+    thread.daemon = True
+    thread.start()
+    item = None
+    try:
+      while True:
+        error, item = items.get()
+        if error is not None:
+          raise error
+        if item is done:
+          return
+        yield item
+    finally:
+      if item is not done:
+        # Stop the parse at its next item, taking what it puts meanwhile so it can not block.
+        closed.set()
+        while items.get()[1] is not done:
+          pass
+      thread.join()
+
+
+BACKENDS = ('ply', 'descent')
+
+
+def parser_class(backend='ply'):
+  """Return the parser class implementing backend, one of BACKENDS.
+
+  'ply' is the table-driven PLY parser above.  'descent' is a hand-written recursive-descent parser
+  building the same trees, which does not need PLY at all.
+  """
+  if backend == 'ply':
+    return Parser
+  elif backend == 'descent':
+    from .descent import DescentParser
+    return DescentParser
+  raise ValueError('Unknown parser backend: %s' % backend)
+
+
+class ParserPool(object):
+  """A thread-safe pool of Parsers.
+
+  A Parser carries per-parse state (lexer position, LR stacks, the enum counter) and must not be
+  shared between threads.  The pool hands each concurrent parse() its own Parser, creating one only
+  when all existing ones are busy.  Parsers share their LALR tables, so growing the pool is cheap.
+  factory makes each Parser, given track_positions: Parser, or the class parser_class() returns
+  for another backend.
+  """
+
+  def __init__(self, factory=Parser, track_positions=True):
+    self.factory = factory
+    self.track_positions = track_positions
+    self._idle = deque()
 
   def parse(self, data):
-    return self._yacc.parse(data, lexer=self._lex, tracking=True)
+    try:
+      parser = self._idle.pop()
+    except IndexError:
+      parser = self.factory(track_positions=self.track_positions)
+    try:
+      return parser.parse(data)
+    finally:
+      self._idle.append(parser)
@@ -0,0 +1,235 @@
+"""Python types built at run time from the modules of a Loader."""
+
+from copy import deepcopy
+import keyword
+import os
+import sys
+import types
+
+from . import ast
+from .codec import Error, Resolver, _kind
+from .lexer import Literal
+
+
+# The Python types of the values of each base kind.
+PYTHON_TYPES = {
+  'bool': bool, 'byte': int, 'i16': int, 'i32': int, 'i64': int, 'double': float, 'string': str,
+  'binary': bytes, 'list': list, 'set': set, 'map': dict,
+}
+
+
+def attribute(name):
+  """Return the Python attribute name of a field named name."""
+  return name + '_' if keyword.iskeyword(name) else name
+
+
+def _free(name, taken):
+  """Return name, with underscores appended until it is not in taken, and add it to taken."""
+  while name in taken:
+    name += '_'
+  taken.add(name)
+  return name
+
+
+class Module(types.ModuleType):
+  """A module building the definitions of one Thrift module as they are looked up."""
+
+  def __init__(self, name, runtime, module):
+    super(Module, self).__init__(name)
+    self.__runtime = runtime
+    self.__module = module
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    value = self.__runtime.build(self.__module, name)
+    setattr(self, name, value)
+    return value
+
+  def __dir__(self):
+    return sorted(set(super(Module, self).__dir__()) | set(self.__runtime.names(self.__module)))
+
+  @property
+  def __all__(self):
+    return self.__runtime.names(self.__module)
+
+
+class Runtime(object):
+  """Python modules for the Thrift modules of a Loader, built lazily."""
+
+  def __init__(self, loader, package=None):
+    self.loader = loader
+    self.package = package
+    self.resolver = Resolver(loader, enums=True)
+    self._definitions = {}  # module -> {name: definition node}, filled on first use
+    self.modules = {}
+    for module in loader.modules:
+      self.modules[module] = Module(self._module_name(module), self, module)
+    self.root = None
+    if package is not None:
+      self.root = types.ModuleType(package)
+      self.root.__path__ = []
+      for module, value in self.modules.items():
+        setattr(self.root, module, value)
+
+  def _module_name(self, module):
+    return module if self.package is None else '%s.%s' % (self.package, module)
+
+  def install(self):
+    """Register the modules in sys.modules, under the package if there is one."""
+    if self.root is not None:
+      sys.modules[self.package] = self.root
+    for value in self.modules.values():
+      sys.modules[value.__name__] = value
+
+  def uninstall(self):
+    """Remove what install() registered from sys.modules."""
+    for value in self.modules.values():
+      if sys.modules.get(value.__name__) is value:
+        del sys.modules[value.__name__]
+    if self.root is not None and sys.modules.get(self.package) is self.root:
+      del sys.modules[self.package]
+
+  def definitions(self, module):
+    """Return the definitions of module that are built, by name."""
+    definitions = self._definitions.get(module)
+    if definitions is None:
+      definitions = self._definitions[module] = {}
+      for path, thrift in self.loader.thrifts.items():
+        if os.path.splitext(os.path.basename(path))[0] == module:
+          for node in thrift.body:
+            if not isinstance(node, (ast.Service, ast.Senum)):
+              definitions[node.name.value] = node
+    return definitions
+
+  def names(self, module):
+    return sorted(self.definitions(module))
+
+  def build(self, module, name):
+    """Return the Python value of definition name of module."""
+    node = self.definitions(module).get(name)
+    if node is None:
+      raise AttributeError('Thrift module %s has no definition %s' % (module, name))
+    if isinstance(node, (ast.Struct, ast.Exception_)):
+      return self.struct(module, node)
+    elif isinstance(node, ast.Enum):
+      return self.enum(module, node)
+    elif isinstance(node, ast.Const):
+      return self.value(node.value, self.resolver.spec(node.type, module), module)
+    return self.type(self.resolver.spec(node.type, module))
+
+  def type(self, spec):
+    """Return the Python type of the values of spec: a built class, or a Python type."""
+    if _kind(spec) in ('struct', 'enum'):
+      return getattr(self.modules[spec[1]], spec[2])
+    return PYTHON_TYPES[_kind(spec)]
+
+  def enum(self, module, node):
+    names = dict((value.name.value, value.tag) for value in node.values)
+    attributes = dict(names)
+    attributes.update({
+      '__slots__': (),
+      '__module__': self._module_name(module),
+      '_NAMES_TO_VALUES': names,
+      '_VALUES_TO_NAMES': dict((tag, name) for name, tag in names.items()),
+    })
+    return type(node.name.value, (object,), attributes)
+
+  def value(self, value, spec, module):
+    """Return the Python value of the const value, of type spec, written in module."""
+    kind = _kind(spec)
+    if isinstance(value, ast.Identifier):
+      try:
+        value = self.loader.find(value.value, module)
+      except self.loader.LookupError as e:
+        raise Error(str(e))
+      if isinstance(value, ast.Node):
+        raise Error('%s in %s is not a value' % (value, module))
+    if isinstance(value, Literal):
+      return value.value.encode('utf-8') if kind == 'binary' else value.value
+    elif isinstance(value, list) and kind in ('list', 'set'):
+      values = [self.value(item, spec[1], module) for item in value]
+      return set(values) if kind == 'set' else values
+    elif isinstance(value, dict) and kind == 'map':
+      return dict((self.value(key, spec[1], module), self.value(item, spec[2], module))
+                  for key, item in value.items())
+    elif isinstance(value, dict) and kind == 'struct':
+      fields = dict((field.name.value, field) for field in spec[3].fields)
+      arguments = {}
+      for key, item in value.items():
+        key = self.value(key, 'string', module)
+        if key not in fields:
+          raise Error('%s has no field %s' % (spec[2], key))
+        arguments[attribute(key)] = self.value(
+            item, self.resolver.spec(fields[key].type, spec[1]), spec[1])
+      return self.type(spec)(**arguments)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      if kind == 'bool':
+        return bool(value)
+      elif kind == 'double':
+        return float(value)
+      elif kind in ('byte', 'i16', 'i32', 'i64', 'enum') and isinstance(value, int):
+        return value
+    raise Error('Can not use %r as a %s in %s' % (value, kind, module))
+
+  def struct(self, module, node):
+    name = node.name.value
+    fields = [(attribute(field.name.value), field) for field in node.fields]
+    # Each class is built in a namespace of its own, where the names the generated code uses for
+    # itself differ from the class name and from the fields, which are parameters of __init__.
+    taken = set(field_name for field_name, _ in fields)
+    taken.add(name)
+    namespace = {}
+
+    def constant(value):
+      key = _free('_c%d' % len(namespace), taken)
+      namespace[key] = value
+      return key
+
+    this, copy = _free('self', taken), constant(deepcopy)
+    parameters, body = [], []
+    for field_name, field in fields:
+      spec = self.resolver.spec(field.type, module)
+      if field.const_value is None:
+        parameters.append('%s=None' % field_name)
+        body.append('    %s.%s = %s' % (this, field_name, field_name))
+        continue
+      default = self.value(field.const_value, spec, module)
+      if isinstance(default, (list, set, dict)) or _kind(spec) == 'struct':
+        # Each instance gets its own copy of a mutable default.
+        parameters.append('%s=None' % field_name)
+        body.append('    %s.%s = %s(%s) if %s is None else %s' % (
+            this, field_name, copy, constant(default), field_name, field_name))
+      else:
+        parameters.append('%s=%s' % (field_name, constant(default)))
+        body.append('    %s.%s = %s' % (this, field_name, field_name))
+    exception = isinstance(node, ast.Exception_)
+    lines = [
+      'class %s(%s):' % (name, 'Exception' if exception else 'object'),
+      '  __slots__ = (%s)' % ''.join('%r, ' % field_name for field_name, _ in fields),
+      '  __module__ = %r' % self._module_name(module),
+      '',
+      '  def __init__(%s%s):' % (this, ''.join(', ' + parameter for parameter in parameters)),
+    ]
+    lines.extend(body or ['    pass'])
+    lines.extend([
+      '',
+      '  def __eq__(self, other):',
+      '    if other.__class__ is not self.__class__:',
+      '      return NotImplemented',
+      '    return %s' % (' and '.join(
+          'self.%s == other.%s' % (field_name, field_name) for field_name, _ in fields) or 'True'),
+      '',
+      '  def __repr__(self):',
+      '    return %r %% (%s)' % (
+          '%s(%s)' % (name, ', '.join('%s=%%r' % field_name for field_name, _ in fields)),
+          ''.join('self.%s, ' % field_name for field_name, _ in fields)),
+    ])
+    if exception:
+      # Exceptions stay hashable, and print their fields.
+      lines.extend(['', '  __hash__ = Exception.__hash__', '  __str__ = __repr__'])
+    else:
+      lines.extend(['', '  __hash__ = None'])
+    exec(compile('\n'.join(lines), '<ptsd.runtime %s.%s>' % (module, name), 'exec'), namespace)
+    # Unbound again, so the methods look builtins such as NotImplemented up past a class so named.
+    return namespace.pop(name)
@@ -0,0 +1,117 @@
+from collections import Counter, OrderedDict
+import sys
+
+
+class FileStats(object):
+  """What loading one file cost.
+
+  source says where its tree came from: 'parse', 'cache', 'prefetch' (parsed by a worker),
+  'reused' (kept by Loader.refresh) or 'shared' (loaded before, through the same loader.Shared).
+  cache_hit is None when no cache was consulted.  timings maps each phase to seconds; tokens and
+  nodes are only counted for files that were parsed here.
+  """
+
+  def __init__(self, path, depth=0):
+    self.path = path
+    self.depth = depth
+    self.source = None
+    self.cache_hit = None
+    self.bytes = 0
+    self.tokens = 0
+    self.nodes = Counter()
+    self.timings = OrderedDict()
+
+  def add(self, phase, seconds):
+    self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+  @property
+  def total(self):
+    return sum(self.timings.values())
+
+  def as_dict(self):
+    return {
+      'path': self.path,
+      'depth': self.depth,
+      'source': self.source,
+      'cache_hit': self.cache_hit,
+      'bytes': self.bytes,
+      'tokens': self.tokens,
+      'nodes': dict(self.nodes),
+      'timings': dict(self.timings),
+    }
+
+
+class Stats(object):
+  """Collects where the time of a Loader goes, per file and per phase.
+
+  Pass an instance as Loader(..., stats=stats).  The phases are 'setup' (building the parser) and
+  'prefetch' (waiting on the worker processes) for the whole load, and 'read', 'cache', 'lex',
+  'parse', 'intern' and 'symbols' per file.
+  Subclasses can override file() or FileStats.add to forward the measurements elsewhere.
+  """
+
+  def __init__(self):
+    self.files = OrderedDict()
+    self.timings = OrderedDict()
+
+  @property
+  def cache_hits(self):
+    return sum(record.cache_hit is True for record in self.files.values())
+
+  @property
+  def cache_misses(self):
+    return sum(record.cache_hit is False for record in self.files.values())
+
+  def add(self, phase, seconds):
+    self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+  def file(self, path, depth=0):
+    """Return the FileStats of path, creating it on first use."""
+    record = self.files.get(path)
+    if record is None:
+      record = self.files[path] = FileStats(path, depth)
+    return record
+
+  def phases(self):
+    """Return (phase, seconds) for every phase, summed over files, most expensive first."""
+    totals = Counter(self.timings)
+    for record in self.files.values():
+      totals.update(record.timings)
+    return totals.most_common()
+
+  def nodes(self):
+    totals = Counter()
+    for record in self.files.values():
+      totals.update(record.nodes)
+    return totals
+
+  def as_dict(self):
+    return {
+      'timings': dict(self.timings),
+      'phases': dict(self.phases()),
+      'cache_hits': self.cache_hits,
+      'cache_misses': self.cache_misses,
+      'files': [record.as_dict() for record in self.files.values()],
+    }
+
+  def report(self, fp=None, limit=10):
+    """Print a breakdown of the load, most expensive phases and files first."""
+    fp = fp or sys.stdout
+    phases = self.phases()
+    total = sum(seconds for _, seconds in phases) or 1.0
+    print('phase        time    share', file=fp)
+    for phase, seconds in phases:
+      print('%-9s %8.1fms %6.1f%%' % (phase, 1000 * seconds, 100 * seconds / total), file=fp)
+    records = sorted(self.files.values(), key=lambda record: record.total, reverse=True)
+    print('\n%d files, %d tokens, max include depth %d, cache %d hits / %d misses' % (
+        len(records), sum(record.tokens for record in records),
+        max([record.depth for record in records] or [0]), self.cache_hits, self.cache_misses),
+        file=fp)
+    for record in records[:limit]:
+      print('%8.1fms  %-8s depth %-2d %7d tokens  %s  (%s)' % (
+          1000 * record.total, record.source, record.depth, record.tokens, record.path,
+          ', '.join('%s %.1fms' % (phase, 1000 * seconds)
+                    for phase, seconds in record.timings.items())), file=fp)
+    nodes = self.nodes()
+    if nodes:
+      print('\nnodes: %s' % ', '.join('%s %d' % pair for pair in nodes.most_common()), file=fp)
@@ -0,0 +1,375 @@
+"""Validation of dict payloads against the structs of a Loader."""
+
+from array import array
+
+from . import ast
+from .codec import ARRAY_TYPECODES, Error, Resolver, _hashable, _kind
+
+
+class ValidationError(Error):
+  def __init__(self, violations):
+    super(ValidationError, self).__init__('; '.join(violations))
+    self.violations = violations
+
+
+# The bounds of each integer kind.
+RANGES = {
+  'byte': (-1 << 7, (1 << 7) - 1),
+  'i16': (-1 << 15, (1 << 15) - 1),
+  'i32': (-1 << 31, (1 << 31) - 1),
+  'i64': (-1 << 63, (1 << 63) - 1),
+}
+
+# Kinds of a payload value: each path segment is (parent path, segment, kind).
+_FIELD, _ITEM, _KEY = range(3)
+
+
+def render(path):
+  """Return the text of a path: None for the payload itself, or (parent, segment, kind)."""
+  parts = []
+  while path is not None:
+    path, segment, kind = path
+    if kind == _FIELD:
+      parts.append('.%s' % segment)
+    elif kind == _ITEM:
+      parts.append('[%r]' % (segment,))
+    else:
+      parts.append('[key %r]' % (segment,))
+  return ''.join(reversed(parts)).lstrip('.')
+
+
+def _violation(errors, path, message):
+  text = render(path)
+  errors.append('%s: %s' % (text, message) if text else message)
+
+
+def _fits(values, typecode):
+  """Return whether the ints values all fit in the array.array typecode."""
+  try:
+    array(typecode, values)
+  except OverflowError:
+    return False
+  return True
+
+
+def _type_name(value):
+  return type(value).__name__
+
+
+def _enum_values(node):
+  return frozenset(value.tag for value in node.values)
+
+
+def _container_types(spec):
+  """Return the Python types accepted for a list or set spec."""
+  types = (list, tuple) if spec[0] == 'list' else (set, frozenset, list, tuple)
+  if spec[1] in RANGES or spec[1] == 'double':
+    types += (array,)
+  return types
+
+
+class Interpreter(object):
+  """Validates payloads by walking the definitions of their struct for every message."""
+
+  def __init__(self, loader):
+    self.resolver = Resolver(loader, enums=True)
+
+  def _check(self, spec, value, path, errors):
+    kind = _kind(spec)
+    if kind == 'struct':
+      self._check_struct(spec, value, path, errors)
+    elif kind == 'bool':
+      if not isinstance(value, bool):
+        _violation(errors, path, 'expected bool, got %s' % _type_name(value))
+    elif kind in RANGES or kind == 'enum':
+      if not isinstance(value, int) or isinstance(value, bool):
+        _violation(errors, path, 'expected %s, got %s' % (
+            spec[2] if kind == 'enum' else kind, _type_name(value)))
+      elif kind == 'enum':
+        if value not in _enum_values(spec[3]):
+          _violation(errors, path, '%r is not a value of enum %s' % (value, spec[2]))
+      elif not RANGES[kind][0] <= value <= RANGES[kind][1]:
+        _violation(errors, path, '%s out of range: %r' % (kind, value))
+    elif kind == 'double':
+      if not isinstance(value, (int, float)) or isinstance(value, bool):
+        _violation(errors, path, 'expected double, got %s' % _type_name(value))
+    elif kind == 'string':
+      if not isinstance(value, str):
+        _violation(errors, path, 'expected string, got %s' % _type_name(value))
+    elif kind == 'binary':
+      if not isinstance(value, (bytes, bytearray)):
+        _violation(errors, path, 'expected binary, got %s' % _type_name(value))
+    elif kind == 'map':
+      if isinstance(value, dict):
+        items = value.items()
+      elif not _hashable(spec[1]) and isinstance(value, (list, tuple)):
+        items = value
+      else:
+        _violation(errors, path, 'expected map, got %s' % _type_name(value))
+        return
+      for item in items:
+        if not isinstance(item, (list, tuple)) or len(item) != 2:
+          _violation(errors, path, 'expected (key, value) pairs, got %s' % _type_name(item))
+          continue
+        key, element = item
+        self._check(spec[1], key, (path, key, _KEY), errors)
+        self._check(spec[2], element, (path, key, _ITEM), errors)
+    else:
+      if not isinstance(value, _container_types(spec)):
+        _violation(errors, path, 'expected %s, got %s' % (kind, _type_name(value)))
+        return
+      for index, element in enumerate(value):
+        self._check(spec[1], element, (path, index, _ITEM), errors)
+
+  def _check_struct(self, spec, value, path, errors):
+    _, module, name, node = spec
+    if not isinstance(value, dict):
+      _violation(errors, path, 'expected a dict for struct %s, got %s' % (name, _type_name(value)))
+      return
+    present = 0
+    for field in node.fields:
+      field_name = field.name.value
+      field_value = value.get(field_name)
+      if field_value is None:
+        if field.required:
+          _violation(errors, (path, field_name, _FIELD), 'missing required field')
+        continue
+      present += 1
+      self._check(self.resolver.spec(field.type, module), field_value,
+                  (path, field_name, _FIELD), errors)
+    if getattr(node, 'union', False) and present != 1:
+      _violation(errors, path, 'union %s must have exactly one field set, not %d' % (name, present))
+
+  def validate(self, name, value, module=None):
+    errors = []
+    self._check_struct(self.resolver.struct(name, module), value, None, errors)
+    return errors
+
+
+class _Compiler(object):
+  """Generates the source of the validation functions of structs."""
+
+  # How many structs deep the checks of contained structs are inlined.
+  INLINE = 3
+  # The size from which containers of base types are checked in bulk; below, looping is faster.
+  BULK = 16
+
+  def __init__(self, validator):
+    self.validator = validator
+    self._names = 0
+    self._inlined = []  # (module, name) of the structs being generated, outermost first
+
+  def name(self, prefix):
+    self._names += 1
+    return '%s%d' % (prefix, self._names)
+
+  def constant(self, value):
+    """Return the name under which value is available to the generated code."""
+    name = self.name('_c')
+    self.validator.namespace[name] = value
+    return name
+
+  def struct(self, spec):
+    """Return the source of validate_<n>(value, path, errors) for the struct spec."""
+    lines = ['def %s(value, path, errors):' % self.validator.function(spec)]
+    self.body(spec, lines)
+    return lines
+
+  def entry(self, spec, function):
+    """Return the source of function(value) -> violations for the struct spec."""
+    lines = ['def %s(value):' % function, '  errors = []', '  path = None']
+    self.body(spec, lines)
+    lines.append('  return errors')
+    return lines
+
+  def body(self, spec, lines, var='value', path='path', indent='  '):
+    """Append the statements checking that var, whose path is path, is a valid struct spec."""
+    _, module, name, node = spec
+    union = getattr(node, 'union', False)
+    lines.extend([
+      '%sif type(%s) is not dict and not isinstance(%s, dict):' % (indent, var, var),
+      '%s  violation(errors, %s, %r %% type(%s).__name__)' % (
+          indent, path, 'expected a dict for struct %s, got %%s' % name, var),
+    ])
+    if not node.fields and not union:
+      return
+    lines.append('%selse:' % indent)
+    present, field_var = self.name('present'), self.name('v')
+    if union:
+      lines.append('%s  %s = 0' % (indent, present))
+    self._inlined.append((spec[1], spec[2]))
+    for field in node.fields:
+      field_name = field.name.value
+      field_path = '(%s, %r, %d)' % (path, field_name, _FIELD)
+      lines.append('%s  %s = %s.get(%r)' % (indent, field_var, var, field_name))
+      lines.append('%s  if %s is not None:' % (indent, field_var))
+      if union:
+        lines.append('%s    %s += 1' % (indent, present))
+      self.check(self.validator.resolver.spec(field.type, module), field_var, field_path, lines,
+                 indent + '    ')
+      if field.required:
+        lines.append('%s  else:' % indent)
+        lines.append("%s    violation(errors, %s, 'missing required field')" % (indent, field_path))
+    self._inlined.pop()
+    if union:
+      lines.append('%s  if %s != 1:' % (indent, present))
+      lines.append('%s    violation(errors, %s, %r %% %s)' % (
+          indent, path, 'union %s must have exactly one field set, not %%d' % name, present))
+
+  def check(self, spec, var, path, lines, indent):
+    """Append the statements checking var against spec; path is the expression of its path."""
+    kind = _kind(spec)
+    if kind == 'struct':
+      if len(self._inlined) < self.INLINE and (spec[1], spec[2]) not in self._inlined:
+        # Checked in place: no call, and no path built unless there is a violation to report.
+        self.body(spec, lines, var, path, indent)
+      else:
+        lines.append('%s%s(%s, %s, errors)' % (indent, self.validator.function(spec), var, path))
+    elif kind == 'bool':
+      lines.append('%sif type(%s) is not bool:' % (indent, var))
+      self.wrong_type(kind, var, path, lines, indent + '  ')
+    elif kind in RANGES or kind == 'enum':
+      # Fast path for exact ints; bools are ints but never a valid integer value.
+      lines.append('%sif type(%s) is not int and (type(%s) is bool or not isinstance(%s, int)):' % (
+          indent, var, var, var))
+      self.wrong_type(spec[2] if kind == 'enum' else kind, var, path, lines, indent + '  ')
+      if kind == 'enum':
+        lines.append('%selif %s not in %s:' % (
+            indent, var, self.constant(_enum_values(spec[3]))))
+        lines.append('%s  violation(errors, %s, %r %% %s)' % (
+            indent, path, '%%r is not a value of enum %s' % spec[2], var))
+      else:
+        low, high = RANGES[kind]
+        lines.append('%selif not %d <= %s <= %d:' % (indent, low, var, high))
+        lines.append('%s  violation(errors, %s, %r %% %s)' % (
+            indent, path, '%s out of range: %%r' % kind, var))
+    elif kind == 'double':
+      lines.append(
+          '%sif type(%s) is not float and (type(%s) is bool or not isinstance(%s, (int, float))):' % (
+              indent, var, var, var))
+      self.wrong_type(kind, var, path, lines, indent + '  ')
+    elif kind == 'string':
+      lines.append('%sif type(%s) is not str and not isinstance(%s, str):' % (indent, var, var))
+      self.wrong_type(kind, var, path, lines, indent + '  ')
+    elif kind == 'binary':
+      lines.append('%sif type(%s) is not bytes and not isinstance(%s, (bytes, bytearray)):' % (
+          indent, var, var))
+      self.wrong_type(kind, var, path, lines, indent + '  ')
+    elif kind == 'map':
+      key, element, item = self.name('k'), self.name('e'), self.name('m')
+      lines.append('%sif type(%s) is dict or isinstance(%s, dict):' % (indent, var, var))
+      keys, values = self.fast(spec[1], var), self.fast(spec[2], '%s.values()' % var)
+      loop = indent + '  '
+      if keys and values:
+        lines.append('%s  if not (%s and %s):' % (indent, keys, values))
+        loop += '  '
+      lines.append('%sfor %s, %s in %s.items():' % (loop, key, element, var))
+      self.check(spec[1], key, '(%s, %s, %d)' % (path, key, _KEY), lines, loop + '  ')
+      self.check(spec[2], element, '(%s, %s, %d)' % (path, key, _ITEM), lines, loop + '  ')
+      if not _hashable(spec[1]):
+        lines.extend([
+          '%selif isinstance(%s, (list, tuple)):' % (indent, var),
+          '%s  for %s in %s:' % (indent, item, var),
+          '%s    if not isinstance(%s, (list, tuple)) or len(%s) != 2:' % (indent, item, item),
+          '%s      violation(errors, %s, %r %% type(%s).__name__)' % (
+              indent, path, 'expected (key, value) pairs, got %s', item),
+          '%s      continue' % indent,
+          '%s    %s, %s = %s' % (indent, key, element, item),
+        ])
+        self.check(spec[1], key, '(%s, %s, %d)' % (path, key, _KEY), lines, indent + '    ')
+        self.check(spec[2], element, '(%s, %s, %d)' % (path, key, _ITEM), lines, indent + '    ')
+      lines.append('%selse:' % indent)
+      self.wrong_type(kind, var, path, lines, indent + '  ')
+    else:
+      index, element = self.name('i'), self.name('e')
+      types = self.constant(_container_types(spec))
+      lines.append('%sif type(%s) is not %s and not isinstance(%s, %s):' % (
+          indent, var, kind, var, types))
+      self.wrong_type(kind, var, path, lines, indent + '  ')
+      fast = self.fast(spec[1], var)
+      if fast:
+        # Only containers failing the check as a whole are walked, to find the offending elements.
+        lines.append('%selif not %s:' % (indent, fast))
+      else:
+        lines.append('%selse:' % indent)
+      lines.append('%s  for %s, %s in enumerate(%s):' % (indent, index, element, var))
+      self.check(spec[1], element, '(%s, %s, %d)' % (path, index, _ITEM), lines, indent + '    ')
+
+  def fast(self, spec, var):
+    """Return an expression true if every element of the iterable var is a valid spec, or None."""
+    kind = _kind(spec)
+    expected = {
+      'bool': 'bool', 'double': 'float', 'string': 'str', 'binary': 'bytes',
+    }.get(kind, 'int' if kind in RANGES or kind == 'enum' else None)
+    if expected is None:
+      return None
+    test = 'list(map(type, %s)).count(%s) == len(%s)' % (var, expected, var)
+    if kind == 'enum':
+      test += ' and %s >= set(%s)' % (self.constant(_enum_values(spec[3])), var)
+    elif kind in RANGES:
+      test += ' and fits(%s, %r)' % (var, ARRAY_TYPECODES[kind])
+    return '(len(%s) >= %d and %s)' % (var, self.BULK, test)
+
+  def wrong_type(self, expected, var, path, lines, indent):
+    lines.append('%sviolation(errors, %s, %r %% type(%s).__name__)' % (
+        indent, path, 'expected %s, got %%s' % expected, var))
+
+
+class Validator(object):
+  """Compiled validators for the structs of a Loader."""
+
+  def __init__(self, loader):
+    self.resolver = Resolver(loader, enums=True)
+    self.namespace = {'violation': _violation, 'fits': _fits}
+    self._functions = {}  # (module, name) -> function name
+    self._validators = {}  # (name, module) -> validate function
+    self._pending = []
+    self._compiler = _Compiler(self)
+
+  def function(self, spec):
+    """Return the name of the compiled function of spec, scheduling its source."""
+    key = (spec[1], spec[2])
+    name = self._functions.get(key)
+    if name is None:
+      name = self._functions[key] = 'validate_%s_%d' % (
+          spec[2].replace('.', '_'), len(self._functions))
+      self._pending.append(spec)
+    return name
+
+  def _compile(self, spec):
+    name = self.function(spec)
+    try:
+      while self._pending:
+        pending = self._pending.pop()
+        lines = self._compiler.struct(pending)
+        exec(compile('\n'.join(lines), '<ptsd.validator %s>' % pending[2], 'exec'), self.namespace)
+    except Error:
+      # Forget the functions left uncompiled, so the error is raised again on the next attempt.
+      del self._pending[:]
+      for key, function in list(self._functions.items()):
+        if function not in self.namespace:
+          del self._functions[key]
+      raise
+    return self.namespace[name]
+
+  def validator(self, name, module=None):
+    """Return the compiled function(value) -> violations of the struct or exception name."""
+    validate = self._validators.get((name, module))
+    if validate is None:
+      spec = self.resolver.struct(name, module)
+      self._compile(spec)
+      function = 'check_%s_%d' % (spec[2].replace('.', '_'), len(self._validators))
+      exec(compile('\n'.join(self._compiler.entry(spec, function)), '<ptsd.validator %s>' % name,
+                   'exec'), self.namespace)
+      validate = self._validators[(name, module)] = self.namespace[function]
+    return validate
+
+  def validate(self, name, value, module=None):
+    """Return the violations of value as the struct or exception name, an empty list if valid."""
+    return self.validator(name, module)(value)
+
+  def check(self, name, value, module=None):
+    """Raise ValidationError listing the violations of value, if it has any."""
+    violations = self.validator(name, module)(value)
+    if violations:
+      raise ValidationError(violations)
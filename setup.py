@@ -13,6 +13,7 @@ setup(
   license              = 'MIT',
   packages             = find_packages(),
   zip_safe             = True,
+  python_requires      = '>=3.6',
   install_requires     = ['ply'],
   scripts              = ['bin/ptsd'],
 )
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from ptsd import ast
+from ptsd.benchmark import Generator
+from ptsd.lexer import Identifier as LexerIdentifier, Literal
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def data_path(name):
+  return os.path.join(DATA, name)
+
+
+def read_data(name):
+  with open(data_path(name)) as fp:
+    return fp.read()
+
+
+def spans(tree):
+  """The class and packed span of every node of tree, in walk order."""
+  return [(type(node).__name__, node._span) for _, node in tree.walk()]
+
+
+def flatten(tree):
+  """Every node and value below tree, depth first, each node as its class and span.
+
+  Unlike walk(), this also visits types and const values, and needs no recursion.
+  """
+  out, stack = [], [tree]
+  while stack:
+    value = stack.pop()
+    if isinstance(value, ast.Node):
+      cls = type(value)
+      out.append((cls.__name__, value._span))
+      stack.extend(getattr(value, name, None) for name in reversed(ast._fields(cls)))
+    elif isinstance(value, (list, tuple)):
+      out.append(type(value).__name__)
+      stack.extend(reversed(value))
+    elif isinstance(value, dict):
+      out.append('dict')
+      for key, item in reversed(list(value.items())):
+        stack.extend((item, key))
+    elif isinstance(value, (LexerIdentifier, Literal)):
+      out.append((type(value).__name__, value.value))
+    else:
+      out.append(value)
+  return out
+
+
+@pytest.fixture(scope='session')
+def sources():
+  """Thrift sources to parse: the test data, and a synthetic include graph."""
+  generator = Generator(modules=6, fanout=2, structs=10, fields=6, enums=3, values=5, services=1,
+                        functions=4, depth=3, seed=1)
+  return [read_data('thrift_test.thrift'), read_data('inc.thrift')] + [
+      generator.module(i) for i in range(generator.modules)]
@@ -0,0 +1,17 @@
+include "thrift_test.thrift"
+namespace py inc
+
+/** doc text */
+enum Color { RED, GREEN = 5, BLUE (a = "b"); }
+typedef list<thrift_test.Bonk> Bonks
+const map<string, i32> M = {"a": 1, "b": 2}
+const list<double> L = [1.5, 2.0]
+struct Holder {
+  1: required Bonks bonks
+  2: optional Color color = Color.RED
+  3: i32 x = 3 (foo = "bar")
+} (annot = "yes")
+union U { 1: i32 a; 2: string b }
+service S extends thrift_test.SecondService {
+  thrift_test.Xtruct get(1: i32 id) throws (1: thrift_test.Xception e)
+}
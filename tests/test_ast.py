@@ -0,0 +1,29 @@
+import pickle
+
+import pytest
+
+from ptsd import ast
+from ptsd.parser import Parser
+
+
+def test_unannotated_base_types_are_shared():
+  tree = Parser().parse('struct S { 1: i32 a, 2: i32 (x = "y") b }')
+  a, b = tree.body[0].fields
+  assert a.type is ast.I32.shared()
+  assert b.type is not ast.I32.shared()
+  assert [str(annotation.name) for annotation in b.type.annotations] == ['x']
+  assert pickle.loads(pickle.dumps(a.type)) is ast.I32.shared()
+
+
+def test_shared_base_types_are_immutable():
+  shared = ast.String.shared()
+  shared.add_annotations([])
+  with pytest.raises(TypeError):
+    shared.add_annotations([object()])
+  assert shared.annotations == ()
+
+
+def test_base_type_constructor():
+  node = ast.Double(None)
+  node.add_annotations(['annotation'])
+  assert node.annotations == ['annotation'] and node._span is None
@@ -0,0 +1,66 @@
+"""The descent backend must build the same trees as PLY's, spans included, and fail alike."""
+
+import re
+
+import pytest
+
+from ptsd.descent import DescentParser
+from ptsd.parser import Parser
+
+from conftest import flatten
+
+
+def error(parser, data):
+  with pytest.raises(Parser.Error) as info:
+    parser.parse(data)
+  # Tokens holding an identifier show it by address.
+  return re.sub(r' at 0x[0-9a-f]+', '', str(info.value))
+
+
+def parse_both(data, **options):
+  return Parser(**options).parse(data), DescentParser(**options).parse(data)
+
+
+def test_same_trees(sources):
+  for data in sources:
+    ply, descent = parse_both(data)
+    assert str(descent) == str(ply)
+    assert flatten(descent) == flatten(ply)
+    assert descent.fingerprint() == ply.fingerprint()
+
+
+def test_same_trees_without_positions(sources):
+  for data in sources:
+    ply, descent = parse_both(data, track_positions=False)
+    assert flatten(descent) == flatten(ply)
+
+
+def test_same_iterparse(sources):
+  for data in sources:
+    ply = [flatten(item) for item in Parser().iterparse(data)]
+    assert [flatten(item) for item in DescentParser().iterparse(data)] == ply
+
+
+@pytest.mark.parametrize('data', [
+  'typedef %si32%s T' % ('list<' * 3000, '>' * 3000),
+  'typedef %si32%s T' % ('map<string, ' * 3000, '>' * 3000),
+  'struct S { 1: %si32 (a = "b")%s x }' % ('set<' * 3000, '> (c = "d")' * 3000),
+  'const list<i32> C = %s%s' % ('[1, ' * 3000, ']' * 3000),
+  'const map<i32, i32> C = %s1%s' % ('{1: ' * 3000, '}' * 3000),
+], ids=['list', 'map', 'set', 'const list', 'const map'])
+def test_deep_nesting(data):
+  ply, descent = parse_both(data)
+  assert flatten(descent) == flatten(ply)
+
+
+@pytest.mark.parametrize('data', [
+  'struct S { 1: i32 }',
+  'typedef map<i32 T',
+  'typedef list<i32 T',
+  'const i32 C = {1:}',
+  'const i32 C = {1 2}',
+  'const i32 C = [1,',
+  'typedef %si32 T' % ('list<' * 3000),
+], ids=range(7))
+def test_same_errors(data):
+  assert error(DescentParser(), data) == error(Parser(), data)
@@ -0,0 +1,29 @@
+import os
+
+from ptsd.batch import BatchLoader, expand
+
+from conftest import DATA, data_path
+
+
+def test_expand_directories_and_globs():
+  assert expand([DATA]) == [data_path('inc.thrift'), data_path('thrift_test.thrift')]
+  assert expand([os.path.join(DATA, '**', 'inc.*')]) == [data_path('inc.thrift')]
+
+
+def test_expand_deduplicates_by_real_path(tmp_path):
+  link = tmp_path / 'link.thrift'
+  link.symlink_to(data_path('inc.thrift'))
+  relative = os.path.relpath(data_path('thrift_test.thrift'))
+  roots = expand([str(link), relative, DATA, data_path('inc.thrift'),
+                  os.path.join(DATA, '*.thrift')])
+  # Each file once, as first named.
+  assert roots == [str(link), relative]
+
+
+def test_batch_results_in_order():
+  roots = expand([DATA]) + [data_path('missing.thrift')]
+  results = list(BatchLoader().run(roots))
+  assert [result.root for result in results] == roots
+  assert [result.ok for result in results] == [True, True, False]
+  # inc.thrift includes thrift_test.thrift, which the second root then shares.
+  assert [result.files for result in results[:2]] == [2, 0]
@@ -0,0 +1,50 @@
+import pytest
+
+from ptsd.codec import Codec, EncodeError, Interpreter
+from ptsd.loader import Loader
+
+
+SOURCE = '''
+struct Numbers {
+  1: optional byte b
+  2: optional i16 s
+  3: optional i32 i
+  4: optional i64 l
+  5: optional list<i16> ss
+  6: optional map<i32, byte> m
+}
+'''
+
+LIMITS = {'b': 8, 's': 16, 'i': 32, 'l': 64}
+
+
+@pytest.fixture(scope='module')
+def loader(tmp_path_factory):
+  path = tmp_path_factory.mktemp('codec') / 'numbers.thrift'
+  path.write_text(SOURCE)
+  return Loader(str(path), logger=lambda message: None)
+
+
+@pytest.fixture(params=[(cls, protocol) for cls in (Codec, Interpreter)
+                        for protocol in ('binary', 'compact')],
+                ids=lambda param: '%s-%s' % (param[0].__name__, param[1]))
+def codec(request, loader):
+  cls, protocol = request.param
+  return cls(loader, protocol=protocol)
+
+
+def test_integer_limits_round_trip(codec):
+  for field, bits in LIMITS.items():
+    for value in (-1 << bits - 1, (1 << bits - 1) - 1, 0, -1):
+      assert codec.decode('Numbers', codec.encode('Numbers', {field: value})) == {field: value}
+
+
+def test_integers_out_of_range(codec):
+  for field, bits in LIMITS.items():
+    for value in (-1 << bits - 1) - 1, 1 << bits - 1:
+      with pytest.raises(EncodeError):
+        codec.encode('Numbers', {field: value})
+  with pytest.raises(EncodeError):
+    codec.encode('Numbers', {'ss': [1, 1 << 15]})
+  with pytest.raises(EncodeError):
+    codec.encode('Numbers', {'m': {1: 128}})
@@ -0,0 +1,158 @@
+import pytest
+
+from ptsd import ast
+from ptsd.diff import Differ, diff_loaders
+from ptsd.loader import Loader
+from ptsd.parser import Parser
+
+
+def diff(old, new):
+  parser = Parser()
+  return [(change.path, change.kind, change.compatible)
+          for change in Differ().diff(parser.parse(old), parser.parse(new))]
+
+
+def diff_files(tmp_path, old, new):
+  roots = []
+  for name, source in (('old', old), ('new', new)):
+    directory = tmp_path / name
+    directory.mkdir()
+    (directory / 'schema.thrift').write_text(source)
+    roots.append(Loader(str(directory / 'schema.thrift'), logger=lambda message: None))
+  return [(change.path, change.kind, change.compatible) for change in diff_loaders(*roots)]
+
+
+# Fingerprints
+def test_fingerprints_ignore_formatting():
+  parser = Parser()
+  old = parser.parse('struct S { 1: i32 a, 2: map<string, list<i32>> b = {"x": [1]} }')
+  new = parser.parse('struct S {\n  1: i32 a;\n  2: map<string,list<i32>> b = {"x": [1,]}\n}\n')
+  assert old.fingerprint() == new.fingerprint()
+  assert old.fingerprint() != parser.parse('struct S { 1: i32 a }').fingerprint()
+
+
+def test_fingerprints_of_const_maps_ignore_order():
+  parser = Parser()
+  old = parser.parse('const map<i32, i32> M = {1: 2, 3: 4}')
+  new = parser.parse('const map<i32, i32> M = {3: 4, 1: 2}')
+  assert old.fingerprint() == new.fingerprint()
+  assert old.fingerprint() != parser.parse('const map<i32, i32> M = {1: 4, 3: 2}').fingerprint()
+
+
+def test_fingerprints_of_nested_lists():
+  parser = Parser()
+  fingerprint = parser.parse('const list<list<i32>> L = [[1, 2], [3]]').fingerprint()
+  assert fingerprint != parser.parse('const list<list<i32>> L = [[1], [2, 3]]').fingerprint()
+  assert ast.fingerprint([[1, 2], [3]]) != ast.fingerprint([[1], [2, 3]])
+
+
+def test_fingerprints_of_deep_trees():
+  depth = 5000
+  parser = Parser()
+  tree = parser.parse('typedef %si32%s T' % ('list<' * depth, '>' * depth))
+  other = parser.parse('typedef %si64%s T' % ('list<' * depth, '>' * depth))
+  assert tree.fingerprint() != other.fingerprint()
+  values = parser.parse('const list<i32> C = %s1%s' % ('[' * depth, ']' * depth))
+  assert len(values.fingerprint()) == 16
+
+
+def test_fingerprints_are_kept_until_invalidated():
+  tree = Parser().parse('struct S { 1: i32 a }')
+  fingerprint = tree.fingerprint()
+  tree.body[0].fields[0].tag = 2
+  assert tree.fingerprint() == fingerprint
+  tree.invalidate()
+  assert tree.fingerprint() != fingerprint
+
+
+# The rules of the Differ, as its docstring states them.
+def test_adding_and_removing_optional_fields_is_compatible():
+  assert diff('struct S { 1: i32 a }', 'struct S { 1: i32 a, 2: i32 b }') == [
+      ('S.b', 'added', True)]
+  assert diff('struct S { 1: i32 a, 2: i32 b }', 'struct S { 1: i32 a }') == [
+      ('S.b', 'removed', True)]
+
+
+def test_adding_and_removing_required_fields_is_not():
+  assert diff('struct S { 1: i32 a }', 'struct S { 1: i32 a, 2: required i32 b }') == [
+      ('S.b', 'added', False)]
+  assert diff('struct S { 1: i32 a, 2: required i32 b }', 'struct S { 1: i32 a }') == [
+      ('S.b', 'removed', False)]
+
+
+def test_moving_a_field_to_another_tag_is_not_compatible():
+  assert diff('struct S { 1: i32 a }', 'struct S { 2: i32 a }') == [('S.a', 'tag', False)]
+
+
+def test_changing_requiredness_is_not_compatible():
+  assert diff('struct S { 1: i32 a }', 'struct S { 1: required i32 a }') == [
+      ('S.a', 'requiredness', False)]
+  assert diff('struct S { 1: required i32 a }', 'struct S { 1: optional i32 a }') == [
+      ('S.a', 'requiredness', False)]
+
+
+def test_string_and_binary_are_written_alike():
+  assert diff('struct S { 1: string a }', 'struct S { 1: binary a }') == [('S.a', 'type', True)]
+  assert diff('struct S { 1: list<binary> a }', 'struct S { 1: list<string> a }') == [
+      ('S.a', 'type', True)]
+  assert diff('struct S { 1: string a }', 'struct S { 1: i32 a }') == [('S.a', 'type', False)]
+
+
+def test_enums_and_i32_are_written_alike(tmp_path):
+  old = 'enum E { A = 1 }\nstruct S { 1: E a }\nservice V { E f(1: E x) }'
+  new = 'enum E { A = 1 }\nstruct S { 1: i32 a }\nservice V { i32 f(1: i32 x) }'
+  assert diff_files(tmp_path, old, new) == [
+      ('schema.S.a', 'type', True), ('schema.V.f', 'type', True), ('schema.V.f.x', 'type', True)]
+
+
+def test_enums_and_i64_are_not(tmp_path):
+  assert diff_files(tmp_path, 'enum E { A = 1 }\nstruct S { 1: E a }',
+                    'enum E { A = 1 }\nstruct S { 1: i64 a }') == [('schema.S.a', 'type', False)]
+
+
+def test_typedefs_and_their_types_are_written_alike(tmp_path):
+  assert diff_files(tmp_path, 'typedef string T\nstruct S { 1: T a }',
+                    'typedef string T\nstruct S { 1: binary a }') == [('schema.S.a', 'type', True)]
+
+
+def test_renaming_a_field_is_compatible():
+  assert diff('struct S { 1: i32 a }', 'struct S { 1: i32 b }') == [('S.b', 'name', True)]
+
+
+def test_adding_and_renaming_enum_values_is_compatible():
+  assert diff('enum E { A = 1 }', 'enum E { A = 1, B = 2 }') == [('E.B', 'added', True)]
+  assert diff('enum E { A = 1 }', 'enum E { B = 1 }') == [('E.A', 'name', True)]
+
+
+def test_changing_and_removing_enum_values_is_not():
+  assert diff('enum E { A = 1 }', 'enum E { A = 2 }') == [('E.A', 'value', False)]
+  assert diff('enum E { A = 1, B = 2 }', 'enum E { A = 1 }') == [('E.B', 'removed', False)]
+  # A new name for another value is a removal and an addition, not a rename.
+  assert sorted(diff('enum E { A = 1 }', 'enum E { B = 2 }')) == [
+      ('E.A', 'removed', False), ('E.B', 'added', True)]
+
+
+def test_removing_definitions_and_functions_is_not_compatible():
+  assert diff('struct S {}\nstruct T {}', 'struct S {}') == [('T', 'removed', False)]
+  assert diff('service V { void f(), void g() }', 'service V { void f() }') == [
+      ('V.g', 'removed', False)]
+  assert diff('struct S {}', 'union S {}') == [('S', 'definition', False)]
+  assert diff('struct S {}', 'exception S {}') == [('S', 'definition', False)]
+
+
+@pytest.mark.parametrize('old, new, kind', [
+  ('struct S { 1: i32 a = 1 }', 'struct S { 1: i32 a = 2 }', 'default'),
+  ('const i32 C = 1', 'const i32 C = 2', 'value'),
+  ('struct S { 1: i32 a (x = "1") }', 'struct S { 1: i32 a (x = "2") }', 'annotations'),
+  ('namespace py a\nstruct S {}', 'namespace py b\nstruct S {}', 'other'),
+  ('include "a.thrift"\nstruct S {}', 'include "b.thrift"\nstruct S {}', 'other'),
+], ids=['default', 'const', 'annotations', 'namespace', 'include'])
+def test_what_is_not_written_is_compatible(old, new, kind):
+  changes = diff(old, new)
+  assert changes and all(compatible for _, _, compatible in changes)
+  assert kind in [change_kind for _, change_kind, _ in changes]
+
+
+def test_equal_trees_have_no_changes():
+  source = 'struct S { 1: i32 a }\nenum E { A = 1 }\nservice V { void f() }'
+  assert diff(source, source) == []
@@ -0,0 +1,158 @@
+import io
+import json
+
+import pytest
+
+from ptsd import ast, export
+from ptsd.lexer import Identifier as LexerIdentifier, Literal
+from ptsd.loader import Loader
+from ptsd.parser import Parser
+
+from conftest import data_path, flatten, read_data
+
+
+def json_round_trip(source):
+  fp = io.StringIO()
+  export.write_json(source, fp)
+  json.loads(fp.getvalue())  # valid JSON as written
+  return export.read_json(io.StringIO(fp.getvalue()))
+
+
+def binary_round_trip(source):
+  fp = io.BytesIO()
+  export.write_binary(source, fp)
+  return export.read_binary(io.BytesIO(fp.getvalue()))
+
+
+def binary_round_trip_value(value):
+  fp = io.BytesIO()
+  writer = export.BinaryWriter(fp)
+  writer.value(value)
+  writer.flush()
+  return export.BinaryReader(fp.getvalue()).value()
+
+
+ROUND_TRIPS = [json_round_trip, binary_round_trip]
+
+
+def assert_same_tree(copy, tree):
+  assert type(copy) is ast.Thrift
+  assert flatten(copy) == flatten(tree)
+  assert str(copy) == str(tree)
+  assert copy.fingerprint() == tree.fingerprint()
+
+
+def shared_base_types(tree):
+  stack, found = [tree], []
+  while stack:
+    value = stack.pop()
+    if isinstance(value, ast.Node):
+      if isinstance(value, ast.BaseType) and value is type(value).shared():
+        found.append(value)
+      else:
+        stack.extend(getattr(value, name, None) for name in ast._fields(type(value)))
+    elif isinstance(value, (list, tuple)):
+      stack.extend(value)
+  return found
+
+
+@pytest.mark.parametrize('round_trip', ROUND_TRIPS)
+@pytest.mark.parametrize('name', ['thrift_test.thrift', 'inc.thrift'])
+def test_thrift_round_trip(round_trip, name):
+  tree = Parser().parse(read_data(name))
+  copy = round_trip(tree)
+  assert_same_tree(copy, tree)
+  # Spans, annotations and the tagged values all come back.
+  assert all(node._span is not None for _, node in copy.walk())
+  assert shared_base_types(copy) and all(
+      node is type(node).shared() for node in shared_base_types(copy))
+
+
+@pytest.mark.parametrize('round_trip', ROUND_TRIPS)
+def test_thrift_round_trip_without_positions(round_trip):
+  tree = Parser(track_positions=False).parse(read_data('inc.thrift'))
+  assert_same_tree(round_trip(tree), tree)
+
+
+@pytest.mark.parametrize('round_trip', ROUND_TRIPS)
+def test_tagged_values(round_trip):
+  tree = Parser().parse('''
+      enum E { A = 1 } (doc = "enum")
+      const map<string, list<i32>> M = {"a": [1, 2], "b": []}
+      const E C = E.A
+      typedef string (x = "y") S
+  ''')
+  copy = round_trip(tree)
+  assert_same_tree(copy, tree)
+  enum, mapping, const, typedef = copy.body
+  assert [(str(a.name), a.value.value) for a in enum.annotations] == [('doc', 'enum')]
+  assert type(mapping.value) is dict
+  key, = [key for key in mapping.value if key.value == 'a']
+  assert type(key) is Literal and mapping.value[key] == [1, 2]
+  assert type(const.value) is ast.Identifier and const.value.value == 'E.A'
+  assert type(typedef.type) is ast.String and typedef.type is not ast.String.shared()
+  assert [(str(a.name), a.value.value) for a in typedef.type.annotations] == [('x', 'y')]
+
+
+def test_plain_tags():
+  value = [(1, 'a'), {Literal('k'): LexerIdentifier('v')}, None, True, 1.5]
+  for copy in (json.loads(json.dumps(export.plain(value)), object_hook=export._from_plain),
+               binary_round_trip_value(value)):
+    pair, mapping, none, true, double = copy
+    assert pair == (1, 'a')
+    (key, item), = mapping.items()
+    assert (type(key), key.value) == (Literal, 'k')
+    assert (type(item), item.value) == (LexerIdentifier, 'v')
+    assert (none, true, double) == (None, True, 1.5)
+
+
+@pytest.mark.parametrize('round_trip', ROUND_TRIPS)
+def test_loader_round_trip(round_trip):
+  loader = Loader(data_path('inc.thrift'), logger=lambda message: None)
+  document = round_trip(loader)
+  assert (document['format'], document['version']) == (export.FORMAT, export.VERSION)
+  assert document['root'] == data_path('inc.thrift')
+  modules = dict((module['path'], module) for module in document['modules'])
+  assert sorted(modules) == sorted(loader.thrifts)
+  for path, thrift in loader.thrifts.items():
+    module = modules[path]
+    assert module['includes'] == list(loader.include_paths(path, thrift))
+    assert_same_tree(module['thrift'], thrift)
+  assert modules[data_path('inc.thrift')]['includes'] == [data_path('thrift_test.thrift')]
+  assert modules[data_path('inc.thrift')]['module'] == 'inc'
+
+
+def binary_export(source):
+  fp = io.BytesIO()
+  export.write_binary(source, fp)
+  return fp.getvalue()
+
+
+def read_binary(data):
+  return export.read_binary(io.BytesIO(data))
+
+
+def test_bad_magic():
+  data = binary_export(Parser().parse(read_data('inc.thrift')))
+  with pytest.raises(export.Error, match='Not a ptsd binary export'):
+    read_binary(b'XXXX' + data[4:])
+  with pytest.raises(export.Error):
+    read_binary(b'')
+
+
+def test_truncated_input():
+  data = binary_export(Parser().parse('struct S { 1: i32 (a = "b") x = 1.5 } (c = "d")'))
+  for length in range(len(export.MAGIC), len(data)):
+    with pytest.raises(export.Error):
+      read_binary(data[:length])
+  with pytest.raises(export.Error, match='Trailing data'):
+    read_binary(data + b'\0')
+
+
+def test_unknown_tag():
+  with pytest.raises(export.Error, match='Unknown tag 99'):
+    read_binary(export.MAGIC + b'\x63')
+  with pytest.raises(export.Error, match='Unknown node class'):
+    export.read_json(io.StringIO('{"node": "Nonsense"}'))
+  with pytest.raises(export.Error, match='Unknown string'):
+    read_binary(export.MAGIC + bytes([export._STRING_REF, 5]))
@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing ptsd.loader takes about 15ms, 35ms without bytecode caches; the budget leaves room for a
+# loaded machine.  A heavy import creeping back in is caught by DEFERRED before the budget.
+IMPORT_BUDGET = 0.25
+
+# What importing ptsd.loader must leave for first use: PLY and the parsers, which a load served
+# from the cache never needs, and the standard modules only some features use.
+DEFERRED = ['ply', 'ply.lex', 'ply.yacc', 'ptsd.parser', 'ptsd.descent', 'ptsd.cache', 'hashlib',
+            'pickle', 'multiprocessing', 'ptsd.export', 'ptsd.codec']
+
+SCRIPT = '''
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import ptsd.loader
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'imported': sorted(set(sys.modules) - before)}))
+'''
+
+
+def import_loader():
+  env = dict(os.environ, PYTHONPATH=ROOT)
+  output = subprocess.check_output([sys.executable, '-c', SCRIPT], env=env, cwd=ROOT)
+  return json.loads(output.decode('utf-8'))
+
+
+def test_import_loader_defers_heavy_modules():
+  imported = import_loader()['imported']
+  assert 'ptsd.loader' in imported
+  assert [name for name in DEFERRED if name in imported] == []
+
+
+def test_import_loader_within_budget():
+  seconds = min(import_loader()['seconds'] for _ in range(3))
+  assert seconds < IMPORT_BUDGET, 'importing ptsd.loader took %.1fms' % (1000 * seconds)
@@ -0,0 +1,34 @@
+import pytest
+
+from ptsd import ast
+from ptsd.loader import Loader
+
+
+SOURCE = '''
+typedef list<i32> A
+typedef list<i32> B
+typedef list<i32> (x = "y") C
+struct S { 1: map<string, list<i32>> m }
+'''
+
+
+@pytest.fixture
+def loader(tmp_path):
+  path = tmp_path / 'types.thrift'
+  path.write_text(SOURCE)
+  return Loader(str(path), logger=lambda message: None, intern=True)
+
+
+def test_unannotated_types_are_shared(loader):
+  a, b, c, s = next(iter(loader.thrifts.values())).body
+  assert a.type is b.type and a.type._span is None
+  assert c.type is not a.type and [str(n.name) for n in c.type.annotations] == ['x']
+  assert s.fields[0].type.value_type is a.type
+
+
+def test_shared_types_are_immutable(loader):
+  a = next(iter(loader.thrifts.values())).body[0]
+  a.type.add_annotations([])
+  with pytest.raises(TypeError):
+    a.type.add_annotations([object()])
+  assert a.type.annotations == ()
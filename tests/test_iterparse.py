@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from ptsd.parser import Parser
+
+
+def iterparse_threads():
+  return [thread for thread in threading.enumerate() if thread.name == 'ptsd-iterparse']
+
+
+def many_structs(count):
+  return '\n'.join('struct S%d { 1: i32 a }' % i for i in range(count))
+
+
+def test_iterparse_yields_what_parse_builds(sources):
+  parser = Parser()
+  for data in sources:
+    tree = parser.parse(data)
+    items = list(parser.iterparse(data))
+    assert [str(item) for item in items] == [
+        str(node) for node in tree.includes + tree.namespaces + tree.body]
+  assert not iterparse_threads()
+
+
+def test_closing_early_stops_the_parse():
+  parser = Parser()
+  data = many_structs(10 * Parser.ITERPARSE_BUFFER)
+  items = parser.iterparse(data)
+  assert str(next(items).name) == 'S0'
+  items.close()
+  assert not iterparse_threads()
+  # The parser is free again.
+  assert len(parser.parse(data).body) == 10 * Parser.ITERPARSE_BUFFER
+
+
+def test_errors_are_raised_in_order():
+  data = many_structs(3 * Parser.ITERPARSE_BUFFER) + '\nstruct {'
+  names = []
+  with pytest.raises(Parser.Error):
+    for item in Parser().iterparse(data):
+      names.append(str(item.name))
+  assert len(names) == 3 * Parser.ITERPARSE_BUFFER
+  assert not iterparse_threads()
@@ -0,0 +1,44 @@
+import mmap
+
+import pytest
+
+from conftest import data_path
+from ptsd.loader import Loader
+from ptsd.parser import Parser, ParserPool
+
+
+class ReversingParser(Parser):
+  def parse(self, data):
+    thrift = super(ReversingParser, self).parse(data)
+    thrift.body.reverse()
+    return thrift
+
+
+def test_workers_use_the_given_parser():
+  root = data_path('thrift_test.thrift')
+  sequential = Loader(root, parser=ReversingParser())
+  for parser in ReversingParser(), ParserPool(ReversingParser):
+    parallel = Loader(root, parser=parser, workers=2)
+    assert sorted(parallel.thrifts) == sorted(sequential.thrifts)
+    for path, thrift in sequential.thrifts.items():
+      assert str(parallel.thrifts[path]) == str(thrift)
+
+
+def test_failed_load_closes_prefetched_sources(monkeypatch):
+  opened = []
+  read = Loader.read
+
+  def recording_read(self, real_path):
+    data = read(self, real_path)
+    opened.append(data)
+    return data
+
+  def failing_process(self, root):
+    raise Loader.Error('boom')
+
+  monkeypatch.setattr(Loader, 'read', recording_read)
+  monkeypatch.setattr(Loader, 'process', failing_process)
+  with pytest.raises(Loader.Error):
+    Loader(data_path('thrift_test.thrift'), use_mmap=True, workers=2)
+  assert opened and all(isinstance(data, mmap.mmap) for data in opened)
+  assert all(data.closed for data in opened)
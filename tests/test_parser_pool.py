@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ptsd.parser import BACKENDS, Parser, ParserPool, parser_class
+
+from conftest import spans
+
+
+THREADS = 8
+ROUNDS = 10
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_concurrent_parses_match_sequential(sources, backend):
+  parser = parser_class(backend)()
+  expected = [(str(tree), spans(tree)) for tree in map(parser.parse, sources)]
+  pool = ParserPool(parser_class(backend))
+
+  def parse(index):
+    tree = pool.parse(sources[index])
+    return index, str(tree), spans(tree)
+
+  indices = [i for _ in range(ROUNDS) for i in range(len(sources))]
+  with ThreadPoolExecutor(THREADS) as executor:
+    results = list(executor.map(parse, indices))
+  assert len(results) == len(indices)
+  for index, text, positions in results:
+    assert (text, positions) == expected[index]
+
+
+def test_pool_reuses_idle_parsers(sources):
+  pool = ParserPool()
+  for data in sources:
+    pool.parse(data)
+  assert len(pool._idle) == 1
+  assert isinstance(pool._idle[0], Parser)
+
+
+def test_pool_without_positions(sources):
+  tree = ParserPool(track_positions=False).parse(sources[0])
+  assert all(span is None for _, span in spans(tree))
+  assert str(tree) == str(Parser().parse(sources[0]))
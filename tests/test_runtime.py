@@ -0,0 +1,61 @@
+import pytest
+
+from ptsd.loader import Loader
+from ptsd.runtime import Runtime
+
+
+SOURCE = '''
+struct deepcopy {
+  1: list<i32> values = [1, 2]
+}
+
+struct NotImplemented {
+  1: i32 a
+}
+
+struct _c1 {
+  1: map<string, i32> m = {"a": 1}
+}
+
+struct Clash {
+  1: i32 self_
+  2: list<i32> deepcopy = [3]
+  3: i32 _c0 = 7
+  4: list<i32> _c1 = [4]
+  5: i32 other
+  6: i32 from
+}
+
+exception Failed {
+  1: string deepcopy = "message"
+  2: list<string> _c0 = ["a"]
+}
+'''
+
+
+@pytest.fixture
+def module(tmp_path):
+  path = tmp_path / 'clash.thrift'
+  path.write_text(SOURCE)
+  return Runtime(Loader(str(path), logger=lambda message: None)).modules['clash']
+
+
+def test_classes_named_like_helpers(module):
+  first, second = module.deepcopy(), module.deepcopy()
+  assert first.values == [1, 2] and first.values is not second.values
+  assert module._c1().m == {'a': 1} and module._c1().m is not module._c1().m
+  assert module.NotImplemented(a=1) == module.NotImplemented(a=1)
+  assert module.NotImplemented(a=1) != module.NotImplemented(a=2)
+  assert module.NotImplemented(a=1) != 1
+
+
+def test_fields_named_like_helpers(module):
+  value = module.Clash(self_=1, other=2, from_=3)
+  assert (value.self_, value.other, value.from_) == (1, 2, 3)
+  assert (value.deepcopy, value._c0, value._c1) == ([3], 7, [4])
+  assert value.deepcopy is not module.Clash().deepcopy
+  assert value == module.Clash(self_=1, other=2, from_=3)
+  assert repr(module.Clash(self_=1)).startswith('Clash(self_=1, deepcopy=[3], _c0=7')
+  failed = module.Failed()
+  assert (failed.deepcopy, failed._c0) == ('message', ['a'])
+  assert failed._c0 is not module.Failed()._c0